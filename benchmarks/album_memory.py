@@ -0,0 +1,56 @@
+"""
+Compares the memory used by Album and CompactAlbum
+
+Uses spreadsheet.csv by default, or an export (JSON/ndjson/binary):
+
+    python3 benchmarks/album_memory.py [EXPORT_FILE]
+"""
+
+import gc
+import sys
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable, List
+
+from nextalbums.core_gsheets import use_offline_source
+from nextalbums.export import export_data, read_dump, Album
+from nextalbums.compact_album import compact_albums
+
+ROOT = Path(__file__).parent.parent
+
+
+def _measure(load: Callable[[], List[Any]]) -> int:
+    gc.collect()
+    tracemalloc.start()
+    items = load()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del items
+    gc.collect()
+    return size
+
+
+def main() -> None:
+    if len(sys.argv) > 1:
+        path = Path(sys.argv[1])
+
+        def _albums() -> Any:
+            return read_dump(path)
+
+    else:
+        use_offline_source(ROOT / "spreadsheet.csv")
+
+        def _albums() -> Any:
+            return (a for a in export_data() if isinstance(a, Album))
+
+    count = len(list(_albums()))
+    before = _measure(lambda: list(_albums()))
+    after = _measure(lambda: compact_albums(_albums()))
+    print(f"{count} albums")
+    print(f"Album:        {before:>10} bytes, {before / count:>7.1f} bytes/album")
+    print(f"CompactAlbum: {after:>10} bytes, {after / count:>7.1f} bytes/album")
+    print(f"{100 * (1 - after / before):.1f}% smaller")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""
+Compares reading the JSON export against the binary export
+
+Uses spreadsheet.csv, so this doesn't need the Google Sheets API:
+
+    python3 benchmarks/read_dump.py [REPEAT]
+"""
+
+import sys
+import json
+import random
+import tempfile
+from pathlib import Path
+from timeit import timeit
+
+from nextalbums.core_gsheets import use_offline_source
+from nextalbums.export import export_data, dump_results, read_dump, Album
+from nextalbums.binary_export import BinaryDump, write_binary_dump
+
+ROOT = Path(__file__).parent.parent
+
+
+def main(repeat: int) -> None:
+    use_offline_source(ROOT / "spreadsheet.csv")
+    albums = [a for a in export_data() if isinstance(a, Album)]
+    with tempfile.TemporaryDirectory() as tmp:
+        json_path = Path(tmp) / "albums.json"
+        binary_path = Path(tmp) / "albums.bin"
+        json_path.write_text(dump_results(albums))
+        write_binary_dump(albums, binary_path)
+        assert list(read_dump(json_path)) == list(read_dump(binary_path))
+
+        print(f"{len(albums)} albums, best of {repeat} runs")
+        print(f"json size:   {json_path.stat().st_size:>10} bytes")
+        print(f"binary size: {binary_path.stat().st_size:>10} bytes")
+
+        def _bench(name: str, func) -> None:  # type: ignore[no-untyped-def]
+            best = min(timeit(func, number=1) for _ in range(repeat))
+            print(f"{name:<28} {best * 1000:>8.2f}ms")
+
+        indices = random.Random(0).sample(range(len(albums)), 10)
+
+        _bench("json.loads (no Albums)", lambda: json.loads(json_path.read_text()))
+        _bench("read_dump json", lambda: list(read_dump(json_path)))
+        _bench("read_dump binary", lambda: list(read_dump(binary_path)))
+
+        def _json_by_index() -> None:
+            loaded = list(read_dump(json_path))
+            for i in indices:
+                loaded[i]
+
+        def _binary_by_index() -> None:
+            with BinaryDump(binary_path) as dump:
+                for i in indices:
+                    dump[i]
+
+        _bench("10 albums by index, json", _json_by_index)
+        _bench("10 albums by index, binary", _binary_by_index)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
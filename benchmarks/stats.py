@@ -0,0 +1,65 @@
+"""
+Times the stats command on synthetic albums
+
+    python3 benchmarks/stats.py [ROWS]
+"""
+
+import sys
+import random
+from datetime import date, timedelta
+from time import perf_counter
+from typing import List
+
+from nextalbums.export import Album
+from nextalbums.album_table import AlbumTable
+from nextalbums.stats import compute_stats
+
+GENRES = ["Rock", "Jazz", "Electronic", "Hip Hop", "Pop", "Folk, World, & Country"]
+STYLES = [f"Style {i}" for i in range(300)]
+REASONS = [f"Reason {i}" for i in range(150)]
+
+
+def synthetic_albums(rows: int, seed: int = 0) -> List[Album]:
+    r = random.Random(seed)
+    start = date(2015, 1, 1)
+    albums = []
+    for i in range(rows):
+        listened = r.random() < 0.6
+        albums.append(
+            Album(
+                score=(
+                    r.choice([4.0, 5.5, 6.0, 7.0, 7.5, 8.0, 9.0]) if listened else None
+                ),
+                note=None,
+                listened_on=(
+                    start + timedelta(days=r.randint(0, 3000)) if listened else None
+                ),
+                album_name=f"Album {i}",
+                album_artwork_url="",
+                cover_artists=f"Artist {i % 5000}",
+                discogs_url=f"https://www.discogs.com/master/{i}",
+                year=r.randint(1950, 2023),
+                reasons=r.sample(REASONS, r.randint(1, 3)),
+                genres=r.sample(GENRES, r.randint(1, 2)),
+                styles=r.sample(STYLES, r.randint(0, 4)),
+                main_artists=[i % 5000],
+            )
+        )
+    return albums
+
+
+def main(rows: int) -> None:
+    albums = synthetic_albums(rows)
+    started = perf_counter()
+    table = AlbumTable.from_albums(albums)
+    built = perf_counter()
+    compute_stats(table)
+    done = perf_counter()
+    print(f"{rows} albums")
+    print(f"build AlbumTable: {(built - started) * 1000:>8.1f}ms")
+    print(f"compute_stats:    {(done - built) * 1000:>8.1f}ms")
+    print(f"total:            {(done - started) * 1000:>8.1f}ms")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
@@ -1,7 +1,8 @@
 from __future__ import annotations
 import os
+from pathlib import Path
 from datetime import date, datetime
-from typing import TYPE_CHECKING, Optional, Union, Literal
+from typing import TYPE_CHECKING, Optional, Iterator, TextIO
 
 import click
 
@@ -10,11 +11,44 @@ from .common import eprint
 
 
 @click.group(invoke_without_command=True)
+@click.option(
+    "--offline",
+    is_flag=True,
+    default=False,
+    help="Read the sheet from the local snapshot or spreadsheet.csv instead of Google Sheets",
+)
+@click.option(
+    "--source",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    default=None,
+    help="Read the sheet from a CSV file or JSON snapshot (implies --offline)",
+)
+@click.option(
+    "--max-refresh",
+    type=click.IntRange(min=0),
+    default=None,
+    help="Max number of stale discogs entries to refresh in the background",
+)
 @click.pass_context
-def main(ctx: click.Context) -> None:
+def main(
+    ctx: click.Context,
+    offline: bool,
+    source: Optional[Path],
+    max_refresh: Optional[int],
+) -> None:
     """
     Interact with my albums spreadsheet!
     """
+    if offline or source is not None:
+        from .core_gsheets import use_offline_source
+
+        use_offline_source(source)
+
+    # if this isnt passed, discogs_cache.MAX_REFRESH is used
+    if max_refresh is not None:
+        from . import discogs_cache
+
+        discogs_cache.MAX_REFRESH = max_refresh
     # run print-next if I didn't specify anything else
     if ctx.invoked_subcommand is None:
         ctx.invoke(print_next)
@@ -22,12 +56,41 @@ def main(ctx: click.Context) -> None:
 
 @main.command(short_help="print next albums")
 @click.argument("COUNT", default=10, type=int)
-@click.option("-r", "--random", is_flag=True, default=False, help="Print random albums")
-def print_next(count: int, random: bool) -> None:
-    """Print the next albums I should listen to"""
-    from .generate_table import generate_table
+@click.option(
+    "-r",
+    "--random",
+    is_flag=True,
+    default=False,
+    help="Print random albums, weighted by their rank",
+)
+@click.option(
+    "--sheet-order",
+    is_flag=True,
+    default=False,
+    help="Print albums in the order they're on the sheet, instead of ranking them",
+)
+def print_next(count: int, random: bool, sheet_order: bool) -> None:
+    """
+    Print the next albums I should listen to
 
-    click.echo(generate_table(count, random))
+    Albums are ranked by the lists they're on and how well they match
+    genres/styles I've rated highly. The ranked queue is saved, and only
+    rebuilt when the spreadsheet changes
+    """
+    from .generate_table import generate_table, format_table
+
+    if sheet_order:
+        click.echo(generate_table(count, random))
+        return
+
+    from .core_gsheets import HEADER
+    from .next_queue import current_queue
+
+    queue = current_queue()
+    entries = queue.sample(count) if random else queue.top(count)
+    click.echo(
+        format_table(HEADER[1:4], [[e.album, e.artist, str(e.year)] for e in entries])
+    )
 
 
 @main.command(short_help="export sheet as JSON")
@@ -38,19 +101,251 @@ def print_next(count: int, random: bool) -> None:
     default=False,
     help="If there are any errors while exporting, exit",
 )
-def export(raise_errors: bool) -> None:
-    """Parse and print all of the information from the spreadsheet as JSON"""
-    from .export import export_data, dump_results
+@click.option(
+    "-f",
+    "--format",
+    "_format",
+    type=click.Choice(["json", "json-stream", "ndjson", "binary"]),
+    default="json",
+    show_default=True,
+    help="json-stream/ndjson print each album as its parsed, instead of all at once",
+)
+def export(raise_errors: bool, _format: str) -> None:
+    """
+    Parse and print all of the information from the spreadsheet as JSON
 
-    items = []
-    for res in export_data():
-        if isinstance(res, Exception):
-            if raise_errors:
-                raise res
-            eprint(str(res))
-        else:
-            items.append(res)
-    click.echo(dump_results(items))
+    json-stream prints the same JSON array as json, and ndjson
+    prints one album per line. binary prints a compact binary
+    format, which read_dump can read lazily
+    """
+    from .export import export_data, dump_results, stream_results, Album
+
+    def _albums() -> Iterator[Album]:
+        for res in export_data():
+            if isinstance(res, Exception):
+                if raise_errors:
+                    raise res
+                eprint(str(res))
+            else:
+                yield res
+
+    if _format == "json":
+        click.echo(dump_results(list(_albums())))
+    elif _format == "binary":
+        import sys
+        from .binary_export import dump_binary
+
+        if sys.stdout.isatty():
+            raise click.UsageError("Redirect the binary format to a file")
+        dump_binary(_albums(), sys.stdout.buffer)
+    else:
+        for chunk in stream_results(_albums(), ndjson=_format == "ndjson"):
+            click.echo(chunk, nl=False)
+
+
+@main.command(short_help="print listening stats")
+@click.option(
+    "--dump",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    help="Read albums from a file created by 'export' instead of the sheet",
+)
+@click.option(
+    "--min-albums",
+    type=click.IntRange(min=1),
+    default=3,
+    show_default=True,
+    help="Hide groups with less than this many listened albums",
+)
+@click.option("--json", "_json", is_flag=True, default=False, help="Print as JSON")
+def stats(dump: Optional[Path], min_albums: int, _json: bool) -> None:
+    """
+    Print score statistics by genre/style/reason/decade/year, how much of
+    each reason I've listened to and how many albums I listen to each month
+    """
+    from .album_table import AlbumTable
+    from .export import Album, export_data, read_dump
+    from .stats import compute_stats, format_stats
+
+    if dump is not None:
+        table = AlbumTable.from_dump(dump)
+    else:
+        table = AlbumTable.from_albums(a for a in export_data() if isinstance(a, Album))
+    computed = compute_stats(table, min_albums=min_albums)
+    if _json:
+        import json
+
+        click.echo(json.dumps(computed))
+    else:
+        click.echo(format_stats(computed))
+
+
+if TYPE_CHECKING:
+    from .export import Album
+    from click.shell_completion import CompletionItem
+    from .search_index import SearchIndex, SearchEntry
+    from .discogs_update import Listened
+
+
+def _entry_album(entry: SearchEntry) -> Album:
+    try:
+        return entry.to_album()
+    except Exception as e:
+        raise click.BadParameter(f"Could not parse {entry.label}: {e}")
+
+
+def _find_album(query: Optional[str], refresh: bool = False) -> Album:
+    """
+    Finds the album that matches the query using the search index,
+    or picks one with fzf if there is no query
+    """
+    from .search_index import current_search_index
+
+    index = current_search_index(refresh=refresh)
+    if query is None:
+        return _pick_album(index)
+    matches = index.match(query)
+    if not matches:
+        raise click.BadParameter(f"No albums matched '{query}'")
+    if len(matches) > 1:
+        labels = "\n".join(r.entry.label for r in matches[:10])
+        if len(matches) > 10:
+            labels += f"\n...and {len(matches) - 10} more"
+        raise click.BadParameter(f"'{query}' matched multiple albums:\n{labels}")
+    entry = matches[0].entry
+    eprint(f"Matched {entry.label}")
+    return _entry_album(entry)
+
+
+def _handle_album_cli(
+    ctx: click.Context, param: click.Argument, value: Optional[str]
+) -> Optional[Album]:
+    # mark-listened --from finds the albums from the file instead
+    if ctx.params.get("from_file") is not None:
+        return None
+    return _find_album(value, refresh=ctx.params.get("refresh", False))
+
+
+def _complete_album(
+    ctx: click.Context, param: click.Parameter, incomplete: str
+) -> list[CompletionItem]:
+    from click.shell_completion import CompletionItem
+    from .search_index import load_search_index
+
+    # only uses the saved index, so completion doesn't make any requests
+    index = load_search_index()
+    if index is None:
+        return []
+    return [CompletionItem(r.entry.label) for r in index.search(incomplete, limit=20)]
+
+
+def _pick_album(index: SearchIndex) -> Album:
+    from pyfzf import FzfPrompt
+
+    if not index.entries:
+        raise click.BadParameter("No albums found in spreadsheet")
+
+    tagged_albums = [
+        f"{i}|{e.album}|{e.artist}|{e.year}" for i, e in enumerate(index.entries)
+    ]
+
+    picked = FzfPrompt().prompt(
+        tagged_albums, "--header='Pick an album' --layout=reverse --no-multi"
+    )
+    if not picked:
+        raise click.BadParameter("No album picked")
+    # get index from string and index into the entries
+    i = int(picked[0].split("|")[0])
+    assert i < len(index.entries)
+
+    entry = index.entries[i]
+    eprint(f"Picked {entry.label}")
+    return _entry_album(entry)
+
+
+@main.command(short_help="search for albums")
+@click.argument("QUERY", nargs=-1, required=True)
+@click.option(
+    "-n",
+    "--limit",
+    type=click.IntRange(min=1),
+    default=10,
+    show_default=True,
+    help="Number of albums to print",
+)
+@click.option(
+    "--refresh",
+    is_flag=True,
+    default=False,
+    help="Check if the sheet changed before searching, instead of using the last snapshot",
+)
+def search(query: tuple[str, ...], limit: int, refresh: bool) -> None:
+    """
+    Search for albums by name, artist and year
+
+    Uses an index built from the last snapshot of the sheet,
+    so this doesn't make any requests unless --refresh is passed
+    """
+    from .generate_table import format_table
+    from .search_index import current_search_index
+
+    index = current_search_index(refresh=refresh)
+    results = index.search(" ".join(query), limit=limit)
+    click.echo(
+        format_table(
+            ["Album", "Artist", "Year"],
+            [[r.entry.album, r.entry.artist, r.entry.year] for r in results],
+        )
+    )
+
+
+@main.command(short_help="find similar albums")
+@click.option(
+    "--top-scored",
+    "top_scored",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Find albums similar to this many of my highest scored albums, instead of picking an album",
+)
+@click.option(
+    "--album",
+    "query",
+    type=str,
+    default=None,
+    shell_complete=_complete_album,
+    help="Album to find similar albums to, picks one with fzf if not given",
+)
+@click.option(
+    "-k",
+    "--count",
+    type=click.IntRange(min=1),
+    default=10,
+    show_default=True,
+    help="Number of albums to print",
+)
+def similar(top_scored: Optional[int], query: Optional[str], count: int) -> None:
+    """
+    Print albums I haven't listened to which are similar to an album, based
+    on their genres, styles, artists and the lists they're on
+    """
+    from .generate_table import format_table
+    from .similar import current_index
+
+    index = current_index()
+    if top_scored is not None:
+        found = index.similar_to_top_scored(top_scored, k=count)
+    else:
+        album = _find_album(query)
+        try:
+            found = index.similar_to(album, k=count)
+        except ValueError as e:
+            # e.g. the album was added after the index was saved
+            raise click.ClickException(str(e))
+    click.echo(
+        format_table(
+            ["Album", "Artist", "Year", "Similarity"],
+            [[s.album, s.artist, str(s.year), f"{s.similarity:.3f}"] for s in found],
+        )
+    )
 
 
 @main.command(short_help="use discogs to update sheet")
@@ -62,18 +357,162 @@ def export(raise_errors: bool) -> None:
     default=False,
     help="Attempt to resolve release IDs to Master on Discogs",
 )
-def discogs_update(_resolve: bool) -> None:
+@click.option(
+    "--full",
+    is_flag=True,
+    default=False,
+    help="Update every row, instead of skipping rows which haven't changed since the last run",
+)
+@click.option(
+    "-w",
+    "--workers",
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    help="Number of discogs requests to make at the same time",
+)
+@click.option(
+    "--image-workers",
+    type=click.IntRange(min=1),
+    default=2,
+    show_default=True,
+    help="Number of images to upload to s3 at the same time",
+)
+def discogs_update(
+    _resolve: bool, full: bool, workers: int, image_workers: int
+) -> None:
     """
     Update rows on the spreadsheet which just have a discogs link
 
-    Gets information from the Discogs API
+    Gets information from the Discogs API. Rows are fetched/updated
+    concurrently, and any changes (or prompts for images which couldn't
+    be downloaded) are shown once they're done, in the order of the sheet
     """
     from .discogs_update import update_new_entries
 
-    updated: int = update_new_entries(_resolve)
+    updated: int = update_new_entries(
+        _resolve, full=full, workers=workers, image_workers=image_workers
+    )
     eprint(f"Updated {updated} cells")
 
 
+@main.command(short_help="prefetch discogs data")
+@click.option(
+    "-w",
+    "--workers",
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    help="Number of requests to make at the same time",
+)
+@click.option(
+    "--restart",
+    is_flag=True,
+    default=False,
+    help="Ignore any checkpoint from an interrupted run, and re-read the sheet",
+)
+def warm_cache(workers: int, restart: bool) -> None:
+    """
+    Fetch discogs data for every album on the sheet which isn't cached yet
+
+    If this is interrupted, running it again resumes where it stopped
+    """
+    from .warm_cache import warm_cache
+
+    fetched = warm_cache(workers=workers, restart=restart)
+    eprint(f"Fetched {fetched} URLs")
+
+
+@main.command(short_help="import old discogs cache")
+@click.argument(
+    "CACHE_DIR",
+    type=click.Path(exists=True, file_okay=False, path_type=Path),
+    required=False,
+)
+def migrate_cache(cache_dir: Optional[Path]) -> None:
+    """
+    Import the discogs data from the directory that url_cache used to save to
+    (defaults to $DISCOGS_CACHE_DIR or ~/.local/share/discogs_urlcache)
+    into the SQLite database
+    """
+    from .discogs_cache import discogs_store
+    from .discogs_store import migrate_urlcache, default_urlcache_dir
+
+    store = discogs_store()
+    count = migrate_urlcache(store, cache_dir or default_urlcache_dir())
+    eprint(f"Imported {count} entries into {store.path}")
+
+
+@main.command(short_help="import discogs data dumps")
+@click.option(
+    "--masters",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    help="masters dump, e.g. discogs_20230101_masters.xml.gz",
+)
+@click.option(
+    "--releases",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    help="releases dump, e.g. discogs_20230101_releases.xml.gz",
+)
+@click.option(
+    "--overwrite",
+    is_flag=True,
+    default=False,
+    help="Import entries even if they're already cached",
+)
+def import_dump(
+    masters: Optional[Path], releases: Optional[Path], overwrite: bool
+) -> None:
+    """
+    Populate the discogs cache from the monthly discogs data dumps,
+    instead of requesting everything from the API
+
+    Only imports the masters/releases which are on the sheet (and the
+    main releases for those masters). The dumps can be downloaded from
+    https://discogs-data-dumps.s3.us-west-2.amazonaws.com/index.html
+    """
+    from .core_gsheets import get_values
+    from .discogs_cache import discogs_store
+    from .discogs_dump import import_dump, sheet_keys
+
+    if masters is None and releases is None:
+        raise click.UsageError("Pass at least one of --masters or --releases")
+    values = get_values(sheetRange="Music!A:K", valueRenderOption="FORMULA")
+    imported, missing = import_dump(
+        discogs_store(),
+        sheet_keys(values[1:]),
+        masters=masters,
+        releases=releases,
+        overwrite=overwrite,
+    )
+    eprint(f"Imported {imported} entries")
+    if missing:
+        eprint(
+            f"{len(missing)} entries weren't found, run 'nextalbums warm-cache' to request them from the API"
+        )
+
+
+@main.command(short_help="shrink discogs cache")
+def compact_cache() -> None:
+    """
+    Rewrite the discogs cache so that entries only keep the fields which
+    are used, compressed with zlib. Anything saved to the cache afterwards
+    is stored the same way
+
+    The other fields are removed from the cache, so
+    getting them back means requesting everything again
+    """
+    from .discogs_cache import discogs_store
+
+    store = discogs_store()
+    before = store.path.stat().st_size
+    count = store.compact()
+    after = store.path.stat().st_size
+    eprint(
+        f"Compacted {count} entries, {store.path} went from {before // 1024}KB to {after // 1024}KB"
+    )
+
+
 @main.command(short_help="update csv datafiles")
 def update_csv_datafiles() -> None:
     """Updates the CSV files in data directory"""
@@ -85,10 +524,14 @@ def update_csv_datafiles() -> None:
 @main.command(short_help="update spreadsheet.csv")
 def generate_csv() -> None:
     """Generate the spreadsheet.csv file in the root dir"""
+    from io import StringIO
     from .update_datafiles import write_to_spreadsheets_csv_file
 
+    # write to a buffer first, so the file isn't emptied if reading the sheet fails
+    buf = StringIO()
+    write_to_spreadsheets_csv_file(buf)
     with open(SETTINGS.BASE_SPREADSHEETS_CSV_FILE, "w") as f:
-        write_to_spreadsheets_csv_file(f)
+        f.write(buf.getvalue())
     sfile = SETTINGS.BASE_SPREADSHEETS_CSV_FILE
     home = os.path.expanduser("~")
     if sfile.startswith(home):
@@ -96,51 +539,64 @@ def generate_csv() -> None:
     eprint(f"Wrote to {sfile} successfully.")
 
 
-if TYPE_CHECKING:
-    from .export import Album
-
-
-def _export_data() -> list[Album]:
-    from nextalbums.export import export_data
-
-    albums = [a for a in export_data() if not isinstance(a, Exception)]
-
-    if not albums:
-        raise click.BadParameter("No albums found in spreadsheet")
-
-    return albums
-
-
-def _handle_album_cli(
-    ctx: click.Context, param: click.Argument, value: Optional[str]
-) -> Album:
-    from pyfzf import FzfPrompt
-
-    albums = _export_data()
-
-    tagged_albums = [
-        f"{i}|{a.album_name}|{a.cover_artists}|{a.year}" for i, a in enumerate(albums)
-    ]
-
-    picked = FzfPrompt().prompt(
-        tagged_albums, "--header='Pick an album' --layout=reverse --no-multi"
-    )
-    if not picked:
-        raise click.BadParameter("No album picked")
-    # get index from string and index into albums
-    index = int(picked[0].split("|")[0])
-    assert index < len(albums)
+today = str(date.today())
 
-    picked_album = albums[index]
-    click.echo(
-        f"Picked {picked_album.album_name} - {picked_album.cover_artists} ({picked_album.year})",
-        err=True,
-    )
 
-    return picked_album
+def _parse_listened_on(value: str) -> Optional[datetime]:
+    """Parses a --date, 'no-edit' means the date isn't changed"""
+    if value == "no-edit":
+        return None
+    try:
+        return datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        raise click.BadParameter("Date must be in YYYY-MM-DD format")
 
 
-today = str(date.today())
+def _read_listened(f: TextIO, default_date: str, refresh: bool) -> list[Listened]:
+    """
+    Reads QUERY,SCORE[,DATE] rows and finds each album with the search index.
+    QUERY can be a discogs URL, and DATE defaults to the --date option
+    """
+    import csv
+    from .discogs_update import Listened
+    from .search_index import current_search_index
+
+    index = current_search_index(refresh=refresh)
+    listened: list[Listened] = []
+    rows: dict[int, int] = {}
+    errors: list[str] = []
+    for line, row in enumerate(csv.reader(f), start=1):
+        if not row or not row[0].strip() or row[0].lstrip().startswith("#"):
+            continue
+        if len(row) not in (2, 3):
+            errors.append(f"line {line}: expected QUERY,SCORE[,DATE], got {row}")
+            continue
+        query = row[0].strip()
+        try:
+            score = float(row[1])
+            listened_on = _parse_listened_on(
+                row[2].strip() if len(row) == 3 and row[2].strip() else default_date
+            )
+        except (ValueError, click.BadParameter) as e:
+            errors.append(f"line {line}: {e}")
+            continue
+        if not 0 <= score <= 10:
+            errors.append(f"line {line}: score must be between 0 and 10")
+            continue
+        matches = index.match(query)
+        if len(matches) != 1:
+            found = "no albums" if not matches else f"{len(matches)} albums"
+            errors.append(f"line {line}: '{query}' matched {found}")
+            continue
+        entry = matches[0].entry
+        if entry.row in rows:
+            errors.append(f"line {line}: {entry.label} is on line {rows[entry.row]}")
+            continue
+        rows[entry.row] = line
+        listened.append(Listened(_entry_album(entry), score, listened_on, entry.row))
+    if errors:
+        raise click.ClickException("\n".join(errors))
+    return listened
 
 
 @main.command(short_help="mark album listened")
@@ -152,58 +608,180 @@ today = str(date.today())
     show_default=True,
     help="Date to give album, pass 'no-edit' to not edit date",
 )
+@click.option(
+    "--from",
+    "from_file",
+    type=click.File("r"),
+    default=None,
+    is_eager=True,
+    help="Mark every album in a CSV file of QUERY,SCORE[,DATE] rows ('-' for stdin)",
+)
+@click.option(
+    "--refresh/--no-refresh",
+    default=True,
+    show_default=True,
+    is_eager=True,
+    help="Check if the sheet changed before finding albums, instead of using the last snapshot",
+)
 @click.option(
     "--album",
     callback=_handle_album_cli,
     required=False,
     type=click.UNPROCESSED,
-    help="Album to mark",
+    shell_complete=_complete_album,
+    help="Album to mark, e.g. 'abbey road beatles'. Picks one with fzf if not given",
 )
 @click.option(
     "-s",
     "--score",
     type=float,
-    required=True,
-    prompt=True,
-    help="Score to give album",
+    required=False,
+    help="Score to give album, prompts if not given",
 )
-def mark_listened(album: Album, score: float, date: str) -> None:
-    assert 0 <= score <= 10, "Score must be between 0 and 10"
-    # parse date to a datetime
-    from .discogs_update import mark_listened
-
-    dt: Union[date, Literal["no-edit"]]
-    try:
-        dt = datetime.strptime(date, "%Y-%m-%d")
-    except ValueError:
-        if date == "no-edit":
-            dt = date
-        else:
-            raise click.BadParameter("Date must be in YYYY-MM-DD format")
-
-    from .core_gsheets import get_values
-
-    worksheet_vals = get_values(sheetRange="Music!A:K", valueRenderOption="FORMULA")
-    mark_listened(
-        album, worksheet_vals, score=score, listened_on=dt if dt != "no-edit" else None
-    )
+@click.option(
+    "-y",
+    "--yes",
+    is_flag=True,
+    default=False,
+    help="Don't ask for confirmation when using --from",
+)
+def mark_listened(
+    album: Optional[Album],
+    score: Optional[float],
+    date: str,
+    from_file: Optional[TextIO],
+    yes: bool,
+    refresh: bool,
+) -> None:
+    """
+    Mark an album as listened to, with a score and the date
 
+    With --from, marks all the albums in a file, and writes them
+    to the sheet at once, e.g. for a file like:
 
-@main.command(short_help="add new album")
-@click.argument("DISCOGS_URL")
-def add_album(discogs_url: str) -> None:
+    \b
+    kid a radiohead,8.5
+    https://www.discogs.com/master/24047,9,2024-01-05
     """
-    This *just* adds the URL to the spreadsheet, you'll need to run
-    nextalbums discogs-update to actually update the sheet with the data
+    from .core_gsheets import spreadsheet_version
+    from .discogs_update import Listened, mark_listened
+    from .next_queue import update_listened
+
+    listened: list[Listened]
+    if from_file is not None:
+        listened = _read_listened(from_file, date, refresh)
+        if not listened:
+            raise click.ClickException("No albums to mark")
+        from .generate_table import format_table
+
+        click.echo(
+            format_table(
+                ["Album", "Artist", "Year", "Score", "Listened On"],
+                [
+                    [
+                        a.album.album_name,
+                        a.album.cover_artists,
+                        str(a.album.year),
+                        str(a.score),
+                        (
+                            "(unchanged)"
+                            if a.listened_on is None
+                            else a.listened_on.strftime("%Y-%m-%d")
+                        ),
+                    ]
+                    for a in listened
+                ],
+            ),
+            err=True,
+        )
+        if not yes:
+            if from_file.name == "<stdin>":
+                raise click.UsageError("Pass --yes to confirm when reading from stdin")
+            click.confirm(f"Mark {len(listened)} albums as listened?", abort=True)
+    else:
+        assert album is not None
+        if score is None:
+            score = click.prompt("Score", type=float)
+        assert 0 <= score <= 10, "Score must be between 0 and 10"
+        listened_on = _parse_listened_on(date)
+        if listened_on is not None:
+            print(f"Setting listened on to {listened_on}")
+
+        from .search_index import current_search_index
+
+        row = current_search_index().row_for(album)
+        listened = [Listened(album, score, listened_on, row)]
+
+    previous_version = spreadsheet_version()
+    mark_listened(listened)
+    update_listened(((a.album, a.score) for a in listened), previous_version)
+
+
+@main.command(short_help="add new albums")
+@click.argument("DISCOGS_URLS", nargs=-1)
+@click.option(
+    "--from",
+    "from_file",
+    type=click.File("r"),
+    default=None,
+    help="Read URLs from a file, one per line ('-' for stdin)",
+)
+@click.option(
+    "--reason",
+    default="Manual",
+    show_default=True,
+    help="Reason to give the albums",
+)
+@click.option(
+    "-w",
+    "--workers",
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    help="Number of releases to resolve at the same time",
+)
+def add_album(
+    discogs_urls: tuple[str, ...],
+    from_file: Optional[TextIO],
+    reason: str,
+    workers: int,
+) -> None:
     """
+    This *just* adds the URLs to the spreadsheet, you'll need to run
+    nextalbums discogs-update to actually update the sheet with the data
 
-    from .discogs_update import add_album, _fix_discogs_link
-
-    fixed_url = _fix_discogs_link(discogs_url, resolve=True)
-    if fixed_url != discogs_url:
-        eprint(f"Resolved {discogs_url} to {fixed_url}")
+    Releases are resolved to their master, if they have one. URLs
+    which are already on the sheet (as of the last snapshot) are skipped
+    """
 
-    add_album(fixed_url)
+    from .discogs_update import add_albums, resolve_links
+    from .search_index import load_search_index
+
+    urls = list(discogs_urls)
+    if from_file is not None:
+        urls.extend(
+            line.strip()
+            for line in from_file
+            if line.strip() and not line.lstrip().startswith("#")
+        )
+    if not urls:
+        raise click.UsageError("Pass discogs URLs, or a file with --from")
+
+    fixed_urls = resolve_links(urls, workers=workers)
+    for discogs_url, fixed_url in zip(urls, fixed_urls):
+        if fixed_url != discogs_url:
+            eprint(f"Resolved {discogs_url} to {fixed_url}")
+
+    # doesn't read the sheet, so this only knows about albums in the saved index
+    index = load_search_index()
+    new_urls: list[str] = []
+    for url in dict.fromkeys(fixed_urls):
+        if index is not None and index.has_url(url):
+            eprint(f"{url} is already on the spreadsheet, skipping")
+        else:
+            new_urls.append(url)
+    if new_urls:
+        add_albums(new_urls, reason=reason)
 
 
 @main.command(short_help="override image upload")
@@ -0,0 +1,318 @@
+"""
+A columnar version of the export, for computing aggregates over all the
+albums with numpy instead of looping over each Album in python
+
+Multi-valued columns (genres, styles, reasons, main_artists) are dictionary
+encoded: each distinct value gets an integer ID, and the IDs for every
+album are stored in one flat array, with an offsets array (like a CSR
+sparse matrix) marking where each album's IDs start/end
+"""
+
+from __future__ import annotations
+
+import itertools
+from datetime import date
+from pathlib import Path
+from typing import (
+    NamedTuple,
+    Dict,
+    List,
+    Iterable,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+    Any,
+)
+
+import numpy as np
+
+from .export import Album, DROPPED, read_dump
+
+CATEGORICAL_COLUMNS = ("genres", "styles", "reasons", "main_artists")
+
+
+class Categorical(NamedTuple):
+    """
+    values: the distinct values, a value's index in this is its ID
+    offsets: the IDs for album i are ids[offsets[i]:offsets[i + 1]]
+    ids: the IDs for every album, concatenated
+    """
+
+    values: List[Any]
+    offsets: np.ndarray
+    ids: np.ndarray
+
+    @staticmethod
+    def encode(rows: Sequence[Sequence[Any]]) -> Categorical:
+        flat = list(itertools.chain.from_iterable(rows))
+        # dicts are ordered, so IDs are assigned in the order values are seen
+        values = list(dict.fromkeys(flat))
+        lookup = {v: i for i, v in enumerate(values)}
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(
+            np.fromiter(map(len, rows), dtype=np.int64, count=len(rows)),
+            out=offsets[1:],
+        )
+        ids = np.fromiter(
+            map(lookup.__getitem__, flat), dtype=np.int32, count=len(flat)
+        )
+        return Categorical(values, offsets, ids)
+
+    def row(self, i: int) -> List[Any]:
+        return [self.values[j] for j in self.ids[self.offsets[i] : self.offsets[i + 1]]]
+
+    def rows(self) -> np.ndarray:
+        """The album index for each item in ids"""
+        return np.repeat(
+            np.arange(len(self.offsets) - 1), np.diff(self.offsets)
+        ).astype(np.int64)
+
+    def contains(self, value: Any) -> np.ndarray:
+        """A boolean mask of albums which have this value"""
+        mask = np.zeros(len(self.offsets) - 1, dtype=bool)
+        try:
+            code = self.values.index(value)
+        except ValueError:
+            return mask
+        mask[self.rows()[self.ids == code]] = True
+        return mask
+
+    def take(self, indices: np.ndarray) -> Categorical:
+        """Selects these albums, keeping the same values/IDs"""
+        starts = self.offsets[indices]
+        lengths = self.offsets[indices + 1] - starts
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        # the position in ids for each item that's kept
+        positions = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return Categorical(self.values, offsets, self.ids[positions])
+
+
+def _object_array(items: Sequence[Any]) -> np.ndarray:
+    arr = np.empty(len(items), dtype=object)
+    arr[:] = items
+    return arr
+
+
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+def _dates(dates: Sequence[Optional[date]]) -> np.ndarray:
+    """Converts to datetime64[D] using the ordinals, with NaT for None"""
+    days = np.fromiter(
+        (d.toordinal() - EPOCH_ORDINAL if d is not None else 0 for d in dates),
+        dtype=np.int64,
+        count=len(dates),
+    ).astype("datetime64[D]")
+    days[np.array([d is None for d in dates], dtype=bool)] = np.datetime64("NaT")
+    return days
+
+
+def _unique_groups(
+    values: np.ndarray, rows: np.ndarray
+) -> Tuple[List[Any], np.ndarray, np.ndarray]:
+    keys, inverse = np.unique(values, return_inverse=True)
+    return keys.tolist(), inverse.astype(np.int64), rows
+
+
+class GroupSummary(NamedTuple):
+    albums: int
+    mean: float
+    median: float
+
+
+class AlbumTable:
+    """
+    Holds the albums as columns. score is NaN and listened_on
+    is NaT for albums which haven't been listened to
+    """
+
+    def __init__(
+        self,
+        *,
+        score: np.ndarray,
+        year: np.ndarray,
+        listened_on: np.ndarray,
+        note: np.ndarray,
+        album_name: np.ndarray,
+        album_artwork_url: np.ndarray,
+        cover_artists: np.ndarray,
+        discogs_url: np.ndarray,
+        genres: Categorical,
+        styles: Categorical,
+        reasons: Categorical,
+        main_artists: Categorical,
+    ) -> None:
+        self.score = score
+        self.year = year
+        self.listened_on = listened_on
+        self.note = note
+        self.album_name = album_name
+        self.album_artwork_url = album_artwork_url
+        self.cover_artists = cover_artists
+        self.discogs_url = discogs_url
+        self.genres = genres
+        self.styles = styles
+        self.reasons = reasons
+        self.main_artists = main_artists
+
+    @staticmethod
+    def from_albums(albums: Iterable[Album]) -> AlbumTable:
+        items = list(albums)
+        return AlbumTable(
+            score=np.array(
+                [a.score if a.score is not None else np.nan for a in items],
+                dtype=np.float64,
+            ),
+            year=np.array([a.year for a in items], dtype=np.int32),
+            listened_on=_dates([a.listened_on for a in items]),
+            note=_object_array([a.note for a in items]),
+            album_name=_object_array([a.album_name for a in items]),
+            album_artwork_url=_object_array([a.album_artwork_url for a in items]),
+            cover_artists=_object_array([a.cover_artists for a in items]),
+            discogs_url=_object_array([a.discogs_url for a in items]),
+            genres=Categorical.encode([a.genres for a in items]),
+            styles=Categorical.encode([a.styles for a in items]),
+            reasons=Categorical.encode([a.reasons for a in items]),
+            main_artists=Categorical.encode([a.main_artists for a in items]),
+        )
+
+    @staticmethod
+    def from_dump(path: Path) -> AlbumTable:
+        return AlbumTable.from_albums(read_dump(path))
+
+    def __len__(self) -> int:
+        return len(self.score)
+
+    def album(self, i: int) -> Album:
+        listened_on = self.listened_on[i]
+        return Album(
+            score=None if np.isnan(self.score[i]) else float(self.score[i]),
+            note=self.note[i],
+            listened_on=None if np.isnat(listened_on) else listened_on.item(),
+            album_name=self.album_name[i],
+            album_artwork_url=self.album_artwork_url[i],
+            cover_artists=self.cover_artists[i],
+            discogs_url=self.discogs_url[i],
+            year=int(self.year[i]),
+            reasons=self.reasons.row(i),
+            genres=self.genres.row(i),
+            styles=self.styles.row(i),
+            main_artists=[int(a) for a in self.main_artists.row(i)],
+        )
+
+    def to_albums(self) -> List[Album]:
+        return [self.album(i) for i in range(len(self))]
+
+    @property
+    def dropped(self) -> np.ndarray:
+        return np.isin(self.note, list(DROPPED))
+
+    @property
+    def listened(self) -> np.ndarray:
+        """A boolean mask, the same as Album.listened"""
+        mask: np.ndarray = (
+            ~self.dropped & ~np.isnan(self.score) & ~np.isnat(self.listened_on)
+        )
+        return mask
+
+    def filter(self, mask: Union[np.ndarray, Sequence[int]]) -> AlbumTable:
+        """Returns a table with the albums selected by a boolean mask or indices"""
+        arr = np.asarray(mask)
+        indices = np.flatnonzero(arr) if arr.dtype == bool else arr.astype(np.int64)
+        return AlbumTable(
+            score=self.score[indices],
+            year=self.year[indices],
+            listened_on=self.listened_on[indices],
+            note=self.note[indices],
+            album_name=self.album_name[indices],
+            album_artwork_url=self.album_artwork_url[indices],
+            cover_artists=self.cover_artists[indices],
+            discogs_url=self.discogs_url[indices],
+            genres=self.genres.take(indices),
+            styles=self.styles.take(indices),
+            reasons=self.reasons.take(indices),
+            main_artists=self.main_artists.take(indices),
+        )
+
+    def _groups(self, key: str) -> Tuple[List[Any], np.ndarray, np.ndarray]:
+        """
+        Returns the group keys, the group index of each
+        item and the album index for each item
+
+        For categorical columns an album is in a group for
+        each value it has, so it can be in multiple groups
+        """
+        if key in CATEGORICAL_COLUMNS:
+            cat: Categorical = getattr(self, key)
+            return list(cat.values), cat.ids.astype(np.int64), cat.rows()
+        if key in ("year", "decade"):
+            years = self.year if key == "year" else self.year // 10 * 10
+            return _unique_groups(years, np.arange(len(self)))
+        if key in ("listened_year", "listened_month"):
+            mask = ~np.isnat(self.listened_on)
+            unit = "datetime64[Y]" if key == "listened_year" else "datetime64[M]"
+            keys, groups, rows = _unique_groups(
+                self.listened_on[mask].astype(unit), np.flatnonzero(mask)
+            )
+            return [str(k) for k in keys], groups, rows
+        raise ValueError(f"Can't group by {key}")
+
+    def count_by(self, key: str, mask: Optional[np.ndarray] = None) -> Dict[Any, int]:
+        """Number of albums in each group, optionally only counting albums in mask"""
+        keys, groups, rows = self._groups(key)
+        if mask is not None:
+            groups = groups[mask[rows]]
+        counts = np.bincount(groups, minlength=len(keys))
+        return {k: int(c) for k, c in zip(keys, counts) if c > 0}
+
+    def mean_by(
+        self, key: str, column: str = "score", mask: Optional[np.ndarray] = None
+    ) -> Dict[Any, Tuple[float, int]]:
+        """
+        Mean of a numeric column for each group, ignoring NaNs.
+        Returns (mean, count) for each group
+        """
+        keys, groups, rows = self._groups(key)
+        values = np.asarray(getattr(self, column), dtype=np.float64)[rows]
+        keep = ~np.isnan(values)
+        if mask is not None:
+            keep &= mask[rows]
+        groups, values = groups[keep], values[keep]
+        counts = np.bincount(groups, minlength=len(keys))
+        sums = np.bincount(groups, weights=values, minlength=len(keys))
+        return {
+            k: (float(s / c), int(c)) for k, s, c in zip(keys, sums, counts) if c > 0
+        }
+
+    def describe_by(
+        self, key: str, column: str = "score", mask: Optional[np.ndarray] = None
+    ) -> Dict[Any, GroupSummary]:
+        """
+        Number of albums, mean and median of a numeric column for each group, ignoring NaNs
+        """
+        keys, groups, rows = self._groups(key)
+        values = np.asarray(getattr(self, column), dtype=np.float64)[rows]
+        keep = ~np.isnan(values)
+        if mask is not None:
+            keep &= mask[rows]
+        groups, values = groups[keep], values[keep]
+        counts = np.bincount(groups, minlength=len(keys))
+        sums = np.bincount(groups, weights=values, minlength=len(keys))
+        # sort by group, then by value, so each group's values are
+        # contiguous and sorted, and the median is in the middle of that
+        order = np.lexsort((values, groups))
+        ordered = values[order]
+        starts = np.zeros(len(keys), dtype=np.int64)
+        np.cumsum(counts[:-1], out=starts[1:])
+        nonempty = counts > 0
+        lo = starts[nonempty] + (counts[nonempty] - 1) // 2
+        hi = starts[nonempty] + counts[nonempty] // 2
+        medians = np.full(len(keys), np.nan)
+        medians[nonempty] = (ordered[lo] + ordered[hi]) / 2
+        return {
+            k: GroupSummary(albums=int(c), mean=float(s / c), median=float(m))
+            for k, c, s, m in zip(keys, counts, sums, medians)
+            if c > 0
+        }
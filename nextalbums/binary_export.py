@@ -0,0 +1,234 @@
+"""
+A compact binary version of the export, which can be memory-mapped
+and read lazily, instead of parsing the entire JSON dump
+
+Layout (all integers are little-endian):
+
+    header        magic, version, number of albums, offset of the string table
+    offsets       (count + 1) u64 offsets of each album record
+    records       the encoded albums
+    string table  strings shared between albums (reasons/genres/styles)
+"""
+
+import math
+import mmap
+import struct
+from datetime import date
+from pathlib import Path
+from typing import (
+    Dict,
+    List,
+    Iterable,
+    Iterator,
+    Optional,
+    Sequence,
+    Union,
+    BinaryIO,
+    overload,
+)
+
+from .common import atomic_write
+from .export import Album
+
+MAGIC = b"NXAL"
+VERSION = 1
+
+HEADER = struct.Struct("<4sHIQ")
+OFFSET = struct.Struct("<Q")
+# the start of each record, followed by the string bytes, the string
+# table indices for reasons/genres/styles and then the main artist IDs
+#
+# score (nan if None), listened_on (date ordinal, 0 if None), year,
+# the byte lengths of note/album_name/album_artwork_url/cover_artists/discogs_url,
+# the number of reasons/genres/styles/main_artists
+FIXED = struct.Struct("<dIi5I4H")
+U32 = struct.Struct("<I")
+
+# length used for optional strings which are None
+NONE_LENGTH = 0xFFFFFFFF
+
+
+def is_binary_dump(path: Union[str, Path]) -> bool:
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class _Writer:
+    def __init__(self) -> None:
+        self.strings: Dict[str, int] = {}
+
+    def _index(self, s: str) -> int:
+        return self.strings.setdefault(s, len(self.strings))
+
+    def record(self, album: Album) -> bytes:
+        encoded = [
+            s.encode() if s is not None else None
+            for s in (
+                album.note,
+                album.album_name,
+                album.album_artwork_url,
+                album.cover_artists,
+                album.discogs_url,
+            )
+        ]
+        shared = [
+            self._index(s)
+            for items in (album.reasons, album.genres, album.styles)
+            for s in items
+        ]
+        return b"".join(
+            (
+                FIXED.pack(
+                    album.score if album.score is not None else math.nan,
+                    album.listened_on.toordinal() if album.listened_on else 0,
+                    album.year,
+                    *(len(b) if b is not None else NONE_LENGTH for b in encoded),
+                    len(album.reasons),
+                    len(album.genres),
+                    len(album.styles),
+                    len(album.main_artists),
+                ),
+                *(b for b in encoded if b is not None),
+                struct.pack(f"<{len(shared)}I", *shared),
+                struct.pack(f"<{len(album.main_artists)}q", *album.main_artists),
+            )
+        )
+
+    def string_table(self) -> bytes:
+        # dicts are ordered, so these are in index order
+        encoded = [s.encode() for s in self.strings]
+        return b"".join(
+            (
+                U32.pack(len(encoded)),
+                struct.pack(f"<{len(encoded)}I", *map(len, encoded)),
+                *encoded,
+            )
+        )
+
+
+def dump_binary(albums: Iterable[Album], f: BinaryIO) -> int:
+    """Writes the albums to a file opened in binary mode, returns the number written"""
+    writer = _Writer()
+    records = [writer.record(album) for album in albums]
+    start = HEADER.size + OFFSET.size * (len(records) + 1)
+    offsets = [start]
+    for rec in records:
+        offsets.append(offsets[-1] + len(rec))
+    f.write(HEADER.pack(MAGIC, VERSION, len(records), offsets[-1]))
+    f.write(b"".join(OFFSET.pack(o) for o in offsets))
+    f.writelines(records)
+    f.write(writer.string_table())
+    return len(records)
+
+
+class BinaryDump(Sequence[Album]):
+    """
+    Reads a binary dump using mmap. Albums are only decoded when
+    they're accessed, so loading a single album doesn't read the whole file
+    """
+
+    def __init__(self, path: Union[str, Path]) -> None:
+        self.path = Path(path)
+        with self.path.open("rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self._count, strings_offset = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{self.path} is not a binary dump")
+        if version != VERSION:
+            raise ValueError(f"Unsupported binary dump version {version}")
+        self._strings = self._read_strings(strings_offset)
+
+    def _read_strings(self, pos: int) -> List[str]:
+        (count,) = U32.unpack_from(self._mmap, pos)
+        pos += U32.size
+        lengths = struct.unpack_from(f"<{count}I", self._mmap, pos)
+        pos += U32.size * count
+        strings: List[str] = []
+        for length in lengths:
+            strings.append(self._mmap[pos : pos + length].decode())
+            pos += length
+        return strings
+
+    def _decode(self, index: int) -> Album:
+        mm = self._mmap
+        start, end = struct.unpack_from("<QQ", mm, HEADER.size + OFFSET.size * index)
+        (
+            score,
+            listened_on,
+            year,
+            *lengths,
+            reason_count,
+            genre_count,
+            style_count,
+            artist_count,
+        ) = FIXED.unpack_from(mm, start)
+        raw = mm[start + FIXED.size : end]
+        strs: List[Optional[str]] = []
+        pos = 0
+        for length in lengths:
+            if length == NONE_LENGTH:
+                strs.append(None)
+            else:
+                strs.append(raw[pos : pos + length].decode())
+                pos += length
+        note, album_name, album_artwork_url, cover_artists, discogs_url = strs
+        shared_count = reason_count + genre_count + style_count
+        shared = [
+            self._strings[i] for i in struct.unpack_from(f"<{shared_count}I", raw, pos)
+        ]
+        pos += U32.size * shared_count
+        assert album_name is not None
+        assert album_artwork_url is not None
+        assert cover_artists is not None
+        return Album(
+            score=None if math.isnan(score) else score,
+            note=note,
+            listened_on=date.fromordinal(listened_on) if listened_on else None,
+            album_name=album_name,
+            album_artwork_url=album_artwork_url,
+            cover_artists=cover_artists,
+            discogs_url=discogs_url,
+            year=year,
+            reasons=shared[:reason_count],
+            genres=shared[reason_count : reason_count + genre_count],
+            styles=shared[reason_count + genre_count :],
+            main_artists=list(struct.unpack_from(f"<{artist_count}q", raw, pos)),
+        )
+
+    def __len__(self) -> int:
+        return int(self._count)
+
+    @overload
+    def __getitem__(self, index: int) -> Album: ...
+
+    @overload
+    def __getitem__(self, index: slice) -> List[Album]: ...
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[Album, List[Album]]:
+        if isinstance(index, slice):
+            return [self._decode(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self._decode(index)
+
+    def __iter__(self) -> Iterator[Album]:
+        for i in range(len(self)):
+            yield self._decode(i)
+
+    def close(self) -> None:
+        self._mmap.close()
+
+    def __enter__(self) -> "BinaryDump":
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.close()
+
+
+def write_binary_dump(albums: Iterable[Album], path: Union[str, Path]) -> int:
+    """Writes to a temporary file and renames it, so readers never see a partial dump"""
+    with atomic_write(Path(path)) as tmp, tmp.open("wb") as f:
+        count = dump_binary(albums, f)
+    return count
@@ -1,8 +1,11 @@
+import os
 import re
 
+from pathlib import Path
 from urllib.parse import urlparse
 from functools import partial
-from typing import Any, List, Tuple
+from contextlib import contextmanager
+from typing import Any, Iterator, List, Optional, Tuple
 
 import click
 
@@ -13,6 +16,21 @@ WorksheetData = List[WorksheetRow]
 eprint = partial(click.echo, err=True)
 
 
+@contextmanager
+def atomic_write(path: Path, suffix: str = ".tmp") -> Iterator[Path]:
+    """
+    Yields a temporary path to write to, which replaces path once the block
+    finishes, so an interrupted write never leaves a partially written file
+    """
+    tmp = path.with_name(path.name + suffix)
+    try:
+        yield tmp
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    os.replace(tmp, path)
+
+
 # Items which are on my spreadsheet because I added it
 # not because they won a award/were on a list etc.
 PERSONAL = set(["manual", "relation", "recommendation"])
@@ -33,6 +51,26 @@ def filter_personal_reasons(
     return [row for row in values if not _is_personal(row[5])]
 
 
+def remove_image_formula(img_cell: str) -> str:
+    assert img_cell.startswith("=IMAGE(")
+    if img_cell.startswith("=IMAGE("):
+        return img_cell[7:-1].strip('"').strip("'")
+    return img_cell
+
+
+def clean_discogs_link(link: str) -> Optional[str]:
+    """
+    Removes unnecessary parts of a Discogs URL (e.g. the title, or 'www.'),
+    returns None if it isn't a link to a master or a release
+    """
+    path = urlparse(link.strip()).path
+    if master_id := re.search(r"\/master\/(?:view\/)?(\d+)", path):
+        return f"https://www.discogs.com/master/{master_id.group(1)}"
+    if release_id := re.search(r"\/release\/(?:view\/)?(\d+)", path):
+        return f"https://www.discogs.com/release/{release_id.group(1)}"
+    return None
+
+
 def parse_url_type(uurl: str) -> Tuple[str, int]:
     _type, _id = urlparse(uurl).path.strip("/").split("/")
     assert _type in {"master", "release"}, str(uurl)
@@ -0,0 +1,185 @@
+"""
+A smaller, immutable version of Album, for keeping lots of albums in memory
+
+The same few hundred genres/styles/reasons are repeated across thousands of
+albums, so the lists are stored as tuples, and albums which are created with
+the same Interner share those strings/tuples. Dates, scores and artist IDs
+are shared between albums as well
+"""
+
+from datetime import date
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, TypeVar
+
+from .export import Album
+
+T = TypeVar("T")
+
+
+class Interner:
+    """
+    Returns a shared copy of values that repeat across albums. This only
+    keeps values alive while it's being used, so create one for each batch
+    of albums (like compact_albums does), instead of keeping it around
+    """
+
+    __slots__ = ("_values",)
+
+    def __init__(self) -> None:
+        self._values: Dict[Any, Any] = {}
+
+    def __call__(self, value: T) -> T:
+        if value is None:
+            return value
+        # include the type, so that e.g. a score of 7.0 and a year of 7 aren't shared
+        return self._values.setdefault((type(value), value), value)  # type: ignore[no-any-return]
+
+    def all(self, items: Iterable[T]) -> Tuple[T, ...]:
+        return self(tuple(self(item) for item in items))
+
+
+class CompactAlbum:
+    """
+    Has the same fields/properties/methods as Album, but uses __slots__,
+    and stores reasons/genres/styles/main_artists as tuples
+
+    If an interner is given, values are shared with
+    the other albums that were created with it
+    """
+
+    __slots__ = (
+        "score",
+        "note",
+        "listened_on",
+        "album_name",
+        "album_artwork_url",
+        "cover_artists",
+        "discogs_url",
+        "year",
+        "reasons",
+        "genres",
+        "styles",
+        "main_artists",
+    )
+
+    _fields = Album._fields
+
+    score: Optional[float]
+    note: Optional[str]
+    listened_on: Optional[date]
+    album_name: str
+    album_artwork_url: str
+    cover_artists: str
+    discogs_url: Optional[str]
+    year: int
+    reasons: Tuple[str, ...]
+    genres: Tuple[str, ...]
+    styles: Tuple[str, ...]
+    main_artists: Tuple[int, ...]
+
+    def __init__(
+        self,
+        score: Optional[float],
+        note: Optional[str],
+        listened_on: Optional[date],
+        album_name: str,
+        album_artwork_url: str,
+        cover_artists: str,
+        discogs_url: Optional[str],
+        year: int,
+        reasons: Iterable[str],
+        genres: Iterable[str],
+        styles: Iterable[str],
+        main_artists: Iterable[int],
+        *,
+        interner: Optional[Interner] = None,
+    ) -> None:
+        shared = interner or Interner()
+        _set = object.__setattr__
+        _set(self, "score", shared(score))
+        _set(self, "note", shared(note))
+        _set(self, "listened_on", shared(listened_on))
+        _set(self, "album_name", album_name)
+        _set(self, "album_artwork_url", album_artwork_url)
+        _set(self, "cover_artists", shared(cover_artists))
+        _set(self, "discogs_url", discogs_url)
+        _set(self, "year", shared(year))
+        _set(self, "reasons", shared.all(reasons))
+        _set(self, "genres", shared.all(genres))
+        _set(self, "styles", shared.all(styles))
+        _set(self, "main_artists", shared.all(main_artists))
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def __delattr__(self, name: str) -> None:
+        raise AttributeError(f"{type(self).__name__} is immutable")
+
+    def _astuple(self) -> Tuple[Any, ...]:
+        return tuple(getattr(self, f) for f in self._fields)
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter(self._astuple())
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, Album):
+            other = CompactAlbum.from_album(other)
+        if isinstance(other, CompactAlbum):
+            return self._astuple() == other._astuple()
+        return NotImplemented
+
+    def __hash__(self) -> int:
+        return hash(self._astuple())
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{f}={getattr(self, f)!r}" for f in self._fields)
+        return f"{type(self).__name__}({fields})"
+
+    def __reduce__(self) -> Tuple[Any, ...]:
+        return (CompactAlbum, self._astuple())
+
+    # so this serializes the same way as an Album in dump_results
+    def _asdict(self) -> Dict[str, Any]:
+        return {f: getattr(self, f) for f in self._fields}
+
+    def _replace(self, **kwargs: Any) -> "CompactAlbum":
+        return CompactAlbum(**{**self._asdict(), **kwargs})
+
+    @staticmethod
+    def from_album(album: Album, interner: Optional[Interner] = None) -> "CompactAlbum":
+        return CompactAlbum(*album, interner=interner)
+
+    def to_album(self) -> Album:
+        return Album(
+            **{
+                **self._asdict(),
+                "reasons": list(self.reasons),
+                "genres": list(self.genres),
+                "styles": list(self.styles),
+                "main_artists": list(self.main_artists),
+            }
+        )
+
+    # these only use the fields, so they work the same way here
+    dt = Album.dt
+    dropped = Album.dropped
+    listened = Album.listened
+    discogs = Album.discogs
+    master = Album.master
+    has_master = Album.has_master
+    release = Album.release
+    has_release = Album.has_release
+    datas = Album.datas
+    release_date = Album.release_date
+    _parse_release_date = staticmethod(Album._parse_release_date)
+    _traverse_release_dates = staticmethod(Album._traverse_release_dates)
+
+
+def compact_albums(albums: Iterable[Any]) -> List[CompactAlbum]:
+    """
+    Converts albums as they're read, skipping any errors from export_data,
+    so that the full size Albums don't all have to be in memory at once
+    """
+    interner = Interner()
+    return [
+        CompactAlbum.from_album(a, interner) for a in albums if isinstance(a, Album)
+    ]
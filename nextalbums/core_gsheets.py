@@ -1,13 +1,35 @@
+from __future__ import annotations
 import re
-from typing import Optional, Any
-
-import httplib2  # type: ignore[import]
-from googleapiclient import discovery  # type: ignore[import]
-from oauth2client.file import Storage  # type: ignore[import]
-from oauth2client.client import OAuth2Credentials  # type: ignore[import]
+import csv
+import json
+import hashlib
+from pathlib import Path
+from functools import cache
+from typing import (
+    Optional,
+    Any,
+    Callable,
+    Dict,
+    List,
+    Protocol,
+    Tuple,
+    TypeVar,
+    TYPE_CHECKING,
+)
 
 from . import SETTINGS
-from .common import WorksheetData, WorksheetRow, eprint
+from .common import WorksheetData, WorksheetRow, eprint, atomic_write
+
+# the google libraries take a while to import, so they're imported when
+# they're first used. That way, --offline doesn't have to import them at all
+if TYPE_CHECKING:
+    import httplib2  # type: ignore[import]
+    from oauth2client.client import OAuth2Credentials  # type: ignore[import]
+
+# a single entry in a values.batchUpdate request, like:
+# {"range": "Music!A1", "values": [[5]]}
+ValueRange = Dict[str, Any]
+Json = Dict[str, Any]
 
 
 def get_credentials() -> OAuth2Credentials:
@@ -16,6 +38,8 @@ def get_credentials() -> OAuth2Credentials:
     If nothing has been stored, or if the stored credentials are invalid,
     exits, and tells user to run setup script.
     """
+    from oauth2client.file import Storage  # type: ignore[import]
+
     store = Storage(SETTINGS.CREDENTIALS_PATH)
     credentials = store.get()
     if not credentials or credentials.invalid:
@@ -27,6 +51,153 @@ If the problem persists, delete {SETTINGS.CREDENTIALS_PATH} and then try again""
     return credentials
 
 
+@cache
+def authorized_http() -> httplib2.Http:
+    """
+    One authorized transport for the entire process. httplib2 keeps connections
+    alive, so after the first request every other API call reuses the same warm
+    connection instead of doing another TLS handshake
+
+    httplib2.Http is not thread safe, so this should only be used from the main thread
+    """
+    import httplib2
+
+    return get_credentials().authorize(httplib2.Http())
+
+
+@cache
+def sheets_service() -> Any:
+    from googleapiclient import discovery  # type: ignore[import]
+
+    # static_discovery uses the discovery document bundled with
+    # google-api-python-client, instead of requesting it every time
+    return discovery.build(
+        "sheets",
+        "v4",
+        http=authorized_http(),
+        cache_discovery=False,
+        static_discovery=True,
+    )
+
+
+@cache
+def drive_service() -> Any:
+    from googleapiclient import discovery
+
+    return discovery.build(
+        "drive",
+        "v3",
+        http=authorized_http(),
+        cache_discovery=False,
+        static_discovery=True,
+    )
+
+
+def read_range(sheetRange: str, valueRenderOption: str) -> WorksheetData:
+    """Requests a range of values from the spreadsheet"""
+    result = (
+        sheets_service()
+        .spreadsheets()
+        .values()
+        .get(
+            spreadsheetId=SETTINGS.SPREADSHEET_ID,
+            range=sheetRange,
+            valueRenderOption=valueRenderOption,
+        )
+        .execute()
+    )
+    data: WorksheetData = result.get("values", [])
+    return data
+
+
+def batch_get(ranges: List[str], *, valueRenderOption: str) -> List[WorksheetData]:
+    """Requests multiple ranges in a single request"""
+    if not ranges:
+        return []
+    result = (
+        sheets_service()
+        .spreadsheets()
+        .values()
+        .batchGet(
+            spreadsheetId=SETTINGS.SPREADSHEET_ID,
+            ranges=ranges,
+            valueRenderOption=valueRenderOption,
+        )
+        .execute()
+    )
+    data: List[WorksheetData] = [
+        vr.get("values", []) for vr in result.get("valueRanges", [])
+    ]
+    if valueRenderOption == "FORMULA":
+        data = [_remove_escapes(values) for values in data]
+    return data
+
+
+def batch_update(
+    data: List[ValueRange], *, valueInputOption: str = "USER_ENTERED"
+) -> Json:
+    """
+    Writes multiple ranges in a single request
+
+    defaults to USER_ENTERED so that =IMAGE formulas display
+    """
+    resp: Json = (
+        sheets_service()
+        .spreadsheets()
+        .values()
+        .batchUpdate(
+            spreadsheetId=SETTINGS.SPREADSHEET_ID,
+            body={"valueInputOption": valueInputOption, "data": data},
+        )
+        .execute()
+    )
+    return resp
+
+
+def append_values(
+    sheetRange: str, values: WorksheetData, *, valueInputOption: str = "USER_ENTERED"
+) -> Json:
+    """
+    Adds rows after the last row of the table in sheetRange,
+    inserting new rows for them instead of overwriting anything
+    """
+    resp: Json = (
+        sheets_service()
+        .spreadsheets()
+        .values()
+        .append(
+            spreadsheetId=SETTINGS.SPREADSHEET_ID,
+            range=sheetRange,
+            valueInputOption=valueInputOption,
+            insertDataOption="INSERT_ROWS",
+            body={"values": values},
+        )
+        .execute()
+    )
+    return resp
+
+
+def spreadsheet_batch_update(requests: List[Json]) -> Json:
+    """Sends structural updates (e.g. inserting rows) to the spreadsheet"""
+    resp: Json = (
+        sheets_service()
+        .spreadsheets()
+        .batchUpdate(spreadsheetId=SETTINGS.SPREADSHEET_ID, body={"requests": requests})
+        .execute()
+    )
+    return resp
+
+
+def spreadsheet_metadata() -> Json:
+    resp: Json = (
+        sheets_service()
+        .spreadsheets()
+        .get(spreadsheetId=SETTINGS.SPREADSHEET_ID)
+        .execute()
+    )
+    return resp
+
+
 ESCAPED_TEXT = re.compile(r'^=T\("(.*?)"\)$')
 
 
@@ -43,38 +214,298 @@ def _remove_escapes(data: WorksheetData) -> WorksheetData:
     return new_data
 
 
+SNAPSHOT_DIR = Path(SETTINGS.CACHE_DIR) / "snapshots"
+
+printed_version_error = False
+
+
+def spreadsheet_version() -> Optional[str]:
+    """
+    Asks the Drive API for the current version of the spreadsheet. This is
+    incremented every time the spreadsheet changes, so its used to decide
+    whether the local snapshot is still valid
+
+    Returns None if the version couldn't be fetched (e.g. the credentials
+    were created before the drive.metadata.readonly scope was added)
+    """
+    from googleapiclient.errors import HttpError  # type: ignore[import]
+
+    global printed_version_error
+    try:
+        resp = (
+            drive_service()
+            .files()
+            .get(fileId=SETTINGS.SPREADSHEET_ID, fields="version,modifiedTime")
+            .execute()
+        )
+    except HttpError as e:
+        if not printed_version_error:
+            eprint(
+                f"Could not get spreadsheet version, not using local snapshot: {e}\n"
+                f"To fix this, delete {SETTINGS.CREDENTIALS_PATH} and re-run 'python3 setup_credentials.py'"
+            )
+            printed_version_error = True
+        return None
+    return f"{resp['version']}:{resp['modifiedTime']}"
+
+
+def _snapshot_path(sheetRange: str, valueRenderOption: str) -> Path:
+    key = f"{SETTINGS.SPREADSHEET_ID} {sheetRange} {valueRenderOption}"
+    return SNAPSHOT_DIR / f"{hashlib.md5(key.encode()).hexdigest()}.json"
+
+
+def read_snapshot(
+    sheetRange: str, valueRenderOption: str, version: Optional[str] = None
+) -> Optional[WorksheetData]:
+    """
+    Returns the locally saved values for this range, or None if there is no
+    snapshot (or if a version is passed and the snapshot is out of date)
+    """
+    path = _snapshot_path(sheetRange, valueRenderOption)
+    if not path.exists():
+        return None
+    try:
+        snapshot = json.loads(path.read_text())
+    except ValueError:
+        return None
+    if version is not None and snapshot["version"] != version:
+        return None
+    data: WorksheetData = snapshot["values"]
+    return data
+
+
+def write_snapshot(
+    sheetRange: str, valueRenderOption: str, version: str, values: WorksheetData
+) -> None:
+    path = _snapshot_path(sheetRange, valueRenderOption)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with atomic_write(path) as tmp:
+        tmp.write_text(
+            json.dumps(
+                {
+                    "range": sheetRange,
+                    "valueRenderOption": valueRenderOption,
+                    "version": version,
+                    "values": values,
+                }
+            )
+        )
+
+
+# offline mode; set by the --offline/--source flags on the CLI
+# if enabled, get_values reads from local files instead of the API
+OFFLINE: bool = False
+OFFLINE_SOURCE: Optional[Path] = None
+
+HEADER: WorksheetRow = [
+    "Score",
+    "Album",
+    "Artist",
+    "Year",
+    "Listened On",
+    "Reason",
+    "Album Artwork",
+    "Discogs Link",
+    "Artist ID",
+    "Genre",
+    "Style",
+]
+
+RANGE_REGEX = re.compile(r"^(?:.*!)?([A-Z])(\d*):([A-Z])(\d*)$")
+
+
+def use_offline_source(source: Optional[Path] = None) -> None:
+    """
+    Makes get_values read from local data, instead of the Google Sheets API
+
+    source can be a snapshot saved by get_values (a JSON file), or a CSV
+    file like spreadsheet.csv or csv_data/all.csv. If no source is given,
+    uses the local snapshot if one exists, else spreadsheet.csv
+    """
+    global OFFLINE, OFFLINE_SOURCE
+    OFFLINE = True
+    OFFLINE_SOURCE = source
+
+
+def _parse_range(sheetRange: str) -> Tuple[int, Optional[int], int, int]:
+    """
+    Returns the (starting row number, ending row number, first column index,
+    last column index) for a range like 'Music!A2:K5'. The ending row is
+    None if the range goes to the end of the sheet, like 'Music!A2:K'
+    """
+    match = re.match(RANGE_REGEX, sheetRange)
+    assert match is not None, f"Could not parse range {sheetRange}"
+    start_col, start_row, end_col, end_row = match.groups()
+    return (
+        int(start_row) if start_row else 1,
+        int(end_row) if end_row else None,
+        ord(start_col) - ord("A"),
+        ord(end_col) - ord("A"),
+    )
+
+
+def _read_csv_source(path: Path) -> WorksheetData:
+    """
+    Reads a CSV file written by update-csv-datafiles/generate-csv,
+    and converts it back into the layout of the spreadsheet (with a header)
+    """
+    values: WorksheetData = [list(HEADER)]
+    with path.open(newline="") as f:
+        for row in csv.reader(f):
+            # csv_data files have the score, listened on and album artwork columns removed
+            if len(row) == len(HEADER) - 3:
+                row.insert(0, "")
+                row.insert(4, "")
+                row.insert(6, "")
+            values.append(row)
+    return values
+
+
+def _read_snapshot_source(path: Path) -> WorksheetData:
+    snapshot = json.loads(path.read_text())
+    start_row, _, _, _ = _parse_range(snapshot["range"])
+    values: WorksheetData = snapshot["values"]
+    # pad with empty rows, so this starts at the first row of the sheet
+    return [[] for _ in range(start_row - 1)] + values
+
+
+HYPERLINK_FORMULA = re.compile(r'^=HYPERLINK\("(.*?)"(?:\s*,\s*"(.*?)")?\)$', re.I)
+IMAGE_FORMULA = re.compile(r"^=IMAGE\(.*\)$", re.I)
+
+
+def _formatted_value(col: Any) -> str:
+    """
+    Returns what the sheet displays for a cell, for the formulas which are used
+    on the sheet. The local data is saved with FORMULA, so this is used
+    to read it with FORMATTED_VALUE
+    """
+    text = str(col)
+    if not text.startswith("="):
+        return text
+    if match := re.match(ESCAPED_TEXT, text):
+        return match.group(1)
+    if match := re.match(HYPERLINK_FORMULA, text):
+        return match.group(2) if match.group(2) is not None else match.group(1)
+    if re.match(IMAGE_FORMULA, text):
+        return ""
+    raise ValueError(f"Cannot get the formatted value for {text} offline")
+
+
+def _offline_values(
+    sheetRange: str, valueRenderOption: str, allow_csv: bool
+) -> WorksheetData:
+    data: Optional[WorksheetData] = None
+    if OFFLINE_SOURCE is not None:
+        if OFFLINE_SOURCE.suffix == ".json":
+            data = _read_snapshot_source(OFFLINE_SOURCE)
+    else:
+        # if this exact range has been requested before, use that
+        if (exact := read_snapshot(sheetRange, valueRenderOption)) is not None:
+            return exact
+        # else, try to use a snapshot of the entire sheet
+        for full_range in ("Music!A:K", "Music!A1:K"):
+            full_snapshot = _snapshot_path(full_range, "FORMULA")
+            if full_snapshot.exists():
+                data = _read_snapshot_source(full_snapshot)
+                break
+
+    if data is None:
+        csv_file = OFFLINE_SOURCE or Path(SETTINGS.BASE_SPREADSHEETS_CSV_FILE)
+        # the CSV files have rows/columns removed, so writing them
+        # from one of them would remove those from every file
+        if not allow_csv:
+            eprint(
+                f"Cannot use {csv_file} for this, since it doesn't have the entire sheet.\n"
+                "Run this without --offline, or pass a JSON snapshot with --source"
+            )
+            raise SystemExit(1)
+        data = _read_csv_source(csv_file)
+
+    start_row, end_row, start_col, end_col = _parse_range(sheetRange)
+    values = [row[start_col : end_col + 1] for row in data[start_row - 1 : end_row]]
+    # the API always returns strings for FORMATTED_VALUE
+    if valueRenderOption == "FORMATTED_VALUE":
+        values = [[_formatted_value(col) for col in row] for row in values]
+    return values
+
+
 def get_values(
     *,
     sheetRange: str,
     valueRenderOption: str,
-    credentials: Optional[Any] = None,
     remove_escapes: bool = True,
+    use_snapshot: bool = True,
+    allow_offline: bool = True,
+    allow_csv: bool = True,
 ) -> WorksheetData:
-    creds: Any
-    if credentials is None:
-        creds = get_credentials()
-    else:
-        creds = credentials
-    http = creds.authorize(httplib2.Http())
-    discoveryUrl = "https://sheets.googleapis.com/$discovery/rest?version=v4"
-    service = discovery.build(
-        "sheets",
-        "v4",
-        http=http,
-        discoveryServiceUrl=discoveryUrl,
-        cache_discovery=False,
-    )
-    result = (
-        service.spreadsheets()
-        .values()
-        .get(
-            spreadsheetId=SETTINGS.SPREADSHEET_ID,
-            range=sheetRange,
-            valueRenderOption=valueRenderOption,
-        )
-        .execute()
-    )
-    data: WorksheetData = result.get("values", [])
+    """
+    Gets values from the spreadsheet. If use_snapshot is True, checks the
+    spreadsheets version first and only re-downloads the range if it changed
+    since the last time this was called
+
+    If offline mode is enabled (and allow_offline is True), reads from
+    local data instead. Anything which writes back to the sheet
+    should pass allow_offline=False, so the row numbers are correct.
+    Anything which writes the CSV files should pass allow_csv=False, since
+    those are missing some of the sheet and can't be used to rewrite it
+    """
+    version: Optional[str] = None
+    data: Optional[WorksheetData] = None
+    if OFFLINE and allow_offline:
+        data = _offline_values(sheetRange, valueRenderOption, allow_csv)
+    elif use_snapshot:
+        version = spreadsheet_version()
+        if version is not None:
+            data = read_snapshot(sheetRange, valueRenderOption, version)
+
+    if data is None:
+        data = read_range(sheetRange, valueRenderOption)
+        # if the sheet changed in between checking the version and this request,
+        # the next run sees a newer version and re-downloads, so this is safe
+        if version is not None:
+            write_snapshot(sheetRange, valueRenderOption, version, data)
+
     if remove_escapes and valueRenderOption == "FORMULA":
         data = _remove_escapes(data)
     return data
+
+
+class Versioned(Protocol):
+    # the version of the spreadsheet this was built from
+    version: Optional[str]
+
+
+V = TypeVar("V", bound=Versioned)
+
+
+def _sheet_version() -> Optional[str]:
+    return None if OFFLINE else spreadsheet_version()
+
+
+def load_or_build(
+    load: Callable[[], Optional[V]],
+    build: Callable[[Optional[str]], V],
+    save: Callable[[V], None],
+    *,
+    current_version: Callable[[], Optional[str]] = _sheet_version,
+) -> V:
+    """
+    For data which is built from the sheet and saved locally (e.g. an index)
+
+    Returns the saved data if it was built from the current version of the
+    sheet, else builds it for that version (which reads the sheet), and saves
+    it. If the version is unknown when offline, uses whatever was saved
+    """
+    # the saved data is from the sheet, so use the file that was passed instead
+    if OFFLINE and OFFLINE_SOURCE is not None:
+        return build(None)
+    saved = load()
+    version = current_version()
+    if saved is not None:
+        if version is not None and saved.version == version:
+            return saved
+        if version is None and OFFLINE:
+            return saved
+    data = build(version)
+    save(data)
+    return data
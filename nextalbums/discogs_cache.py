@@ -1,23 +1,24 @@
 """
-uses https://github.com/seanbreckenridge/url_cache to cache
-discogs API data locally
+requests data from the discogs API, and caches it locally in a SQLite database
 """
 
 import os
-import functools
+import time
+import queue
+import atexit
+import threading
 from functools import cache
-from typing import Any, Dict
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Dict, Iterable, Mapping, Optional, Set
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 
 import requests
 import backoff  # type: ignore[import]
-import discogs_client  # type: ignore[import]
-from discogs_client.exceptions import HTTPError  # type: ignore[import]
-from url_cache.core import URLCache
-from url_cache.model import Summary
 
 from . import SETTINGS
 from .common import eprint, parse_url_type
+from .discogs_store import DiscogsStore, DiscogsEntry, DiscogsKey
 
 
 def backoff_hdlr(details):
@@ -28,71 +29,308 @@ def backoff_hdlr(details):
     )
 
 
-@functools.lru_cache(1)
-def discogsClient() -> discogs_client.Client:
-    return discogs_client.Client(
-        SETTINGS.DISCOGS_CREDS["user_agent"], user_token=SETTINGS.DISCOGS_CREDS["token"]
-    )
+DISCOGS_API = "https://api.discogs.com"
+
+# how many requests to make to discogs at the same time
+DEFAULT_WORKERS = 4
+
+
+class RateLimiter:
+    """
+    Token bucket which limits how fast requests are sent to discogs
+
+    Discogs allows 60 authenticated requests per minute (in a moving window),
+    and returns how many requests are left in the X-Discogs-Ratelimit-Remaining
+    header. Starts with a single token, and then uses the response headers to
+    keep track of the actual limits
+    """
+
+    def __init__(self, per_minute: int = 60) -> None:
+        self.capacity: float = float(per_minute)
+        self.tokens: float = 1.0
+        self.updated_at: float = time.monotonic()
+        # if we get a 429, don't send anything till this time
+        self.blocked_until: float = 0.0
+        self.lock = threading.Lock()
+
+    @property
+    def rate(self) -> float:
+        """tokens added per second"""
+        return self.capacity / 60
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self.updated_at
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated_at = now
+
+    def acquire(self) -> None:
+        """Blocks till a request can be sent"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def update(self, headers: Mapping[str, str]) -> None:
+        """Updates the bucket from the X-Discogs-Ratelimit headers on a response"""
+        try:
+            limit = int(headers["X-Discogs-Ratelimit"])
+            remaining = int(headers["X-Discogs-Ratelimit-Remaining"])
+        except (KeyError, ValueError):
+            return
+        with self.lock:
+            self._refill(time.monotonic())
+            self.capacity = float(max(limit, 1))
+            # other requests (e.g. from other processes) may have used some
+            self.tokens = min(self.tokens, float(remaining))
+
+    def block(self, seconds: float) -> None:
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+@cache
+def rate_limiter() -> RateLimiter:
+    return RateLimiter()
+
+
+class DiscogsRetry(Exception):
+    """Raised when a request should be retried (rate limited/server error)"""
+
+
+_local = threading.local()
+
+
+def _session() -> requests.Session:
+    # requests.Session isn't guaranteed to be thread safe, so use one per thread
+    if not hasattr(_local, "session"):
+        session = requests.Session()
+        session.headers.update(
+            {
+                "User-Agent": SETTINGS.DISCOGS_CREDS["user_agent"],
+                "Authorization": f"Discogs token={SETTINGS.DISCOGS_CREDS['token']}",
+            }
+        )
+        _local.session = session
+    sess: requests.Session = _local.session
+    return sess
+
+
+def _giveup(e: Exception) -> bool:
+    # don't retry 404s/other client errors
+    if isinstance(e, requests.exceptions.HTTPError) and e.response is not None:
+        return e.response.status_code < 500
+    return False
 
 
 @backoff.on_exception(
-    lambda: backoff.constant(interval=10),
-    (requests.exceptions.RequestException, HTTPError),
-    max_tries=5,
+    backoff.expo,
+    (requests.exceptions.RequestException, DiscogsRetry),
+    max_tries=6,
+    jitter=backoff.full_jitter,
+    giveup=_giveup,
     on_backoff=backoff_hdlr,
 )
+def _retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    Parses a Retry-After header, which can be a number of seconds or
+    an HTTP date. Returns None if it can't be parsed, so that backoff
+    decides how long to wait instead
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def discogs_request(path: str) -> Dict[str, Any]:
+    """
+    Requests a path from the discogs API, waiting for the rate limiter
+
+    If discogs responds with a 429, waits for the Retry-After header
+    (if given) before any other requests are sent
+    """
+    limiter = rate_limiter()
+    limiter.acquire()
+    resp = _session().get(f"{DISCOGS_API}{path}", timeout=30)
+    limiter.update(resp.headers)
+    if resp.status_code == 429:
+        if (retry_after := _retry_after(resp.headers.get("Retry-After"))) is not None:
+            limiter.block(retry_after)
+        raise DiscogsRetry(f"Rate limited requesting {path}")
+    if resp.status_code >= 500:
+        raise DiscogsRetry(f"Got {resp.status_code} requesting {path}")
+    resp.raise_for_status()
+    data: Dict[str, Any] = resp.json()
+    return data
+
+
 def discogs_get(_type: str, _id: int, /) -> Dict[str, Any]:
     """Gets data from discogs API."""
     eprint(f"[Discogs] Requesting {_type} {_id}")
     if _type == "master":  # if Master
-        resp = discogsClient().master(_id)
+        return discogs_request(f"/masters/{_id}")
     elif _type == "release":
-        resp = discogsClient().release(_id)
+        return discogs_request(f"/releases/{_id}")
     else:
         raise RuntimeError(f"Unknown discogs request type: {_type}")
-    resp.refresh()
-    data = dict(resp.data)
+
+
+def request_data(url: str) -> Dict[str, Any]:
+    assert url.strip(), f"No url: '{url}'"
+    _type, _id = parse_url_type(url)
+    data = discogs_get(_type, int(_id))
+    # raises before it returns, so the response isn't saved
+    assert len(data.keys()) > 3, str(data)
     return data
 
 
-class DiscogsCache(URLCache):
+@cache
+def discogs_store() -> DiscogsStore:
+    default_local = os.path.join(os.environ["HOME"], ".local", "share")
+    db_path = os.path.join(default_local, "discogs_cache.sqlite")
+    # refresh data every 32 weeks
+    return DiscogsStore(
+        os.environ.get("DISCOGS_CACHE_DB", db_path),
+        expiry_duration=timedelta(weeks=32),
+    )
+
+
+# how many stale entries to refresh in the background per run, set
+# by the --max-refresh flag. Anything past this is served stale, and
+# is refreshed on some later run
+MAX_REFRESH = 25
+
+
+class Revalidator:
     """
-    Subclass URLCache to handle caching the Summary data to a local directory cache
+    Refreshes stale entries in a background thread, while the stale
+    data is used for this run (stale-while-revalidate)
+
+    Since every entry has a slightly different expiry, and each run
+    refreshes at most 'budget' entries, refreshes are spread out
+    over multiple runs instead of blocking one run on all of them
     """
 
-    def request_data(self, url: str) -> Summary:  # type: ignore[override]
-        """
-        Override the request data function to fetch from the discogs API
-        """
-        self.sleep()
-        uurl = self.preprocess_url(url)
-        assert uurl.strip(), f"No url: '{url}'"
-        _type, _id = parse_url_type(uurl)
-        data = discogs_get(_type, int(_id))
-        assert len(data.keys()) > 3, str(data)
-        # raises before it returns summary which would then get saved by 'URLCache.get'
-        return Summary(url=uurl, data={}, metadata=data, timestamp=datetime.now())
+    def __init__(self, budget: int) -> None:
+        self.budget = budget
+        self.queue: "queue.Queue[str]" = queue.Queue()
+        self.scheduled: Set[str] = set()
+        self.skipped = 0
+        self.lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+
+    def schedule(self, url: str) -> None:
+        with self.lock:
+            if url in self.scheduled:
+                return
+            if len(self.scheduled) >= self.budget:
+                self.skipped += 1
+                return
+            self.scheduled.add(url)
+            self.queue.put(url)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+                atexit.register(self.finish)
+
+    def _run(self) -> None:
+        while True:
+            url = self.queue.get()
+            try:
+                discogs_store().put(url, request_data(url))
+            except Exception as e:
+                eprint(f"[Discogs] Failed to refresh {url}: {e}")
+            finally:
+                self.queue.task_done()
+
+    def finish(self) -> None:
+        """Waits for any refreshes which are still running"""
+        if (left := self.queue.unfinished_tasks) > 0:
+            eprint(f"[Discogs] Waiting for {left} background refreshes to finish...")
+        self.queue.join()
+        if self.skipped > 0:
+            eprint(
+                f"[Discogs] {self.skipped} stale entries weren't refreshed, over --max-refresh ({self.budget})"
+            )
+            self.skipped = 0
 
 
 @cache
-def discogs_urlcache() -> DiscogsCache:
-    default_local = os.path.join(os.environ["HOME"], ".local", "share")
-    cache_dir = os.path.join(default_local, "discogs_urlcache")
-    cache_dir_path = os.environ.get("DISCOGS_CACHE_DIR", cache_dir)
-    # refresh data every 6 weeks
-    return DiscogsCache(
-        cache_dir=cache_dir_path, sleep_time=1, options={"expiry_duration": "32w"}
+def revalidator() -> Revalidator:
+    return Revalidator(MAX_REFRESH)
+
+
+# entries which were read in bulk by preload_discogs, used (once)
+# instead of reading each of them from the store
+_preloaded: Dict[DiscogsKey, DiscogsEntry] = {}
+
+
+def preload_discogs(urls: Iterable[str]) -> None:
+    """
+    Reads the entries for these URLs (and the main releases for any masters)
+    from the store with a few bulk queries, so resolving each album afterwards
+    doesn't query the store once per URL
+    """
+    store = discogs_store()
+    keys: Set[DiscogsKey] = set()
+    for url in urls:
+        try:
+            keys.add(parse_url_type(url))
+        except (ValueError, AssertionError):
+            pass
+    found = [f"https://www.discogs.com/{_type}/{_id}" for _type, _id in keys]
+    found.extend(
+        f"https://www.discogs.com/release/{release_id}"
+        for release_id in store.main_releases(
+            url for url in found if "/master/" in url
+        ).values()
     )
+    for url, entry in store.get_many(found).items():
+        _preloaded[parse_url_type(url)] = entry
 
 
-def _fetch_discogs(url: str, refresh: bool = False) -> Summary:
-    uc = discogs_urlcache()
-    if refresh:
-        uurl = uc.preprocess_url(url)
-        data = uc.request_data(uurl)
-        uc.summary_cache.put(uurl, data)
-    else:
-        data = uc.get(url)
+def _get_or_revalidate(url: str, refresh: bool) -> Optional[DiscogsEntry]:
+    """
+    Returns the entry from the store if it exists. If its stale, its
+    refreshed in the background (or now, if refresh is True)
+    """
+    store = discogs_store()
+    data = _preloaded.pop(parse_url_type(url), None)
+    if data is None:
+        data = store.get(url)
+    if data is not None and data.expired:
+        if refresh:
+            return None
+        revalidator().schedule(url)
+    return data
+
+
+def _fetch_discogs(url: str, refresh: bool = False) -> DiscogsEntry:
+    """
+    If refresh is True, fetches stale entries now, instead of
+    returning them and refreshing them in the background
+    """
+    store = discogs_store()
+    data = _get_or_revalidate(url, refresh)
+    if data is None:
+        data = store.put(url, request_data(url))
     _type, _id = parse_url_type(url)
     # if this is the master release, request the main release for this as well
     if _type == "master":
@@ -100,12 +338,56 @@ def _fetch_discogs(url: str, refresh: bool = False) -> Summary:
         main_release_url = (
             f"https://discogs.com/release/{int(data.metadata['main_release'])}"
         )
-        if not uc.summary_cache.has(main_release_url):
+        if not store.has(main_release_url):
             eprint(f"[Discogs] Requesting main release for {_id}")
-        uc.get(main_release_url)
+            store.put(main_release_url, request_data(main_release_url))
+        elif not store.is_fresh(main_release_url):
+            if refresh:
+                store.put(main_release_url, request_data(main_release_url))
+            else:
+                revalidator().schedule(main_release_url)
     return data
 
 
 @cache
-def fetch_discogs(url: str) -> Summary:
+def fetch_discogs(url: str) -> DiscogsEntry:
     return _fetch_discogs(url)
+
+
+def resolve_master(release_id: int) -> Optional[int]:
+    """
+    Returns the master for a release, or None if it doesn't have one
+
+    This is saved whenever a release (or a master, for its main release) is
+    saved to the store, so this only requests the release if it hasn't been
+    seen before, or if it had no master the last time it was checked
+    """
+    store = discogs_store()
+    known = store.master_for(release_id)
+    if known is None or known.expired:
+        # saving the release records its master
+        url = f"https://www.discogs.com/release/{release_id}"
+        store.put(url, request_data(url))
+        known = store.master_for(release_id)
+        assert known is not None
+    return known.master_id
+
+
+def prefetch_discogs(urls: Iterable[str], workers: int = DEFAULT_WORKERS) -> None:
+    """
+    Fetches any URLs which aren't already cached concurrently, so
+    that the (serial) calls to fetch_discogs afterwards are all cache hits
+
+    The rate_limiter makes sure this stays under the discogs rate limit
+    """
+    # anything stale is returned immediately and refreshed in the background
+    missing = list(dict.fromkeys(discogs_store().missing(urls)))
+    if not missing:
+        return
+    eprint(f"[Discogs] Fetching {len(missing)} uncached URLs with {workers} workers")
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(fetch_discogs, url): url for url in missing}
+        for fut in as_completed(futures):
+            if (exc := fut.exception()) is not None:
+                # this is raised again when the URL is requested serially
+                eprint(f"[Discogs] Failed to fetch {futures[fut]}: {exc}")
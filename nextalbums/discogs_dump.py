@@ -0,0 +1,310 @@
+"""
+Imports masters/releases from the monthly discogs data dumps
+(https://discogs-data-dumps.s3.us-west-2.amazonaws.com/index.html)
+into the discogs cache, instead of requesting each of them from the API
+
+The dumps are large, so this streams the XML and only keeps the entries
+which are referenced by the sheet
+"""
+
+import gzip
+from io import BufferedReader
+from pathlib import Path
+from datetime import datetime
+from xml.etree.ElementTree import Element, iterparse
+from typing import (
+    Dict,
+    Any,
+    List,
+    Set,
+    Iterable,
+    Iterator,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from .common import WorksheetData, eprint, parse_url_type
+from .discogs_store import DiscogsStore, DiscogsKey, discogs_url
+
+Json = Dict[str, Any]
+
+# how many entries to write to the store in a single transaction
+BATCH_SIZE = 500
+
+
+def _open(path: Union[str, Path]) -> Union[gzip.GzipFile, BufferedReader]:
+    p = Path(path)
+    if p.suffix == ".gz":
+        return gzip.GzipFile(p, "rb")
+    return p.open("rb")
+
+
+def _text(elem: Element, tag: str) -> Optional[str]:
+    child = elem.find(tag)
+    if child is None or child.text is None:
+        return None
+    return child.text.strip()
+
+
+def _int(elem: Element, tag: str) -> Optional[int]:
+    text = _text(elem, tag)
+    if text is None or not text.isdigit():
+        return None
+    return int(text)
+
+
+def _texts(elem: Element, path: str) -> List[str]:
+    return [c.text.strip() for c in elem.findall(path) if c.text]
+
+
+def _artists(elem: Optional[Element]) -> List[Json]:
+    if elem is None:
+        return []
+    artists = []
+    for artist in elem.findall("artist"):
+        artists.append(
+            {
+                "id": _int(artist, "id") or 0,
+                "name": _text(artist, "name") or "",
+                "anv": _text(artist, "anv") or "",
+                "join": _text(artist, "join") or "",
+                "role": _text(artist, "role") or "",
+                "tracks": _text(artist, "tracks") or "",
+            }
+        )
+    return artists
+
+
+def _images(elem: Element) -> List[Json]:
+    images = []
+    for image in elem.findall("images/image"):
+        # the dumps don't include the image URLs anymore, so
+        # skip those instead of saving an empty image
+        if not image.get("uri"):
+            continue
+        images.append(
+            {
+                "type": image.get("type", ""),
+                "uri": image.get("uri"),
+                "uri150": image.get("uri150", ""),
+                "width": int(image.get("width", 0)),
+                "height": int(image.get("height", 0)),
+            }
+        )
+    return images
+
+
+def _videos(elem: Element) -> List[Json]:
+    return [
+        {
+            "uri": video.get("src", ""),
+            "title": _text(video, "title") or "",
+            "description": _text(video, "description") or "",
+            "duration": int(video.get("duration", 0)),
+            "embed": video.get("embed") == "true",
+        }
+        for video in elem.findall("videos/video")
+    ]
+
+
+def _tracklist(elem: Element) -> List[Json]:
+    return [
+        {
+            "position": _text(track, "position") or "",
+            "title": _text(track, "title") or "",
+            "duration": _text(track, "duration") or "",
+        }
+        for track in elem.findall("tracklist/track")
+    ]
+
+
+def _common(elem: Element, _type: str, _id: int) -> Json:
+    data: Json = {
+        "id": _id,
+        "uri": discogs_url((_type, _id)),
+        "title": _text(elem, "title") or "",
+        "artists": _artists(elem.find("artists")),
+        "genres": _texts(elem, "genres/genre"),
+        "styles": _texts(elem, "styles/style"),
+        "tracklist": _tracklist(elem),
+        "videos": _videos(elem),
+        "data_quality": _text(elem, "data_quality") or "",
+    }
+    if images := _images(elem):
+        data["images"] = images
+    return data
+
+
+def master_json(elem: Element) -> Json:
+    """Converts a <master> element into the same shape as the /masters API"""
+    _id = int(elem.get("id", 0))
+    data = _common(elem, "master", _id)
+    if (main_release := _int(elem, "main_release")) is not None:
+        data["main_release"] = main_release
+    if year := _int(elem, "year"):
+        data["year"] = year
+    return data
+
+
+def release_json(elem: Element) -> Json:
+    """Converts a <release> element into the same shape as the /releases API"""
+    _id = int(elem.get("id", 0))
+    data = _common(elem, "release", _id)
+    data["status"] = elem.get("status", "")
+    data["extraartists"] = _artists(elem.find("extraartists"))
+    data["labels"] = [
+        {
+            "id": int(label.get("id", 0)),
+            "name": label.get("name", ""),
+            "catno": label.get("catno", ""),
+        }
+        for label in elem.findall("labels/label")
+    ]
+    data["formats"] = [
+        {
+            "name": fmt.get("name", ""),
+            "qty": fmt.get("qty", ""),
+            "text": fmt.get("text", ""),
+            "descriptions": _texts(fmt, "descriptions/description"),
+        }
+        for fmt in elem.findall("formats/format")
+    ]
+    if country := _text(elem, "country"):
+        data["country"] = country
+    if notes := _text(elem, "notes"):
+        data["notes"] = notes
+    if released := _text(elem, "released"):
+        data["released"] = released
+        if released[:4].isdigit():
+            data["year"] = int(released[:4])
+    if (master_id := _int(elem, "master_id")) is not None:
+        data["master_id"] = master_id
+    return data
+
+
+def iter_dump(
+    path: Union[str, Path], wanted: Optional[Set[int]] = None
+) -> Iterator[Tuple[str, Json]]:
+    """
+    Streams (type, data) for each <master>/<release> in a (gzipped) dump
+
+    If wanted is given, only converts the entries with those IDs. Each
+    element is cleared once its been read, so this uses constant memory
+    no matter how large the dump is
+    """
+    with _open(path) as f:
+        root: Optional[Element] = None
+        depth = 0
+        for event, elem in iterparse(f, events=("start", "end")):
+            if event == "start":
+                if root is None:
+                    root = elem
+                depth += 1
+                continue
+            depth -= 1
+            # only handle the top-level <master>/<release> elements
+            if depth != 1 or elem.tag not in ("master", "release"):
+                continue
+            _id = int(elem.get("id", 0))
+            if wanted is None or _id in wanted:
+                if elem.tag == "master":
+                    yield "master", master_json(elem)
+                else:
+                    yield "release", release_json(elem)
+            assert root is not None
+            root.clear()
+
+
+def sheet_keys(values: WorksheetData) -> List[DiscogsKey]:
+    """Returns the (type, id) for each discogs link on the sheet"""
+    from .warm_cache import _sheet_urls
+
+    return list(dict.fromkeys(parse_url_type(url) for url in _sheet_urls(values)))
+
+
+def _import(
+    store: DiscogsStore,
+    path: Union[str, Path],
+    wanted: Set[int],
+    fetched_at: Optional[datetime],
+) -> Iterator[Json]:
+    """Writes the wanted entries from the dump, yielding each one as its saved"""
+    fetched = fetched_at or datetime.now()
+    batch: List[Tuple[str, Json, Optional[datetime]]] = []
+    remaining = set(wanted)
+    found = 0
+    for _type, data in iter_dump(path, wanted):
+        batch.append((discogs_url((_type, data["id"])), data, fetched))
+        found += 1
+        if len(batch) >= BATCH_SIZE:
+            store.put_many(batch)
+            batch.clear()
+        if found % 1000 == 0:
+            eprint(f"[Dump] Imported {found}/{len(wanted)} from {path}")
+        yield data
+        # stop reading the dump once everything has been found
+        remaining.discard(data["id"])
+        if not remaining:
+            break
+    store.put_many(batch)
+
+
+def import_dump(
+    store: DiscogsStore,
+    keys: Iterable[DiscogsKey],
+    *,
+    masters: Optional[Union[str, Path]] = None,
+    releases: Optional[Union[str, Path]] = None,
+    fetched_at: Optional[datetime] = None,
+    overwrite: bool = False,
+) -> Tuple[int, List[str]]:
+    """
+    Imports the masters/releases for these keys (and the main releases for
+    any masters) from the dumps into the store
+
+    Unless overwrite is True, anything which is already in the
+    store and hasn't expired is skipped. Returns the number of
+    entries that were imported, and any URLs that weren't in the dumps
+    """
+    urls = [discogs_url(key) for key in dict.fromkeys(keys)]
+    if not overwrite:
+        urls = store.stale(urls)
+    want_masters = {
+        _id for _type, _id in map(parse_url_type, urls) if _type == "master"
+    }
+    want_releases = {
+        _id for _type, _id in map(parse_url_type, urls) if _type == "release"
+    }
+    # main releases for masters which are already cached
+    want_releases.update(
+        store.main_releases(
+            discogs_url(("master", _id)) for _id in want_masters
+        ).values()
+    )
+
+    imported = 0
+    if masters is not None and want_masters:
+        eprint(f"[Dump] Looking for {len(want_masters)} masters in {masters}")
+        for data in _import(store, masters, want_masters, fetched_at):
+            want_masters.discard(data["id"])
+            if (main_release := data.get("main_release")) is not None:
+                want_releases.add(int(main_release))
+            imported += 1
+    if releases is not None and want_releases:
+        if not overwrite:
+            want_releases = {
+                parse_url_type(url)[1]
+                for url in store.stale(
+                    discogs_url(("release", _id)) for _id in want_releases
+                )
+            }
+        eprint(f"[Dump] Looking for {len(want_releases)} releases in {releases}")
+        for data in _import(store, releases, want_releases, fetched_at):
+            want_releases.discard(data["id"])
+            imported += 1
+
+    missing = [discogs_url(("master", _id)) for _id in sorted(want_masters)] + [
+        discogs_url(("release", _id)) for _id in sorted(want_releases)
+    ]
+    return imported, missing
@@ -0,0 +1,536 @@
+"""
+A single-file SQLite database which stores the responses from the discogs API
+"""
+
+import os
+import json
+import zlib
+import random
+import sqlite3
+import threading
+from pathlib import Path
+from datetime import datetime, timedelta
+from typing import (
+    NamedTuple,
+    Optional,
+    Dict,
+    Any,
+    List,
+    Iterable,
+    Iterator,
+    Tuple,
+    Union,
+)
+
+from .common import eprint, parse_url_type
+
+Json = Dict[str, Any]
+
+# (type, id), e.g. ("master", 96471)
+DiscogsKey = Tuple[str, int]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    type TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    main_release INTEGER,
+    fetched_at REAL NOT NULL,
+    expires_at REAL,
+    PRIMARY KEY (type, id)
+);
+CREATE INDEX IF NOT EXISTS entries_main_release ON entries (main_release);
+CREATE TABLE IF NOT EXISTS entry_artists (
+    type TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    artist_id INTEGER NOT NULL,
+    PRIMARY KEY (type, id, artist_id)
+);
+CREATE INDEX IF NOT EXISTS entry_artists_artist_id ON entry_artists (artist_id);
+CREATE TABLE IF NOT EXISTS release_masters (
+    release_id INTEGER PRIMARY KEY,
+    master_id INTEGER,
+    checked_at REAL NOT NULL,
+    expires_at REAL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+# the only fields which are used from the discogs responses, what's
+# kept when the store is compact
+PROJECTED_FIELDS = {
+    "id",
+    "title",
+    "artists",
+    "year",
+    "released",
+    "release",
+    "main_release",
+    "master_id",
+    "genres",
+    "styles",
+    "images",
+}
+PROJECTED_ARTIST_FIELDS = {"id", "name"}
+PROJECTED_IMAGE_FIELDS = {"type", "uri"}
+
+# releases which don't have a master are checked again sooner than
+# other entries, since a master might be created for them later
+NO_MASTER_EXPIRY = timedelta(weeks=4)
+
+# entries expire somewhere between 0.75 and 1.25 times the expiry duration
+EXPIRY_JITTER = 0.25
+
+# sqlite has a limit on the number of variables in a query
+CHUNK_SIZE = 500
+
+
+def discogs_url(key: DiscogsKey) -> str:
+    _type, _id = key
+    return f"https://www.discogs.com/{_type}/{_id}"
+
+
+def project(data: Json) -> Json:
+    """Removes anything from a discogs response which isn't used"""
+    projected = {k: v for k, v in data.items() if k in PROJECTED_FIELDS}
+    for key, fields in (
+        ("artists", PROJECTED_ARTIST_FIELDS),
+        ("images", PROJECTED_IMAGE_FIELDS),
+    ):
+        if key in projected:
+            projected[key] = [
+                {k: v for k, v in item.items() if k in fields}
+                for item in projected[key]
+            ]
+    return projected
+
+
+def _decode(data: Union[str, bytes]) -> Json:
+    # compact entries are zlib compressed JSON, stored as BLOBs
+    if isinstance(data, bytes):
+        data = zlib.decompress(data).decode()
+    d: Json = json.loads(data)
+    return d
+
+
+class MasterLookup(NamedTuple):
+    # None if the release doesn't have a master
+    master_id: Optional[int]
+    expires_at: Optional[datetime]
+
+    @property
+    def expired(self) -> bool:
+        if self.expires_at is None:
+            return False
+        return datetime.now() > self.expires_at
+
+
+class DiscogsEntry(NamedTuple):
+    url: str
+    metadata: Json
+    timestamp: datetime
+    expires_at: Optional[datetime]
+
+    @property
+    def expired(self) -> bool:
+        if self.expires_at is None:
+            return False
+        return datetime.now() > self.expires_at
+
+
+class DiscogsStore:
+    """
+    Stores discogs metadata in SQLite, keyed by (type, id)
+
+    Uses WAL mode and a connection per thread, so it can be read from/written
+    to while requests are being made concurrently
+
+    If the store is compact (see compact), entries only keep
+    the fields which are used and are compressed with zlib
+    """
+
+    def __init__(
+        self, path: Union[str, Path], *, expiry_duration: Optional[timedelta] = None
+    ) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.expiry_duration = expiry_duration
+        self._local = threading.local()
+        self.conn.executescript(SCHEMA)
+        self.compact_entries = self._meta("compact") == "1"
+        if self._meta("release_masters") != "1":
+            self._fill_release_masters()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if not hasattr(self._local, "conn"):
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        c: sqlite3.Connection = self._local.conn
+        return c
+
+    def _meta(self, key: str) -> Optional[str]:
+        row = self.conn.execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)
+        ).fetchone()
+        return None if row is None else str(row[0])
+
+    def _set_meta(self, key: str, value: str) -> None:
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value)
+            )
+
+    def _prepare(self, data: Json) -> Json:
+        return project(data) if self.compact_entries else data
+
+    def _encode(self, data: Json) -> Union[str, bytes]:
+        if self.compact_entries:
+            return zlib.compress(json.dumps(data, separators=(",", ":")).encode())
+        return json.dumps(data)
+
+    def _entry(self, row: Tuple[Any, ...]) -> DiscogsEntry:
+        _type, _id, data, fetched_at, expires_at = row
+        return DiscogsEntry(
+            url=discogs_url((_type, _id)),
+            metadata=_decode(data),
+            timestamp=datetime.fromtimestamp(fetched_at),
+            expires_at=(
+                datetime.fromtimestamp(expires_at) if expires_at is not None else None
+            ),
+        )
+
+    def get(self, url: str) -> Optional[DiscogsEntry]:
+        _type, _id = parse_url_type(url)
+        row = self.conn.execute(
+            "SELECT type, id, data, fetched_at, expires_at FROM entries WHERE type = ? AND id = ?",
+            (_type, _id),
+        ).fetchone()
+        if row is None:
+            return None
+        return self._entry(row)
+
+    def _select_many(self, columns: str, keys: List[DiscogsKey]) -> Iterator[Any]:
+        """Runs a select for each chunk of keys, grouped by type"""
+        by_type: Dict[str, List[int]] = {}
+        for _type, _id in keys:
+            by_type.setdefault(_type, []).append(_id)
+        for _type, ids in by_type.items():
+            for i in range(0, len(ids), CHUNK_SIZE):
+                chunk = ids[i : i + CHUNK_SIZE]
+                placeholders = ", ".join("?" for _ in chunk)
+                yield from self.conn.execute(
+                    f"SELECT {columns} FROM entries WHERE type = ? AND id IN ({placeholders})",
+                    (_type, *chunk),
+                )
+
+    def get_many(self, urls: Iterable[str]) -> Dict[str, DiscogsEntry]:
+        """
+        Returns entries for any of the URLs which are in the store,
+        keyed by the URL that was passed
+        """
+        requested: Dict[DiscogsKey, List[str]] = {}
+        for url in urls:
+            requested.setdefault(parse_url_type(url), []).append(url)
+        found: Dict[str, DiscogsEntry] = {}
+        for row in self._select_many(
+            "type, id, data, fetched_at, expires_at", list(requested)
+        ):
+            entry = self._entry(row)
+            for url in requested[(row[0], row[1])]:
+                found[url] = entry
+        return found
+
+    def _not_fresh(self, urls: Iterable[str], *, include_expired: bool) -> List[str]:
+        requested: Dict[DiscogsKey, List[str]] = {}
+        for url in urls:
+            requested.setdefault(parse_url_type(url), []).append(url)
+        now = datetime.now().timestamp()
+        found = set()
+        for _type, _id, expires_at in self._select_many(
+            "type, id, expires_at", list(requested)
+        ):
+            if not include_expired or expires_at is None or expires_at > now:
+                found.add((_type, _id))
+        return [
+            url for key, urls in requested.items() if key not in found for url in urls
+        ]
+
+    def stale(self, urls: Iterable[str]) -> List[str]:
+        """Returns any URLs which are missing or have expired, without decoding any data"""
+        return self._not_fresh(urls, include_expired=True)
+
+    def missing(self, urls: Iterable[str]) -> List[str]:
+        """Returns any URLs which aren't in the store at all"""
+        return self._not_fresh(urls, include_expired=False)
+
+    def timestamps(self, url: str) -> Optional[Tuple[datetime, Optional[datetime]]]:
+        """Returns when this was fetched/when it expires, if its in the store"""
+        _type, _id = parse_url_type(url)
+        row = self.conn.execute(
+            "SELECT fetched_at, expires_at FROM entries WHERE type = ? AND id = ?",
+            (_type, _id),
+        ).fetchone()
+        if row is None:
+            return None
+        fetched_at, expires_at = row
+        return datetime.fromtimestamp(fetched_at), (
+            datetime.fromtimestamp(expires_at) if expires_at is not None else None
+        )
+
+    def main_releases(self, urls: Iterable[str]) -> Dict[str, int]:
+        """
+        Returns the main release ID for any of these masters
+        which are in the store, without decoding any data
+        """
+        requested: Dict[DiscogsKey, List[str]] = {}
+        for url in urls:
+            requested.setdefault(parse_url_type(url), []).append(url)
+        found: Dict[str, int] = {}
+        for _type, _id, main_release in self._select_many(
+            "type, id, main_release", list(requested)
+        ):
+            if main_release is not None:
+                for url in requested[(_type, _id)]:
+                    found[url] = int(main_release)
+        return found
+
+    def is_fresh(self, url: str) -> bool:
+        return not self.stale([url])
+
+    def has(self, url: str) -> bool:
+        return not self.missing([url])
+
+    def _expires_at(
+        self, fetched_at: datetime, duration: Optional[timedelta] = None
+    ) -> Optional[float]:
+        """
+        Each entry gets a slightly different expiry time, so entries which
+        were added at the same time don't all expire on the same run
+        """
+        duration = duration or self.expiry_duration
+        if duration is None:
+            return None
+        jitter = random.uniform(1 - EXPIRY_JITTER, 1 + EXPIRY_JITTER)
+        return (fetched_at + duration * jitter).timestamp()
+
+    def _put_master(
+        self,
+        release_id: int,
+        master_id: Optional[int],
+        checked_at: datetime,
+        *,
+        replace: bool = True,
+    ) -> None:
+        duration = NO_MASTER_EXPIRY if master_id is None else None
+        self.conn.execute(
+            f"INSERT OR {'REPLACE' if replace else 'IGNORE'} INTO release_masters (release_id, master_id, checked_at, expires_at) VALUES (?, ?, ?, ?)",
+            (
+                release_id,
+                master_id,
+                checked_at.timestamp(),
+                self._expires_at(checked_at, duration),
+            ),
+        )
+
+    def _fill_release_masters(self) -> None:
+        """
+        Fills release_masters from the entries which were
+        saved before it existed. Only runs once
+        """
+        last_rowid = 0
+        while True:
+            rows = self.conn.execute(
+                "SELECT rowid, type, id, data, main_release, fetched_at FROM entries WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                (last_rowid, CHUNK_SIZE),
+            ).fetchall()
+            if not rows:
+                break
+            with self.conn:
+                for _, _type, _id, data, main_release, fetched_at in rows:
+                    checked_at = datetime.fromtimestamp(fetched_at)
+                    if _type == "release":
+                        master_id = _decode(data).get("master_id")
+                        self._put_master(
+                            _id, int(master_id) if master_id else None, checked_at
+                        )
+                    elif main_release is not None:
+                        # the release itself is more accurate, if that's saved
+                        self._put_master(
+                            int(main_release), _id, checked_at, replace=False
+                        )
+            last_rowid = rows[-1][0]
+        self._set_meta("release_masters", "1")
+
+    def master_for(self, release_id: int) -> Optional[MasterLookup]:
+        """
+        Returns the master for a release if it's known (which can be
+        that it has no master), without decoding any data
+        """
+        row = self.conn.execute(
+            "SELECT master_id, expires_at FROM release_masters WHERE release_id = ?",
+            (release_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        master_id, expires_at = row
+        return MasterLookup(
+            master_id=master_id,
+            expires_at=(
+                datetime.fromtimestamp(expires_at) if expires_at is not None else None
+            ),
+        )
+
+    def _put(
+        self, key: DiscogsKey, data: Json, fetched_at: datetime
+    ) -> Optional[float]:
+        """Saves data (which should already be projected), returns when the entry expires"""
+        _type, _id = key
+        expires_at = self._expires_at(fetched_at)
+        main_release = data.get("main_release") if _type == "master" else None
+        self.conn.execute(
+            "INSERT OR REPLACE INTO entries (type, id, data, main_release, fetched_at, expires_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                _type,
+                _id,
+                self._encode(data),
+                int(main_release) if main_release is not None else None,
+                fetched_at.timestamp(),
+                expires_at,
+            ),
+        )
+        self.conn.execute(
+            "DELETE FROM entry_artists WHERE type = ? AND id = ?", (_type, _id)
+        )
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO entry_artists (type, id, artist_id) VALUES (?, ?, ?)",
+            [
+                (_type, _id, int(a["id"]))
+                for a in data.get("artists", [])
+                if int(a.get("id", 0)) != 0
+            ],
+        )
+        if _type == "release":
+            master_id = data.get("master_id")
+            self._put_master(_id, int(master_id) if master_id else None, fetched_at)
+        elif main_release is not None:
+            self._put_master(int(main_release), _id, fetched_at)
+        return expires_at
+
+    def put(
+        self, url: str, data: Json, fetched_at: Optional[datetime] = None
+    ) -> DiscogsEntry:
+        key = parse_url_type(url)
+        fetched = fetched_at or datetime.now()
+        data = self._prepare(data)
+        with self.conn:
+            expires_at = self._put(key, data, fetched)
+        return DiscogsEntry(
+            url=discogs_url(key),
+            metadata=data,
+            timestamp=fetched,
+            expires_at=(
+                datetime.fromtimestamp(expires_at) if expires_at is not None else None
+            ),
+        )
+
+    def put_many(self, items: Iterable[Tuple[str, Json, Optional[datetime]]]) -> int:
+        """Inserts multiple entries in a single transaction"""
+        count = 0
+        with self.conn:
+            for url, data, fetched_at in items:
+                self._put(
+                    parse_url_type(url),
+                    self._prepare(data),
+                    fetched_at or datetime.now(),
+                )
+                count += 1
+        return count
+
+    def compact(self) -> int:
+        """
+        Makes this a compact store, and rewrites the existing entries so
+        they're projected/compressed. Returns the number of entries rewritten
+
+        Since the other fields are dropped, this can't be undone
+        without requesting everything again
+        """
+        self._set_meta("compact", "1")
+        self.compact_entries = True
+        count = 0
+        last_rowid = 0
+        while True:
+            rows = self.conn.execute(
+                "SELECT rowid, data FROM entries WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                (last_rowid, CHUNK_SIZE),
+            ).fetchall()
+            if not rows:
+                break
+            with self.conn:
+                self.conn.executemany(
+                    "UPDATE entries SET data = ? WHERE rowid = ?",
+                    [
+                        (self._encode(project(_decode(data))), rowid)
+                        for rowid, data in rows
+                    ],
+                )
+            count += len(rows)
+            last_rowid = rows[-1][0]
+        # give the space back to the filesystem
+        self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.conn.execute("VACUUM")
+        return count
+
+    def __len__(self) -> int:
+        (count,) = self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()
+        return int(count)
+
+
+def _iter_urlcache_dir(
+    cache_dir: Path,
+) -> Iterator[Tuple[str, Json, Optional[datetime]]]:
+    """
+    Reads the directories created by url_cache, which look like:
+
+    data/4/3/7/b930db84b8079c2dd804a71936b5f/000/key
+    data/4/3/7/b930db84b8079c2dd804a71936b5f/000/metadata.json
+    data/4/3/7/b930db84b8079c2dd804a71936b5f/000/timestamp.datetime.txt
+    """
+    for keyfile in cache_dir.rglob("key"):
+        url = keyfile.read_text().strip()
+        metadata_file = keyfile.parent / "metadata.json"
+        if not metadata_file.exists():
+            continue
+        try:
+            parse_url_type(url)
+        except (AssertionError, ValueError):
+            eprint(f"Skipping unknown URL in cache: {url}")
+            continue
+        timestamp: Optional[datetime] = None
+        timestamp_file = keyfile.parent / "timestamp.datetime.txt"
+        if timestamp_file.exists():
+            timestamp = datetime.fromtimestamp(int(timestamp_file.read_text()))
+        yield url, json.loads(metadata_file.read_text()), timestamp
+
+
+def migrate_urlcache(store: DiscogsStore, cache_dir: Union[str, Path]) -> int:
+    """
+    Imports the entries from the old url_cache directory into the store
+
+    Returns the number of entries imported
+    """
+    path = Path(cache_dir)
+    assert path.is_dir(), f"{path} is not a directory"
+    return store.put_many(_iter_urlcache_dir(path))
+
+
+def default_urlcache_dir() -> str:
+    default_local = os.path.join(os.environ["HOME"], ".local", "share")
+    return os.environ.get(
+        "DISCOGS_CACHE_DIR", os.path.join(default_local, "discogs_urlcache")
+    )
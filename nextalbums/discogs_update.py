@@ -1,23 +1,68 @@
 from __future__ import annotations
 import os
 import re
+import copy
+import json
+import math
+import time
+import queue
 import string
-from datetime import date
+import hashlib
+import threading
+from pathlib import Path
+from functools import partial
+from datetime import date, datetime
 from dataclasses import dataclass, replace
-from urllib.parse import urlparse
-from typing import List, Any, Set, Dict, Optional, Union, Sequence, TYPE_CHECKING
-from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    List,
+    Any,
+    Set,
+    Dict,
+    Optional,
+    Union,
+    Sequence,
+    Tuple,
+    NamedTuple,
+    Callable,
+    Iterable,
+    Iterator,
+    TYPE_CHECKING,
+)
 
 import click
 import backoff  # type: ignore[import]
 import httplib2  # type: ignore[import]
 from more_itertools import unique_everseen
-from googleapiclient import discovery  # type: ignore[import]
 
+from .core_gsheets import (
+    ValueRange,
+    get_values,
+    batch_get,
+    batch_update,
+    append_values,
+    spreadsheet_metadata,
+    spreadsheet_batch_update,
+    _parse_range,
+)
 from . import SETTINGS
-from .core_gsheets import get_credentials, get_values
-from .common import WorksheetData, WorksheetRow, eprint
-from .discogs_cache import fetch_discogs, backoff_hdlr, discogsClient
+from .common import (
+    WorksheetData,
+    WorksheetRow,
+    eprint,
+    remove_image_formula,
+    atomic_write,
+    clean_discogs_link,
+    parse_url_type,
+)
+from .discogs_cache import (
+    DEFAULT_WORKERS,
+    fetch_discogs,
+    preload_discogs,
+    resolve_master,
+    backoff_hdlr,
+    discogs_store,
+)
 from .export import export_data, Album, _split_separated
 
 AlbumOrErr = Union[Album, Exception]
@@ -35,13 +80,6 @@ def _pad_data(row: WorksheetRow, col_count: int) -> WorksheetRow:
 ALLOWED = string.ascii_letters + string.digits + " "
 
 
-def remove_image_formula(img_cell: str) -> str:
-    assert img_cell.startswith("=IMAGE(")
-    if img_cell.startswith("=IMAGE("):
-        return img_cell[7:-1].strip('"').strip("'")
-    return img_cell
-
-
 def slugify(data: str, allow_period: bool = False) -> str:
     allow = ALLOWED + "." if allow_period else ALLOWED
     slug = "".join(s for s in data.strip() if s in allow)
@@ -95,25 +133,27 @@ class AlbumInfo:
 
 def _fix_discogs_link(link: str, resolve: bool) -> str:
     """Removes unnecessary parts of Discogs URLs"""
-    urlparse_path = urlparse(link).path
-    if master_id := re.search(r"\/master\/(?:view\/)?(\d+)", urlparse_path):
-        return "https://www.discogs.com/master/{}".format(master_id.groups()[0])
-    else:  # if there is no master id
-        if release_id := re.search(r"\/release\/(?:view\/)?(\d+)", urlparse_path):
-            if resolve:
-                release_match = release_id.groups()[0]
-                eprint(f"Attempting to resolve release {release_match} to master.")
-                rel = discogsClient().release(int(release_match))
-                sleep(2)
-                if rel.master is not None:
-                    eprint(f"Resolved release {release_match} to {rel.master.id}.")
-                    return f"https://www.discogs.com/master/{rel.master.id}"
-                else:
-                    return "https://www.discogs.com/release/{}".format(release_match)
-            else:
-                return f"https://www.discogs.com/release/{release_id.groups()[0]}"
-        else:
-            raise Exception(f"Unknown discogs link: {link}. Exiting...")
+    fixed = clean_discogs_link(link)
+    if fixed is None:
+        raise Exception(f"Unknown discogs link: {link}. Exiting...")
+    _type, release_id = parse_url_type(fixed)
+    if _type == "release" and resolve:
+        eprint(f"Attempting to resolve release {release_id} to master.")
+        if (resolved := resolve_master(release_id)) is not None:
+            eprint(f"Resolved release {release_id} to {resolved}.")
+            return f"https://www.discogs.com/master/{resolved}"
+    return fixed
+
+
+def resolve_links(links: Sequence[str], workers: int = DEFAULT_WORKERS) -> List[str]:
+    """
+    Fixes each link, resolving releases to their masters. The releases are
+    requested concurrently (the rate limiter keeps this under the discogs limit)
+    """
+    # check that every link is valid before making any requests
+    fixed = [_fix_discogs_link(link, resolve=False) for link in links]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(lambda link: _fix_discogs_link(link, resolve=True), fixed))
 
 
 ARTIST_NAME_REGEX = re.compile(r"\(\d+\)$")
@@ -166,11 +206,8 @@ def _add_image_formula(img_url: str) -> str:
 
 
 def _discogs_image(album: Album) -> Optional[str]:
-    for d in album.datas():
-        if image_list := d.get("images"):
-            assert isinstance(image_list, list)
-            for d in image_list:
-                return _add_image_formula(d["uri"])
+    for image in album.discogs().images:
+        return _add_image_formula(image["uri"])
     return None
 
 
@@ -179,18 +216,21 @@ ALLOWED_EXTENSIONS = ["jpg", "jpeg", "png"]
 printed = False
 
 
-def _s3_proxy_image(info: AlbumInfo) -> str:
+def _s3_proxy_image(info: AlbumInfo, prompt: bool = True) -> Optional[str]:
     """
     use s3 to reupload the image so I'm not hitting discogs cdn all the time
     https://github.com/seanbreckenridge/s3-image-server
 
     If user doesnt have this configured/isnt installed,
     just return the url thats already there
+
+    If prompt is False, returns None instead of asking for
+    another URL when the image couldn't be downloaded
     """
     if "USE_S3_URL" not in os.environ:
         return info.album_artwork
     try:
-        from .image_proxy import proxy_image
+        from .image_proxy import proxy_image, MissingImage
     except ImportError as e:
         global printed
         if not printed:
@@ -203,14 +243,33 @@ def _s3_proxy_image(info: AlbumInfo) -> str:
         return info.album_artwork
 
     img_url = remove_image_formula(info.album_artwork)
-    proxied = proxy_image(img_url, info.slugify_hash(), info.discogs_url)
+    try:
+        proxied = proxy_image(
+            img_url, info.slugify_hash(), info.discogs_url, prompt=prompt
+        )
+    except MissingImage:
+        return None
+    if proxied is None:
+        return info.album_artwork
+    return _add_image_formula(proxied)
+
+
+def _prompt_image(info: AlbumInfo) -> str:
+    """Asks for an image URL for an album whose image couldn't be downloaded"""
+    from .image_proxy import prompt_image
+
+    try:
+        proxied = prompt_image(info.slugify_hash(), info.discogs_url)
+    except Exception as e:
+        click.echo("Error uploading image to s3: {}".format(e), err=True)
+        return info.album_artwork
     if proxied is None:
         return info.album_artwork
     return _add_image_formula(proxied)
 
 
 def discogs_update_info(info: AlbumInfo, album: AlbumOrErr) -> AlbumInfo:
-    """Gets values from discogs API and prompts the user to confirm changes."""
+    """Gets values from discogs API (which should already be fetched)"""
 
     new_info = replace(info)  # copy dataclass
     link = info.discogs_url
@@ -243,8 +302,6 @@ def discogs_update_info(info: AlbumInfo, album: AlbumOrErr) -> AlbumInfo:
 
     new_info.genres = "; ".join(sorted(set(metadata.get("genres", []))))
     new_info.styles = "; ".join(sorted(set(metadata.get("styles", []))))
-
-    print_changes(info, new_info, ignore_fields=["album_artwork"])
     return new_info
 
 
@@ -252,37 +309,314 @@ def non_discogs_update(info: AlbumInfo, album: AlbumOrErr) -> AlbumInfo:
     new_info = replace(info)  # copy dataclass
     new_info.genres = "; ".join(_split_separated(info.genres))
     new_info.styles = "; ".join(_split_separated(info.styles))
-
-    print_changes(info, new_info)
     return new_info
 
 
-def upkeep(info: AlbumInfo, album: AlbumOrErr) -> AlbumInfo:
-    new_info = replace(info)  # copy dataclass
-    new_info.reason = "; ".join(_split_separated(info.reason))
+# how many rows can be waiting between each stage of the update pipeline
+QUEUE_SIZE = 32
+
+# how many images to upload to s3 at the same time
+IMAGE_WORKERS = 2
+
+# put on a queue after the last item
+_DONE: Any = object()
 
+
+class _Stop:
+    """
+    The index of the first row which stops the update (because it failed,
+    or is a duplicate). Rows after it skip each stage, like the serial
+    loop which used to stop at that row
+    """
+
+    def __init__(self) -> None:
+        self.index = math.inf
+        self._lock = threading.Lock()
+
+    def at(self, index: int) -> None:
+        with self._lock:
+            self.index = min(self.index, index)
+
+    def skips(self, index: int) -> bool:
+        return index > self.index
+
+
+@dataclass
+class RowUpdate:
+    index: int
+    # the row from the sheet, with the discogs link fixed once it's fetched
+    info: AlbumInfo
+    album: AlbumOrErr
+    new_info: Optional[AlbumInfo] = None
+    # the image couldn't be downloaded, so this should prompt for a URL
+    missing_image: bool = False
+    error: Optional[Exception] = None
+    # the order this was put into the pipeline
+    seq: int = 0
+
+
+def _in_order(inq: queue.Queue[Any]) -> Iterator[RowUpdate]:
+    """Yields rows from inq in the order they were put into the pipeline"""
+    waiting: Dict[int, RowUpdate] = {}
+    seq = 0
+    while (item := inq.get()) is not _DONE:
+        waiting[item.seq] = item
+        while seq in waiting:
+            yield waiting.pop(seq)
+            seq += 1
+    inq.put(_DONE)
+    yield from (waiting[k] for k in sorted(waiting))
+
+
+def _start_stage(
+    func: Callable[[RowUpdate], None],
+    inq: queue.Queue[Any],
+    outq: queue.Queue[Any],
+    *,
+    workers: int,
+    stop: _Stop,
+    ordered: bool = False,
+) -> None:
+    """
+    Starts threads which run func on each row from inq, and pass it to outq.
+    Once all of them have reached the end of inq, puts _DONE on outq. If
+    ordered is True, the rows are handled in order (with a single thread)
+
+    If func raises, the error is saved on the row, and the rows after it skip
+    each stage, so that this stops soon after (like the serial loop used to)
+    """
+    assert not ordered or workers == 1
+    remaining = [workers]
+    lock = threading.Lock()
+
+    def _items() -> Iterator[RowUpdate]:
+        while (item := inq.get()) is not _DONE:
+            yield item
+        inq.put(_DONE)
+
+    def _work() -> None:
+        for item in _in_order(inq) if ordered else _items():
+            if item.error is None and not stop.skips(item.index):
+                try:
+                    func(item)
+                except Exception as e:
+                    item.error = e
+                    stop.at(item.index)
+            outq.put(item)
+        # _DONE is put back on inq, so the other threads for this stage stop as well
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                outq.put(_DONE)
+
+    for _ in range(workers):
+        threading.Thread(target=_work, daemon=True).start()
+
+
+def _fetch_row(item: RowUpdate, *, resolve: bool) -> None:
+    if item.info.has_discogs_link():
+        item.info.discogs_url = _fix_discogs_link(item.info.discogs_url, resolve)
+        fetch_discogs(item.info.discogs_url)
+
+
+def _check_link(links: Dict[str, int], url: str, index: int, stop: _Stop) -> None:
+    """
+    updates exits at the second row with the same link, so this
+    stops the rows after that before their images are uploaded
+    """
+    other = links.setdefault(url, index)
+    if other != index:
+        stop.at(max(other, index))
+        links[url] = min(other, index)
+
+
+def _compute_row(item: RowUpdate, *, links: Dict[str, int], stop: _Stop) -> None:
+    if item.info.has_discogs_link():
+        new_info = discogs_update_info(item.info, item.album)
+    else:
+        new_info = non_discogs_update(item.info, item.album)
+    new_info.reason = "; ".join(_split_separated(item.info.reason))
+    item.new_info = new_info
+    if new_info.has_discogs_link():
+        _check_link(links, new_info.discogs_url, item.index, stop)
+
+
+def _proxy_row_image(item: RowUpdate) -> None:
+    assert item.new_info is not None
     try:
-        new_info.album_artwork = _s3_proxy_image(new_info)
+        artwork = _s3_proxy_image(item.new_info, prompt=False)
     except Exception as e:
         click.echo("Error uploading image to s3: {}".format(e), err=True)
+        return
+    if artwork is None:
+        item.missing_image = True
+    else:
+        item.new_info.album_artwork = artwork
 
-    print_changes(info, new_info, ignore_fields=["album_artwork"])
-    return new_info
 
+def run_pipeline(
+    items: Iterable[RowUpdate],
+    *,
+    resolve: bool,
+    workers: int = DEFAULT_WORKERS,
+    image_workers: int = IMAGE_WORKERS,
+    links: Iterable[Tuple[str, int]] = (),
+) -> Dict[int, RowUpdate]:
+    """
+    Updates the rows in stages, connected by bounded queues:
 
-def update_row(info: AlbumInfo, album: AlbumOrErr, *, resolve: bool) -> AlbumInfo:
-    """Updates with Discogs data if necessary."""
-    if info.has_discogs_link():  # if this has a discogs link
-        info.discogs_url = _fix_discogs_link(info.discogs_url, resolve)
-        info = discogs_update_info(info, album)
-    else:
-        info = non_discogs_update(info, album)
-    info = upkeep(info, album)
-    return info
+    fetch discogs data (workers threads) -> compute the new AlbumInfo (1 thread)
+    -> upload images to s3 (image_workers threads)
+
+    Rows finish in any order, so they're returned keyed by their index. links
+    are the (discogs link, index) of rows which aren't being updated, to
+    check for duplicates. Rows after a failed/duplicate row aren't updated
+    """
+    if "USE_S3_URL" in os.environ:
+        # load the image database before any of the threads use it
+        try:
+            from .image_proxy import image_db
+
+            image_db()
+        except ImportError:
+            pass
+
+    stop = _Stop()
+    seen: Dict[str, int] = {}
+    for url, index in links:
+        _check_link(seen, url, index, stop)
+    to_fetch: queue.Queue[Any] = queue.Queue(QUEUE_SIZE)
+    to_compute: queue.Queue[Any] = queue.Queue(QUEUE_SIZE)
+    to_proxy: queue.Queue[Any] = queue.Queue(QUEUE_SIZE)
+    finished: queue.Queue[Any] = queue.Queue(QUEUE_SIZE)
+    _start_stage(
+        partial(_fetch_row, resolve=resolve),
+        to_fetch,
+        to_compute,
+        workers=workers,
+        stop=stop,
+    )
+    _start_stage(
+        partial(_compute_row, links=seen, stop=stop),
+        to_compute,
+        to_proxy,
+        workers=1,
+        stop=stop,
+        # so duplicates are found before the rows after them are uploaded
+        ordered=True,
+    )
+    _start_stage(_proxy_row_image, to_proxy, finished, workers=image_workers, stop=stop)
 
+    def _produce() -> None:
+        # items are in order, so nothing after this is needed
+        for seq, item in enumerate(items):
+            if stop.skips(item.index):
+                break
+            item.seq = seq
+            to_fetch.put(item)
+        to_fetch.put(_DONE)
+
+    threading.Thread(target=_produce, daemon=True).start()
+
+    results: Dict[int, RowUpdate] = {}
+    while (item := finished.get()) is not _DONE:
+        results[item.index] = item
+    return results
+
+
+# Album, Artist, Year, Reason, Album Artwork, Discogs Link, Artist ID(s), Genre, Style
+# score (A) and listened on (E) are never written by discogs-update
+UPDATE_COLUMNS = [1, 2, 3, 5, 6, 7, 8, 9, 10]
 
-def updates(values: WorksheetData, resolve: bool) -> WorksheetData:
-    """Error Handling, exits cleanly on exceptions."""
+# slugify_hash -> (hash of the row, epoch time) from the last time discogs-update updated it
+Fingerprints = Dict[str, Tuple[str, float]]
+
+FINGERPRINTS_PATH = Path(SETTINGS.CACHE_DIR) / "discogs_update_fingerprints.json"
+
+
+def load_fingerprints() -> Fingerprints:
+    if not FINGERPRINTS_PATH.exists():
+        return {}
+    try:
+        data = json.loads(FINGERPRINTS_PATH.read_text())
+    except ValueError:
+        eprint(f"Could not parse {FINGERPRINTS_PATH}, ignoring")
+        return {}
+    # ignore anything saved in an older format
+    return {
+        slug: (saved[0], float(saved[1]))
+        for slug, saved in data.items()
+        if isinstance(saved, list) and len(saved) == 2
+    }
+
+
+def save_fingerprints(fingerprints: Fingerprints) -> None:
+    with atomic_write(FINGERPRINTS_PATH) as tmp:
+        tmp.write_text(json.dumps(fingerprints))
+
+
+def row_fingerprint(row: WorksheetRow) -> str:
+    """Hashes the columns in a row discogs-update can change"""
+    padded = _pad_data([str(c) for c in row], 11)
+    data = json.dumps([padded[i] for i in UPDATE_COLUMNS])
+    return hashlib.sha1(data.encode()).hexdigest()
+
+
+def _unchanged(
+    info: AlbumInfo, row_hash: str, fingerprints: Fingerprints, *, resolve: bool
+) -> bool:
+    """
+    Whether or not this row can be skipped, because it hasn't changed
+    since the last time discogs-update ran and the discogs data is still cached
+    """
+    saved = fingerprints.get(info.slugify_hash())
+    if saved is None or saved[0] != row_hash:
+        return False
+    if info.has_discogs_link():
+        if resolve and "/release/" in info.discogs_url:
+            return False
+        store = discogs_store()
+        # the row uses the main release for masters as well
+        urls = [info.discogs_url]
+        urls.extend(
+            f"https://www.discogs.com/release/{release_id}"
+            for release_id in store.main_releases(urls).values()
+        )
+        for url in urls:
+            if (timestamps := store.timestamps(url)) is None:
+                return False
+            fetched_at, expires_at = timestamps
+            # if the cached data was refreshed (e.g. in the background) after this
+            # row was last updated, update it again with the new data
+            if fetched_at.timestamp() > saved[1]:
+                return False
+            if expires_at is not None and expires_at < datetime.now():
+                return False
+    # if the image upload failed last time, retry it
+    if (s3_prefix := os.environ.get("USE_S3_URL")) is not None:
+        if info.album_artwork.strip() and s3_prefix not in info.album_artwork:
+            return False
+    return True
+
+
+def updates(
+    values: WorksheetData,
+    resolve: bool,
+    fingerprints: Optional[Fingerprints] = None,
+    *,
+    workers: int = DEFAULT_WORKERS,
+    image_workers: int = IMAGE_WORKERS,
+) -> WorksheetData:
+    """
+    Error Handling, exits cleanly on exceptions.
+
+    If fingerprints are passed, rows which haven't changed since the
+    last run are skipped, and fingerprints is updated with the new
+    hashes for each row that was updated
+
+    The rows are updated concurrently by run_pipeline, and then any
+    changes/prompts are printed in the order the rows are on the sheet
+    """
     header = values.pop(0)
     all_links: Set[str] = set()
 
@@ -290,8 +624,41 @@ def updates(values: WorksheetData, resolve: bool) -> WorksheetData:
         export_data(data_source=values, remove_header=False)
     )
 
-    for index, (album, row) in enumerate(zip(albums, values, strict=True)):
-        info: AlbumInfo = AlbumInfo.from_row(row)
+    infos: List[AlbumInfo] = [AlbumInfo.from_row(row) for row in values]
+    skip: List[bool] = [
+        fingerprints is not None
+        and _unchanged(info, row_fingerprint(row), fingerprints, resolve=resolve)
+        for info, row in zip(infos, values)
+    ]
+
+    # read everything that's already cached with a few queries,
+    # instead of one per URL as each row is fetched
+    preload_discogs(
+        info.discogs_url
+        for info, skipped in zip(infos, skip)
+        if not skipped and info.has_discogs_link()
+    )
+    results = run_pipeline(
+        (
+            RowUpdate(index=index, info=replace(info), album=album)
+            for index, (album, info, skipped) in enumerate(zip(albums, infos, skip))
+            if not skipped
+        ),
+        resolve=resolve,
+        workers=workers,
+        image_workers=image_workers,
+        links=(
+            (info.discogs_url, index)
+            for index, (info, skipped) in enumerate(zip(infos, skip))
+            if skipped and info.has_discogs_link()
+        ),
+    )
+    # once a row fails, the rest are skipped, so raise the error before anything else
+    for index in sorted(results):
+        if (error := results[index].error) is not None:
+            raise error
+
+    for index, (album, info) in enumerate(zip(albums, infos, strict=True)):
         if isinstance(album, Exception):
             eprint(info)
             eprint(album)
@@ -299,8 +666,21 @@ def updates(values: WorksheetData, resolve: bool) -> WorksheetData:
             assert (
                 album.discogs_url == info.discogs_url
             ), f"{album.discogs_url} != {info.discogs_url}"
-        info = update_row(info, album, resolve=resolve)
-        values[index] = info.to_row()
+        if not skip[index]:
+            result = results[index]
+            assert result.new_info is not None
+            info, new_info = result.info, result.new_info
+            if result.missing_image:
+                new_info.album_artwork = _prompt_image(new_info)
+            print_changes(info, new_info, ignore_fields=["album_artwork"])
+            info = new_info
+            values[index] = info.to_row()
+            # dont save rows with errors, so they're checked again next time
+            if fingerprints is not None and not isinstance(album, Exception):
+                fingerprints[info.slugify_hash()] = (
+                    row_fingerprint(values[index]),
+                    time.time(),
+                )
 
         # check for duplicate links, i.e. duplicate entries
         if info.has_discogs_link():
@@ -310,198 +690,256 @@ def updates(values: WorksheetData, resolve: bool) -> WorksheetData:
                 eprint(f"Found duplicate of {info.discogs_url}. Exiting...")
                 break
 
+    if fingerprints is not None:
+        eprint(f"Skipped {sum(skip)} rows which haven't changed since the last update")
+
     values.insert(0, header)  # put header back
     return values
 
 
+def _column_letter(index: int) -> str:
+    return chr(ord("A") + index)
+
+
+def _changed_runs(
+    old_row: WorksheetRow, new_row: WorksheetRow
+) -> List[Tuple[int, int]]:
+    """
+    Returns (start, end) column indices (inclusive) for each run of
+    adjacent cells which changed in this row
+    """
+    old = _pad_data([str(c) for c in old_row], 11)
+    new = _pad_data([str(c) for c in new_row], 11)
+    runs: List[Tuple[int, int]] = []
+    for col in UPDATE_COLUMNS:
+        if old[col] == new[col]:
+            continue
+        # extend the previous run if this is the next column over
+        if runs and runs[-1][1] == col - 1:
+            runs[-1] = (runs[-1][0], col)
+        else:
+            runs.append((col, col))
+    return runs
+
+
+def changed_ranges(
+    old_values: WorksheetData, values: WorksheetData
+) -> List[ValueRange]:
+    """
+    Diffs the rows in values against the rows that were fetched from the sheet
+
+    Returns the ranges for a batchUpdate request which only includes cells
+    that changed. Adjacent cells in a row are merged into one range, and so
+    are consecutive rows which changed in the same columns
+    """
+    assert len(old_values) == len(values), f"{len(old_values)} != {len(values)}"
+    # ranges which are still being extended, keyed by (start col, end col)
+    open_ranges: Dict[Tuple[int, int], Tuple[int, WorksheetData]] = {}
+    closed: List[Tuple[int, int, int, WorksheetData]] = []
+    for index, (old_row, new_row) in enumerate(zip(old_values, values)):
+        runs = _changed_runs(old_row, new_row)
+        for run in list(open_ranges):
+            if run not in runs:
+                start_index, rows = open_ranges.pop(run)
+                closed.append((start_index, *run, rows))
+        padded = _pad_data([str(c) for c in new_row], 11)
+        for run in runs:
+            cells = padded[run[0] : run[1] + 1]
+            if run in open_ranges:
+                open_ranges[run][1].append(cells)
+            else:
+                open_ranges[run] = (index, [cells])
+    for run, (start_index, rows) in open_ranges.items():
+        closed.append((start_index, *run, rows))
+
+    update_data: List[ValueRange] = []
+    for start_index, start_col, end_col, rows in sorted(closed):
+        start = f"{_column_letter(start_col)}{start_index + 1}"
+        end = f"{_column_letter(end_col)}{start_index + len(rows)}"
+        update_data.append({"range": f"Music!{start}:{end}", "values": rows})
+    return update_data
+
+
 @backoff.on_exception(
     lambda: backoff.constant(interval=10),
     httplib2.error.ServerNotFoundError,
     max_tries=5,
     on_backoff=backoff_hdlr,
 )
-def update_values(values, credentials):
-    """Updates the values on the spreadsheet"""
+def update_values(old_values: WorksheetData, values: WorksheetData) -> int:
+    """
+    Updates the values on the spreadsheet, only sending cells which changed
+
+    Returns the number of cells updated
+    """
     # Uses batchUpdate instead of update since its difficult to format 'date listened on' from FORMULA valueRenderOption
-    service = discovery.build(
-        "sheets", "v4", credentials=credentials, cache_discovery=False
+    update_data = changed_ranges(old_values, values)
+    sending = sum(len(r["values"]) * len(r["values"][0]) for r in update_data)
+    skipped = len(values) * len(UPDATE_COLUMNS) - sending
+    eprint(
+        f"Sending {sending} changed cells in {len(update_data)} ranges, skipped {skipped} unchanged cells"
     )
-    no_of_rows = len(values)
-    update_data = [
-        {
-            # Album, Artist, Year
-            "range": "Music!B1:D{}".format(no_of_rows),
-            "values": [_pad_data(vals[1:4], 3) for vals in values],
-        },
-        {
-            # Reason, Album Artwork, Discogs Link, Artist ID(s), Genre, Style
-            "range": "Music!F1:K{}".format(no_of_rows),
-            "values": [_pad_data(vals[5:], 6) for vals in values],
-        },
-    ]
-    update_body = {
-        "valueInputOption": "USER_ENTERED",  # to allow images to display
-        "data": update_data,
-    }
-    request = (
-        service.spreadsheets()
-        .values()
-        .batchUpdate(spreadsheetId=SETTINGS.SPREADSHEET_ID, body=update_body)
-    )
-    return request.execute()
+    if not update_data:
+        return 0
+    response = batch_update(update_data)
+    return int(response["totalUpdatedCells"])
 
 
-def update_new_entries(resolve: bool) -> int:
-    """Returns the number of cells updated"""
-    credentials = get_credentials()
+def update_new_entries(
+    resolve: bool,
+    full: bool = False,
+    *,
+    workers: int = DEFAULT_WORKERS,
+    image_workers: int = IMAGE_WORKERS,
+) -> int:
+    """
+    Returns the number of cells updated
+
+    Unless full is True, skips rows which haven't changed since the last run
+    """
     values = get_values(
-        credentials=credentials,
         sheetRange="Music!A1:K",
         valueRenderOption="FORMULA",
         remove_escapes=False,
+        allow_offline=False,
     )
     if len(values) == 0:
         eprint("No values returned")
         raise SystemExit(1)
-    response = update_values(values=updates(values, resolve), credentials=credentials)
-    return int(response["totalUpdatedCells"])
+    # updates modifies the rows in place, so save a copy to diff against
+    old_values = copy.deepcopy(values)
+    # if this is a full update, start over, which also removes any old rows
+    fingerprints = {} if full else load_fingerprints()
+    updated = update_values(
+        old_values,
+        updates(
+            values,
+            resolve,
+            fingerprints,
+            workers=workers,
+            image_workers=image_workers,
+        ),
+    )
+    # only save once the sheet has been updated successfully
+    save_fingerprints(fingerprints)
+    return updated
 
 
 if TYPE_CHECKING:
     from .export import Album
 
 
-def mark_listened(
-    album: Album,
-    spreadsheet: WorksheetData,
-    *,
-    score: float,
-    listened_on: Optional[date] = None,
-) -> None:
-    """Marks the album as listened to on the spreadsheet"""
-    change_index = None
-    for index, row in enumerate(spreadsheet):
-        if album.discogs_url == row[6] or (
-            album.album_name == row[1]
-            and album.cover_artists == row[2]
-            and album.year == row[3]
-        ):
-            row[0] = score
-            if listened_on is not None:
-                print(f"Setting listened on to {listened_on}")
-                row[4] = listened_on.strftime("%Y-%m-%d")
-            change_index = index
-            break
-    else:
-        raise Exception(f"Could not find {album} in spreadsheet")
-    assert change_index is not None
-
-    credentials = get_credentials()
-    service = discovery.build(
-        "sheets", "v4", credentials=credentials, cache_discovery=False
+def _row_matches(album: Album, row: WorksheetRow) -> bool:
+    """Whether a row from the sheet (FORMULA values) is this album"""
+    cells = [str(c).strip() for c in row] + [""] * (11 - len(row))
+    if album.discogs_url is not None and cells[7] == album.discogs_url:
+        return True
+    return (cells[1], cells[2], cells[3]) == (
+        album.album_name,
+        album.cover_artists,
+        str(album.year),
     )
-    update_data = [
+
+
+class Listened(NamedTuple):
+    album: Album
+    score: float
+    listened_on: Optional[date] = None
+    # the row the album was on in the search index, if it was found there
+    row: Optional[int] = None
+
+
+def _listened_updates(listened: Listened, row_number: int) -> List[ValueRange]:
+    update_data: List[ValueRange] = [
         {
             # Score
-            "range": f"Music!A{change_index + 1}",
-            "values": [[score]],
+            "range": f"Music!A{row_number}",
+            "values": [[listened.score]],
         },
     ]
-
-    if listened_on is not None:
+    if listened.listened_on is not None:
         update_data += [
             {
                 # Listened on
-                "range": f"Music!E{change_index + 1}",
-                "values": [[listened_on.strftime("%Y-%m-%d")]],
+                "range": f"Music!E{row_number}",
+                "values": [[listened.listened_on.strftime("%Y-%m-%d")]],
             }
         ]
+    return update_data
 
-    update_body = {
-        "valueInputOption": "USER_ENTERED",  # to allow images to display
-        "data": update_data,
-    }
 
-    request = (
-        service.spreadsheets()
-        .values()
-        .batchUpdate(spreadsheetId=SETTINGS.SPREADSHEET_ID, body=update_body)
-    )
-    request.execute()
-
-
-def add_album(discogs_url: str, reason: str = "Manual") -> None:
+def mark_listened(albums: Sequence[Listened]) -> None:
     """
-    adds a new album to the spreadsheet
+    Marks the albums as listened to on the spreadsheet, in one batchUpdate
 
-    this just adds the album to the bottom of the spreadsheet
+    Reads just the rows from the search index first, to check they still
+    have the same albums. The whole sheet is only read if some of them
+    have moved (or weren't in the index)
     """
-    credentials = get_credentials()
-    service = discovery.build(
-        "sheets", "v4", credentials=credentials, cache_discovery=False
-    )
-    values = get_values(
-        credentials=credentials,
-        sheetRange="Music!A1:K",
-        valueRenderOption="FORMULA",
-        remove_escapes=False,
+    # index in albums -> row number
+    rows: Dict[int, int] = {}
+    known = [(i, a.row) for i, a in enumerate(albums) if a.row is not None]
+    checked = batch_get(
+        [f"Music!A{row}:K{row}" for _, row in known], valueRenderOption="FORMULA"
     )
+    for (i, row), values in zip(known, checked):
+        if values and _row_matches(albums[i].album, values[0]):
+            rows[i] = row
 
-    # check if the last row is empty. if it is, then skip adding an empty row
-    add_empty_row = "".join(map(str, values[-1])).strip() != ""
-
-    if add_empty_row:
-        eprint("Adding empty row to spreadsheet")
-
-        data = (
-            service.spreadsheets().get(spreadsheetId=SETTINGS.SPREADSHEET_ID).execute()
+    if moved := [i for i in range(len(albums)) if i not in rows]:
+        spreadsheet = get_values(
+            sheetRange="Music!A:K", valueRenderOption="FORMULA", allow_offline=False
         )
-        sheetId = data["sheets"][0]["properties"]["sheetId"]
-        assert isinstance(sheetId, int)
-
-        # update row count
-        service.spreadsheets().batchUpdate(
-            spreadsheetId=SETTINGS.SPREADSHEET_ID,
-            body={
-                "requests": [
-                    {
-                        "insertDimension": {
-                            "range": {
-                                "sheetId": sheetId,
-                                "dimension": "ROWS",
-                                "startIndex": len(values),
-                                "endIndex": len(values) + 1,
-                            },
-                            "inheritFromBefore": True,
-                        }
-                    }
-                ]
-            },
-        ).execute()
-
-    update_data = [
-        {
-            # Discogs Link
-            "range": "Music!H{}".format(len(values) + 1),
-            "values": [[discogs_url]],
-        },
-        {
-            # Reason
-            "range": "Music!F{}".format(len(values) + 1),
-            "values": [[reason]],
-        },
-    ]
+        for i in moved:
+            for index, values in enumerate(spreadsheet):
+                if _row_matches(albums[i].album, values):
+                    rows[i] = index + 1
+                    break
+            else:
+                raise Exception(f"Could not find {albums[i].album} in spreadsheet")
 
-    update_body = {
-        "valueInputOption": "USER_ENTERED",  # to allow images to display
-        "data": update_data,
-    }
+    update_data: List[ValueRange] = []
+    for i, listened in enumerate(albums):
+        update_data.extend(_listened_updates(listened, rows[i]))
+    batch_update(update_data)
 
-    eprint(f"Adding {discogs_url} to spreadsheet")
 
-    request = (
-        service.spreadsheets()
-        .values()
-        .batchUpdate(spreadsheetId=SETTINGS.SPREADSHEET_ID, body=update_body)
+def add_albums(discogs_urls: Sequence[str], reason: str = "Manual") -> None:
+    """
+    adds new albums to the bottom of the spreadsheet
+
+    this uses the append API, which finds the last row and inserts rows for
+    the new albums itself, so this doesn't have to read the sheet. The rows
+    it inserts don't keep the sheet's formatting, so that's copied from the
+    row above them afterwards (like inserting them with inheritFromBefore)
+    """
+    rows: WorksheetData = [
+        ["", "", "", "", "", reason, "", url] for url in discogs_urls
+    ]
+    for url in discogs_urls:
+        eprint(f"Adding {url} to spreadsheet")
+    resp = append_values("Music!A:K", rows)
+    # e.g. 'Music!A2845:H2847'
+    start_row, end_row, _, _ = _parse_range(resp["updates"]["updatedRange"])
+    if start_row <= 2:
+        return
+    sheetId = spreadsheet_metadata()["sheets"][0]["properties"]["sheetId"]
+    spreadsheet_batch_update(
+        [
+            {
+                "copyPaste": {
+                    "source": {
+                        "sheetId": sheetId,
+                        "startRowIndex": start_row - 2,
+                        "endRowIndex": start_row - 1,
+                    },
+                    "destination": {
+                        "sheetId": sheetId,
+                        "startRowIndex": start_row - 1,
+                        "endRowIndex": end_row or start_row - 1 + len(rows),
+                    },
+                    "pasteType": "PASTE_FORMAT",
+                }
+            }
+        ]
     )
-    request.execute()
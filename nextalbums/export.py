@@ -3,11 +3,12 @@ import re
 import warnings
 from datetime import date, datetime
 from time import strptime
+from functools import cache
 from pathlib import Path
-from typing import NamedTuple, List, Iterator, Optional, Any, Dict, Union
+from typing import NamedTuple, List, Iterator, Iterable, Optional, Any, Dict, Union
 
 
-from .common import WorksheetData, eprint, parse_url_type
+from .common import WorksheetData, eprint, parse_url_type, remove_image_formula
 
 DROPPED = set(["cant find", "nope"])
 
@@ -54,48 +55,28 @@ class Album(NamedTuple):
             return False
         return True
 
-    def master(self) -> Json:
-        from .discogs_cache import fetch_discogs
+    def discogs(self) -> "DiscogsRecord":
+        """The discogs data for this album, resolved once per URL"""
+        return resolve_discogs(self.discogs_url)
 
-        assert self.discogs_url is not None
-        _type, _ = parse_url_type(self.discogs_url)
-        assert _type == "master"
-        return fetch_discogs(self.discogs_url).metadata
+    def master(self) -> Json:
+        master = self.discogs().master
+        assert master is not None, f"No master for {self.discogs_url}"
+        return master
 
     def has_master(self) -> bool:
-        try:
-            self.master()
-            return True
-        except AssertionError:
-            return False
+        return self.discogs().master is not None
 
     def release(self) -> Json:
-        from .discogs_cache import fetch_discogs
-
-        assert self.discogs_url is not None
-        _type, _ = parse_url_type(self.discogs_url)
-        if _type == "master" and self.has_master():
-            release_id = self.master()["main_release"]
-            main_release_url = f"https://discogs.com/release/{int(release_id)}"
-            return fetch_discogs(main_release_url).metadata
-        else:
-            assert _type == "release"
-            return fetch_discogs(self.discogs_url).metadata
+        release = self.discogs().release
+        assert release is not None, f"No release for {self.discogs_url}"
+        return release
 
     def has_release(self) -> bool:
-        try:
-            self.release()
-            return True
-        except AssertionError:
-            return False
+        return self.discogs().release is not None
 
     def datas(self) -> List[Json]:
-        _datas = []
-        if self.has_master():
-            _datas.append(self.master())
-        if self.has_release():
-            _datas.append(self.release())
-        return _datas
+        return self.discogs().datas
 
     @staticmethod
     def _parse_release_date(rel_raw: Union[str, int]) -> Optional[date]:
@@ -127,27 +108,82 @@ class Album(NamedTuple):
         return None
 
     def release_date(self) -> date:
-        if self.has_master() and self.has_release():
-            # main release could possibly be different than the
-            # main 'year' on the master. If they're the same year,
-            # use the release 'released' data, since its more
-            # accurate
-            if "year" in self.master() and "released" in self.release():
-                master_dt = Album._parse_release_date(self.master()["year"])
-                release_dt = Album._parse_release_date(self.release()["released"])
-                if master_dt is not None and release_dt is not None:
-                    if master_dt.year == release_dt.year:
-                        return release_dt
-        # otherwise, use the year if that exists
-        elif self.has_master():
-            if parsed := Album._traverse_release_dates(self.master()):
-                return parsed
-        elif self.has_release():
-            if parsed := Album._traverse_release_dates(self.release()):
-                return parsed
+        if (dt := self.discogs().release_date) is not None:
+            return dt
         return date(year=self.year, month=1, day=1)
 
 
+class DiscogsRecord(NamedTuple):
+    master: Optional[Json]
+    release: Optional[Json]
+    release_date: Optional[date]
+    images: List[Json]
+
+    @property
+    def datas(self) -> List[Json]:
+        return [d for d in (self.master, self.release) if d is not None]
+
+
+def _resolved_release_date(
+    master: Optional[Json], release: Optional[Json]
+) -> Optional[date]:
+    if master is not None and release is not None:
+        # main release could possibly be different than the
+        # main 'year' on the master. If they're the same year,
+        # use the release 'released' data, since its more
+        # accurate
+        if "year" in master and "released" in release:
+            master_dt = Album._parse_release_date(master["year"])
+            release_dt = Album._parse_release_date(release["released"])
+            if master_dt is not None and release_dt is not None:
+                if master_dt.year == release_dt.year:
+                    return release_dt
+    # otherwise, use the year if that exists
+    elif master is not None:
+        return Album._traverse_release_dates(master)
+    elif release is not None:
+        return Album._traverse_release_dates(release)
+    return None
+
+
+@cache
+def resolve_discogs(discogs_url: Optional[str]) -> DiscogsRecord:
+    """
+    Fetches the master (if this is a master) and the main release/release
+    for a discogs URL, and the release date/images from those
+    """
+    from .discogs_cache import fetch_discogs
+
+    master: Optional[Json] = None
+    release: Optional[Json] = None
+    if discogs_url is not None:
+        _type, _ = parse_url_type(discogs_url)
+        try:
+            if _type == "master":
+                master = fetch_discogs(discogs_url).metadata
+                main_release_url = (
+                    f"https://discogs.com/release/{int(master['main_release'])}"
+                )
+                release = fetch_discogs(main_release_url).metadata
+            else:
+                release = fetch_discogs(discogs_url).metadata
+        except AssertionError:
+            # couldn't fetch the master/release, use whatever was found
+            pass
+    images: List[Json] = []
+    for d in (master, release):
+        if d is not None and (image_list := d.get("images")):
+            assert isinstance(image_list, list)
+            images = image_list
+            break
+    return DiscogsRecord(
+        master=master,
+        release=release,
+        release_date=_resolved_release_date(master, release),
+        images=images,
+    )
+
+
 SEPERATORS = {";", "|"}
 
 
@@ -174,7 +210,6 @@ def export_data(
     data_source: Optional[WorksheetData] = None,
     remove_header: bool = True,
 ) -> Iterator[Union[Exception, Album]]:
-    from .discogs_update import remove_image_formula
     from .core_gsheets import get_values
 
     import xlrd  # type: ignore[import]
@@ -291,27 +326,67 @@ def dump_results(data: Any) -> str:
     )
 
 
-# helper to read the dump back into list of python object
+def stream_results(albums: Iterable[Album], *, ndjson: bool = False) -> Iterator[str]:
+    """
+    Yields the serialized albums as they're parsed, instead of building one
+    large string. If ndjson is True, yields one album per line, else yields
+    the chunks of a JSON array, the same as dump_results
+    """
+    if ndjson:
+        for album in albums:
+            yield dump_results(album) + "\n"
+        return
+    sep = "["
+    for album in albums:
+        yield sep + dump_results(album)
+        sep = ", "
+    yield "[]\n" if sep == "[" else "]\n"
+
+
+def _album_from_blob(blob: Json) -> Album:
+    fscore: Optional[float] = None
+    if blob["score"] is not None:
+        fscore = float(blob["score"])
+    dlistened_on: Optional[date] = None
+    if blob["listened_on"] is not None:
+        d = strptime(blob["listened_on"], r"%Y-%m-%d")
+        dlistened_on = date(year=d.tm_year, month=d.tm_mon, day=d.tm_mday)
+    return Album(
+        score=fscore,
+        note=blob["note"],
+        album_name=blob["album_name"],
+        cover_artists=blob["cover_artists"],
+        year=int(blob["year"]),
+        listened_on=dlistened_on,
+        album_artwork_url=blob["album_artwork_url"],
+        discogs_url=blob["discogs_url"],
+        reasons=blob["reasons"],
+        genres=blob["genres"],
+        styles=blob["styles"],
+        main_artists=blob["main_artists"],
+    )
+
+
+# helper to read the dump back into list of python object, reads
+# the JSON array, the newline-delimited (ndjson) or the binary format
+#
+# for the binary format, use binary_export.BinaryDump to access albums by index
 def read_dump(p: Path) -> Iterator[Album]:
-    for blob in json.loads(p.read_text()):
-        fscore: Optional[float] = None
-        if blob["score"] is not None:
-            fscore = float(blob["score"])
-        dlistened_on: Optional[date] = None
-        if blob["listened_on"] is not None:
-            d = strptime(blob["listened_on"], r"%Y-%m-%d")
-            dlistened_on = date(year=d.tm_year, month=d.tm_mon, day=d.tm_mday)
-        yield Album(
-            score=fscore,
-            note=blob["note"],
-            album_name=blob["album_name"],
-            cover_artists=blob["cover_artists"],
-            year=int(blob["year"]),
-            listened_on=dlistened_on,
-            album_artwork_url=blob["album_artwork_url"],
-            discogs_url=blob["discogs_url"],
-            reasons=blob["reasons"],
-            genres=blob["genres"],
-            styles=blob["styles"],
-            main_artists=blob["main_artists"],
-        )
+    from .binary_export import is_binary_dump, BinaryDump
+
+    if is_binary_dump(p):
+        with BinaryDump(p) as dump:
+            yield from dump
+        return
+    with p.open() as f:
+        first = f.read(1)
+        while first.isspace():
+            first = f.read(1)
+        f.seek(0)
+        if first == "[":
+            for blob in json.load(f):
+                yield _album_from_blob(blob)
+        else:
+            for line in f:
+                if line.strip():
+                    yield _album_from_blob(json.loads(line))
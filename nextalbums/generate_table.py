@@ -7,10 +7,10 @@ import shutil
 from prettytable import PrettyTable  # type: ignore[import]
 
 from .core_gsheets import get_values
-from .common import WorksheetData, eprint
+from .common import WorksheetData, WorksheetRow, eprint
 
 
-def generate_table(count: int, choose_random: bool) -> str:
+def format_table(header: WorksheetRow, rows: WorksheetData) -> str:
     terminal_width = shutil.get_terminal_size().columns
     allow_width = terminal_width // 3
 
@@ -22,6 +22,19 @@ def generate_table(count: int, choose_random: bool) -> str:
         max_lines=3,
     )
 
+    # setup pretty table
+    p_table = PrettyTable()
+    p_table.field_names = header  # set header
+    for header_name in header:
+        p_table.align[header_name] = "l"  # align left
+
+    for row in rows:
+        p_table.add_row(["\n".join(text_wrapper.wrap(x)) for x in row])
+
+    return str(p_table)
+
+
+def generate_table(count: int, choose_random: bool) -> str:
     # grab values from sheet
     values: WorksheetData = get_values(
         sheetRange="Music!A1:D", valueRenderOption="FORMATTED_VALUE"
@@ -32,12 +45,6 @@ def generate_table(count: int, choose_random: bool) -> str:
 
     header = values.pop(0)[1:]  # pop header from values
 
-    # setup pretty table
-    p_table = PrettyTable()
-    p_table.field_names = header  # set header
-    for header_name in header:
-        p_table.align[header_name] = "l"  # align left
-
     not_listened_to: WorksheetData = [
         [album, artist, year]
         for (score, album, artist, year) in values
@@ -47,7 +54,4 @@ def generate_table(count: int, choose_random: bool) -> str:
     if choose_random:
         random.shuffle(not_listened_to)
 
-    for row in itertools.islice(not_listened_to, count):
-        p_table.add_row(["\n".join(text_wrapper.wrap(x)) for x in row])
-
-    return str(p_table)
+    return format_table(header, list(itertools.islice(not_listened_to, count)))
@@ -4,6 +4,7 @@ import json
 import time
 import shutil
 import atexit
+import threading
 from typing import cast
 from pathlib import Path
 from urllib.parse import urlparse
@@ -56,6 +57,18 @@ def image_db() -> pickledb.PickleDB:
     return setup_db()
 
 
+# pickledb isn't thread safe, and images are uploaded from multiple threads
+# by discogs-update, so any access to image_db should hold this
+_db_lock = threading.Lock()
+
+
+class MissingImage(Exception):
+    """
+    Raised by proxy_image when the image couldn't be downloaded and
+    prompt is False, so the caller can ask for a URL later
+    """
+
+
 s3_prefix = os.environ["USE_S3_URL"]
 s3_bucket = os.environ["S3_BUCKET"]
 
@@ -105,11 +118,12 @@ def _upload_image(
 
 
 def proxy_image(
-    url: str, album_id: str, discogs_url: str, retry: bool = True
+    url: str, album_id: str, discogs_url: str, retry: bool = True, prompt: bool = True
 ) -> str | None:
-    db = image_db()
-    if db.exists(album_id):
-        resp = db.get(album_id)
+    with _db_lock:
+        db = image_db()
+        resp = db.get(album_id) if db.exists(album_id) else None
+    if resp is not None:
         if resp == 404:
             return None
         assert isinstance(resp, str)
@@ -125,9 +139,9 @@ def proxy_image(
         if image_bytes is None:
             # set BG=1 to skip prompts, then can run without setting the envvar to prompt all at once
             if "BG" not in os.environ:
-                prompted_url = click.prompt(f"Image URL for {album_id}").strip()
-                if prompted_url.strip():
-                    return proxy_image(prompted_url, album_id, discogs_url, retry=False)
+                if not prompt:
+                    raise MissingImage(url)
+                return prompt_image(album_id, discogs_url)
 
             # db.set(album_id, 404)
             return None
@@ -140,8 +154,17 @@ def proxy_image(
         # upload to aws s3
         _upload_image(image_bytes, s3_bucket, key, content_type)
 
-        assert db.set(album_id, key)
+        with _db_lock:
+            assert db.set(album_id, key)
         https_url = _prefix_url(key)
         eprint(f"image_proxy: uploaded to {https_url}")
 
         return https_url
+
+
+def prompt_image(album_id: str, discogs_url: str) -> str | None:
+    """Asks for an image URL to use instead, when an image couldn't be downloaded"""
+    prompted_url = click.prompt(f"Image URL for {album_id}").strip()
+    if prompted_url.strip():
+        return proxy_image(prompted_url, album_id, discogs_url, retry=False)
+    return None
@@ -0,0 +1,232 @@
+"""
+A ranked queue of the albums I haven't listened to yet, used by print-next
+
+Albums are ranked by:
+    - how many reasons they're on the sheet for, weighted by how much of each
+      reason I've already listened to (so lists I'm close to finishing come first)
+    - how well their genres/styles match albums I've rated highly, with
+      recent ratings counting more than old ones
+
+The queue is saved to a file along with the spreadsheet version, so
+print-next doesn't have to read the whole sheet if it hasn't changed.
+mark-listened updates the saved queue directly
+"""
+
+import json
+import math
+import heapq
+import random
+from pathlib import Path
+from datetime import date
+from typing import Dict, List, Iterable, Optional, Any, NamedTuple, Tuple
+
+from . import SETTINGS
+from .common import PERSONAL, eprint, atomic_write
+from .export import Album
+
+QUEUE_PATH = Path(SETTINGS.CACHE_DIR) / "next_queue.json"
+
+# how much each part of the ranking counts for
+REASON_WEIGHT = 1.0
+TASTE_WEIGHT = 1.0
+
+# ratings this many days old count for half as much
+HALF_LIFE_DAYS = 365
+
+# genres/styles with few ratings are pulled towards the average rating
+PRIOR_WEIGHT = 3.0
+
+# [sum of weighted scores, sum of weights]
+Totals = List[float]
+
+
+class QueueEntry(NamedTuple):
+    album: str
+    artist: str
+    year: int
+    reasons: List[str]
+    tags: List[str]
+
+
+def album_key(album: Album) -> str:
+    return f"{album.album_name}|{album.cover_artists}|{album.year}"
+
+
+def _tags(album: Album) -> List[str]:
+    # genres and styles can have the same name, so prefix them
+    return [f"genre:{g}" for g in album.genres] + [f"style:{s}" for s in album.styles]
+
+
+def _reasons(album: Album) -> List[str]:
+    return [r for r in album.reasons if r.lower() not in PERSONAL]
+
+
+def _decay(listened_on: Optional[date], today: date) -> float:
+    if listened_on is None:
+        return 1.0
+    return float(0.5 ** (max((today - listened_on).days, 0) / HALF_LIFE_DAYS))
+
+
+class NextQueue:
+    def __init__(
+        self,
+        *,
+        version: Optional[str] = None,
+        overall: Optional[Totals] = None,
+        tags: Optional[Dict[str, Totals]] = None,
+        reasons: Optional[Dict[str, List[int]]] = None,
+        entries: Optional[Dict[str, QueueEntry]] = None,
+    ) -> None:
+        self.version = version
+        self.overall: Totals = overall or [0.0, 0.0]
+        self.tags: Dict[str, Totals] = tags or {}
+        # reason -> [listened, total]
+        self.reasons: Dict[str, List[int]] = reasons or {}
+        self.entries: Dict[str, QueueEntry] = entries or {}
+
+    def _add_rating(self, album: Album, score: float, weight: float) -> None:
+        self.overall[0] += score * weight
+        self.overall[1] += weight
+        for tag in _tags(album):
+            totals = self.tags.setdefault(tag, [0.0, 0.0])
+            totals[0] += score * weight
+            totals[1] += weight
+
+    @staticmethod
+    def build(albums: Iterable[Album], version: Optional[str] = None) -> "NextQueue":
+        queue = NextQueue(version=version)
+        today = date.today()
+        for album in albums:
+            for reason in _reasons(album):
+                queue.reasons.setdefault(reason, [0, 0])[1] += 1
+            if album.listened:
+                assert album.score is not None
+                queue._add_rating(album, album.score, _decay(album.listened_on, today))
+                for reason in _reasons(album):
+                    queue.reasons[reason][0] += 1
+            elif not album.dropped and album.score is None:
+                queue.entries[album_key(album)] = QueueEntry(
+                    album=album.album_name,
+                    artist=album.cover_artists,
+                    year=album.year,
+                    reasons=_reasons(album),
+                    tags=_tags(album),
+                )
+        return queue
+
+    def mark_listened(self, album: Album, score: float) -> None:
+        """Removes an album from the queue, and counts its rating"""
+        if self.entries.pop(album_key(album), None) is None:
+            return
+        self._add_rating(album, score, 1.0)
+        for reason in _reasons(album):
+            self.reasons.setdefault(reason, [0, 1])[0] += 1
+
+    def priority(self, entry: QueueEntry) -> float:
+        reason_score = sum(
+            1 + listened / total
+            for listened, total in (self.reasons.get(r, [0, 1]) for r in entry.reasons)
+        )
+        taste = 0.0
+        if self.overall[1] > 0 and entry.tags:
+            mean = self.overall[0] / self.overall[1]
+            for tag in entry.tags:
+                weighted, weight = self.tags.get(tag, (0.0, 0.0))
+                taste += (weighted + PRIOR_WEIGHT * mean) / (
+                    weight + PRIOR_WEIGHT
+                ) - mean
+            taste /= len(entry.tags)
+        return REASON_WEIGHT * math.log1p(reason_score) + TASTE_WEIGHT * taste
+
+    def top(self, count: int) -> List[QueueEntry]:
+        """The highest ranked albums"""
+        return heapq.nlargest(count, self.entries.values(), key=self.priority)
+
+    def sample(
+        self, count: int, rng: Optional[random.Random] = None
+    ) -> List[QueueEntry]:
+        """
+        Picks random albums, where higher ranked albums are more likely
+        to be picked (weighted sampling without replacement, using the
+        Efraimidis-Spirakis keys, so the queue doesn't have to be shuffled)
+        """
+        rnd = rng or random.Random()
+        entries = list(self.entries.values())
+        priorities = [self.priority(e) for e in entries]
+        # priorities can be negative, so shift them to be positive
+        low = min(priorities, default=0.0)
+        keyed: List[Tuple[float, int]] = [
+            (rnd.random() ** (1 / (p - low + 1)), i) for i, p in enumerate(priorities)
+        ]
+        return [entries[i] for _, i in heapq.nlargest(count, keyed)]
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "version": self.version,
+            "overall": self.overall,
+            "tags": self.tags,
+            "reasons": self.reasons,
+            "entries": {k: e._asdict() for k, e in self.entries.items()},
+        }
+
+    @staticmethod
+    def from_json(data: Dict[str, Any]) -> "NextQueue":
+        return NextQueue(
+            version=data["version"],
+            overall=data["overall"],
+            tags=data["tags"],
+            reasons=data["reasons"],
+            entries={k: QueueEntry(**e) for k, e in data["entries"].items()},
+        )
+
+
+def load_queue() -> Optional[NextQueue]:
+    if not QUEUE_PATH.exists():
+        return None
+    try:
+        return NextQueue.from_json(json.loads(QUEUE_PATH.read_text()))
+    except (ValueError, KeyError, TypeError):
+        eprint(f"Could not parse {QUEUE_PATH}, ignoring")
+        return None
+
+
+def save_queue(queue: NextQueue) -> None:
+    with atomic_write(QUEUE_PATH) as tmp:
+        tmp.write_text(json.dumps(queue.to_json()))
+
+
+def current_queue() -> NextQueue:
+    """
+    Returns the saved queue if the spreadsheet hasn't changed since
+    it was saved, else reads the sheet and saves a new queue
+    """
+    from .core_gsheets import load_or_build
+    from .export import export_data
+
+    def _build(version: Optional[str]) -> NextQueue:
+        return NextQueue.build(
+            (a for a in export_data() if isinstance(a, Album)), version=version
+        )
+
+    return load_or_build(load_queue, _build, save_queue)
+
+
+def update_listened(
+    listened: Iterable[Tuple[Album, float]], previous_version: Optional[str]
+) -> None:
+    """
+    Updates the saved queue after albums have been marked as listened
+    (with these scores), so the next print-next doesn't have to read the sheet again
+
+    previous_version is the spreadsheet version from before the albums were
+    marked. If the saved queue wasn't up to date with that, it isn't updated
+    """
+    from .core_gsheets import spreadsheet_version
+
+    queue = load_queue()
+    if queue is None or previous_version is None or queue.version != previous_version:
+        return
+    for album, score in listened:
+        queue.mark_listened(album, score)
+    queue.version = spreadsheet_version()
+    save_queue(queue)
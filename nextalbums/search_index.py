@@ -0,0 +1,304 @@
+"""
+A search index over the album name, cover artists and year of each row,
+used to pick albums without reading/parsing the whole sheet
+
+Each album is split into trigrams (like postgres' pg_trgm, every word is
+padded so the start of a word has its own trigrams, which makes prefix
+searches match), and each trigram maps to the albums that contain it
+
+The index is built from the local snapshot of the sheet, and is saved
+with the snapshots mtime/size, so it's only rebuilt when the snapshot
+changes. Searching doesn't make any requests, unless there's no snapshot
+or it's refreshed
+"""
+
+import json
+import unicodedata
+from pathlib import Path
+from collections import Counter
+from typing import Dict, List, NamedTuple, Optional, Any, Set
+
+from . import SETTINGS
+from .common import (
+    WorksheetData,
+    WorksheetRow,
+    eprint,
+    atomic_write,
+    clean_discogs_link,
+)
+from .export import Album, export_data
+
+INDEX_PATH = Path(SETTINGS.CACHE_DIR) / "search_index.json"
+
+# the range the snapshot is saved for, the same one export_data reads
+SHEET_RANGE = "Music!A:K"
+
+# albums which match less than this fraction of the query's trigrams are ignored
+MIN_COVERAGE = 0.5
+
+# if no album has every trigram in the query, the best match is only used
+# if it has this many of them, and is this much better than the next best
+MATCH_COVERAGE = 0.75
+MATCH_MARGIN = 0.2
+
+
+def normalize(text: str) -> List[str]:
+    """Lowercases, removes accents and punctuation, and splits into words"""
+    decomposed = unicodedata.normalize("NFKD", text)
+    stripped = "".join(c for c in decomposed if not unicodedata.combining(c))
+    return "".join(c if c.isalnum() else " " for c in stripped.lower()).split()
+
+
+def trigrams(words: List[str]) -> Set[str]:
+    grams: Set[str] = set()
+    for word in words:
+        padded = f"  {word} "
+        grams.update(padded[i : i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def _clean_url(url: str) -> str:
+    """So that e.g. a trailing slash or a missing 'www.' matches the link on the sheet"""
+    return clean_discogs_link(url) or url.strip()
+
+
+class SearchEntry(NamedTuple):
+    # the row number on the sheet
+    row: int
+    album: str
+    artist: str
+    year: str
+    # the row from the sheet, so it can be parsed into an Album
+    values: WorksheetRow
+
+    @property
+    def label(self) -> str:
+        return f"{self.album} - {self.artist} ({self.year})"
+
+    def to_album(self) -> Album:
+        parsed = next(export_data(data_source=[list(self.values)], remove_header=False))
+        if isinstance(parsed, Exception):
+            raise parsed
+        return parsed
+
+
+class SearchResult(NamedTuple):
+    entry: SearchEntry
+    score: float
+    # the fraction of the query's trigrams this album has
+    coverage: float
+
+
+class SearchIndex:
+    def __init__(
+        self,
+        *,
+        entries: List[SearchEntry],
+        postings: Dict[str, List[int]],
+        version: Optional[str] = None,
+        sizes: Optional[List[int]] = None,
+        names: Optional[List[str]] = None,
+        labels: Optional[List[str]] = None,
+    ) -> None:
+        self.entries = entries
+        # trigram -> indexes of the entries which have it
+        self.postings = postings
+        # 'mtime_ns:size' of the snapshot this was built from
+        self.version = version
+        # these are saved as well, so loading the index is quicker
+        if sizes is None:
+            counts = Counter(i for ids in postings.values() for i in ids)
+            sizes = [counts[i] for i in range(len(entries))]
+        # the number of trigrams for each entry
+        self.sizes = sizes
+        # the normalized album names, and album/artist/year
+        self.names = names or [" ".join(normalize(e.album)) for e in entries]
+        self.labels = labels or [" ".join(normalize(e.label)) for e in entries]
+        # discogs URL/label -> index in entries, for finding an album on the sheet
+        self._lookup: Dict[str, int] = {}
+        for i, (entry, label) in enumerate(zip(entries, self.labels)):
+            self._lookup.setdefault(label, i)
+            if len(entry.values) > 7 and (url := _clean_url(str(entry.values[7]))):
+                self._lookup.setdefault(url, i)
+
+    @staticmethod
+    def build(values: WorksheetData, version: Optional[str] = None) -> "SearchIndex":
+        """Builds the index from the sheet, including the header row"""
+        entries: List[SearchEntry] = []
+        postings: Dict[str, List[int]] = {}
+        for row_number, row in enumerate(values[1:], start=2):
+            if len(row) < 4 or not str(row[1]).strip():
+                continue
+            entry = SearchEntry(
+                row=row_number,
+                album=str(row[1]).strip(),
+                artist=str(row[2]).strip(),
+                year=str(row[3]).strip(),
+                values=row,
+            )
+            for gram in trigrams(
+                normalize(f"{entry.album} {entry.artist} {entry.year}")
+            ):
+                postings.setdefault(gram, []).append(len(entries))
+            entries.append(entry)
+        return SearchIndex(entries=entries, postings=postings, version=version)
+
+    def search(self, query: str, limit: int = 10) -> List[SearchResult]:
+        """
+        Returns the albums which best match the query. Scored by the fraction
+        of the query's trigrams the album has, how similar the two are
+        overall, and whether the album name starts with the query
+        """
+        words = normalize(query)
+        grams = trigrams(words)
+        if not grams:
+            return []
+        counts: Counter[int] = Counter()
+        for gram in grams:
+            counts.update(self.postings.get(gram, ()))
+        prefix = " ".join(words)
+        results: List[SearchResult] = []
+        for i, shared in counts.items():
+            coverage = shared / len(grams)
+            if coverage < MIN_COVERAGE:
+                continue
+            jaccard = shared / (len(grams) + self.sizes[i] - shared)
+            starts = self.names[i].startswith(prefix)
+            results.append(
+                SearchResult(
+                    self.entries[i], coverage + jaccard / 2 + starts / 2, coverage
+                )
+            )
+        results.sort(key=lambda r: (-r.score, r.entry.row))
+        return results[:limit]
+
+    def match(self, query: str) -> List[SearchResult]:
+        """
+        Returns the album the query refers to, or all of the albums
+        which matched equally well if it's ambiguous
+
+        The query can be a discogs URL. If more than one album has all of the
+        query's trigrams (e.g. just an artist name), that's ambiguous unless
+        one of their names is the query
+        """
+        if "://" in query:
+            if (i := self._lookup.get(_clean_url(query))) is None:
+                return []
+            return [SearchResult(self.entries[i], 1.0, 1.0)]
+        normalized = " ".join(normalize(query))
+        exact = [
+            SearchResult(e, 1.0, 1.0)
+            for e, label in zip(self.entries, self.labels)
+            if label == normalized
+        ]
+        if exact:
+            return exact
+        results = self.search(query, limit=len(self.entries))
+        if not results:
+            return []
+        full = [r for r in results if r.coverage == 1.0]
+        if full:
+            named = [
+                r for r in full if " ".join(normalize(r.entry.album)) == normalized
+            ]
+            return named or full
+        # nothing matched the whole query (e.g. a typo), so only use the best
+        # match if it's clearly better than the rest
+        best = results[0]
+        close = [r for r in results if r.score > best.score - MATCH_MARGIN]
+        if len(close) == 1 and best.coverage >= MATCH_COVERAGE:
+            return close
+        return close if len(close) > 1 else []
+
+    def has_url(self, discogs_url: str) -> bool:
+        return _clean_url(discogs_url) in self._lookup
+
+    def row_for(self, album: Album) -> Optional[int]:
+        """
+        The row number the album was on when the snapshot was saved,
+        by its discogs URL or its name/artist/year
+        """
+        i = None
+        if album.discogs_url is not None:
+            i = self._lookup.get(_clean_url(album.discogs_url))
+        if i is None:
+            label = f"{album.album_name} - {album.cover_artists} ({album.year})"
+            i = self._lookup.get(" ".join(normalize(label)))
+        return None if i is None else self.entries[i].row
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            "version": self.version,
+            "entries": [list(e) for e in self.entries],
+            "postings": self.postings,
+            "sizes": self.sizes,
+            "names": self.names,
+            "labels": self.labels,
+        }
+
+    @staticmethod
+    def from_json(data: Dict[str, Any]) -> "SearchIndex":
+        return SearchIndex(
+            entries=[SearchEntry(*e) for e in data["entries"]],
+            postings=data["postings"],
+            version=data["version"],
+            sizes=data["sizes"],
+            names=data["names"],
+            labels=data["labels"],
+        )
+
+
+def load_search_index() -> Optional[SearchIndex]:
+    if not INDEX_PATH.exists():
+        return None
+    try:
+        return SearchIndex.from_json(json.loads(INDEX_PATH.read_text()))
+    except (ValueError, KeyError, TypeError):
+        eprint(f"Could not parse {INDEX_PATH}, ignoring")
+        return None
+
+
+def save_search_index(index: SearchIndex) -> None:
+    with atomic_write(INDEX_PATH) as tmp:
+        tmp.write_text(json.dumps(index.to_json()))
+
+
+def current_search_index(refresh: bool = False) -> SearchIndex:
+    """
+    Returns the saved index if the snapshot hasn't changed since it was
+    saved, else rebuilds it from the snapshot. This only requests the sheet
+    if there is no snapshot yet, or if refresh is True (which updates the
+    snapshot if the sheet has changed)
+    """
+    from . import core_gsheets
+
+    def _sheet() -> WorksheetData:
+        return core_gsheets.get_values(
+            sheetRange=SHEET_RANGE, valueRenderOption="FORMULA"
+        )
+
+    snapshot = core_gsheets._snapshot_path(SHEET_RANGE, "FORMULA")
+
+    def _snapshot_version() -> Optional[str]:
+        if not core_gsheets.OFFLINE and (refresh or not snapshot.exists()):
+            _sheet()
+        if not snapshot.exists():
+            return None
+        stat = snapshot.stat()
+        return f"{stat.st_mtime_ns}:{stat.st_size}"
+
+    def _build(version: Optional[str]) -> SearchIndex:
+        values = None
+        if version is not None:
+            values = core_gsheets.read_snapshot(SHEET_RANGE, "FORMULA")
+        if values is None:
+            # e.g. offline without a snapshot, which reads spreadsheet.csv
+            return SearchIndex.build(_sheet(), version=version)
+        return SearchIndex.build(core_gsheets._remove_escapes(values), version=version)
+
+    return core_gsheets.load_or_build(
+        load_search_index,
+        _build,
+        save_search_index,
+        current_version=_snapshot_version,
+    )
@@ -0,0 +1,233 @@
+"""
+Finds albums which are similar to each other, using the genres, styles,
+artists and reasons for each album
+
+Each album is a TF-IDF weighted vector of those features, stored as a
+sparse (CSR) matrix, and albums are compared using cosine similarity
+
+The matrix is saved to a file along with the spreadsheet version,
+and is only rebuilt when the spreadsheet changes
+"""
+
+import json
+from pathlib import Path
+from typing import List, Optional, NamedTuple, Iterable
+
+import numpy as np
+
+from . import SETTINGS
+from .common import eprint, atomic_write
+from .export import Album
+from .album_table import AlbumTable, Categorical
+from .next_queue import album_key
+
+INDEX_PATH = Path(SETTINGS.CACHE_DIR) / "similarity_index.npz"
+
+# the columns used as features, and the prefix used for their names
+FEATURES = {
+    "genres": "genre",
+    "styles": "style",
+    "main_artists": "artist",
+    "reasons": "reason",
+}
+
+
+class SimilarAlbum(NamedTuple):
+    album: str
+    artist: str
+    year: int
+    similarity: float
+
+
+class SimilarityIndex:
+    """
+    offsets/features/weights are a CSR matrix, where the features for album i
+    are features[offsets[i]:offsets[i + 1]], with the TF-IDF weights in weights.
+    Each row is normalized, so the dot product of two rows is their cosine similarity
+    """
+
+    def __init__(
+        self,
+        *,
+        offsets: np.ndarray,
+        features: np.ndarray,
+        weights: np.ndarray,
+        score: np.ndarray,
+        candidate: np.ndarray,
+        keys: List[str],
+        albums: List[List[str]],
+        feature_names: List[str],
+        version: Optional[str],
+    ) -> None:
+        self.offsets = offsets
+        self.features = features
+        self.weights = weights
+        # NaN if not listened
+        self.score = score
+        # albums which can be recommended (I haven't listened to them)
+        self.candidate = candidate
+        self.keys = keys
+        # [album name, artist, year]
+        self.albums = albums
+        self.feature_names = feature_names
+        self.version = version
+        self._rows = np.repeat(np.arange(len(keys)), np.diff(offsets))
+
+    @staticmethod
+    def build(
+        albums: Iterable[Album], version: Optional[str] = None
+    ) -> "SimilarityIndex":
+        items = list(albums)
+        table = AlbumTable.from_albums(items)
+        n = len(table)
+        rows: List[np.ndarray] = []
+        features: List[np.ndarray] = []
+        feature_names: List[str] = []
+        for column, prefix in FEATURES.items():
+            cat: Categorical = getattr(table, column)
+            rows.append(cat.rows())
+            features.append(cat.ids.astype(np.int64) + len(feature_names))
+            feature_names.extend(f"{prefix}:{v}" for v in cat.values)
+        row = np.concatenate(rows)
+        feature = np.concatenate(features)
+        # sort by album, so each album's features are contiguous
+        order = np.argsort(row, kind="stable")
+        row, feature = row[order], feature[order]
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(row, minlength=n), out=offsets[1:])
+
+        # smoothed inverse document frequency, features are either there or not
+        df = np.bincount(feature, minlength=len(feature_names))
+        idf = np.log((1 + n) / (1 + df)) + 1
+        weights = idf[feature]
+        norms = np.sqrt(np.bincount(row, weights=weights**2, minlength=n))
+        weights /= np.where(norms > 0, norms, 1)[row]
+
+        return SimilarityIndex(
+            offsets=offsets,
+            features=feature,
+            weights=weights,
+            score=table.score,
+            candidate=~table.listened & ~table.dropped & np.isnan(table.score),
+            keys=[album_key(a) for a in items],
+            albums=[[a.album_name, a.cover_artists, str(a.year)] for a in items],
+            feature_names=feature_names,
+            version=version,
+        )
+
+    def vector(self, index: int) -> np.ndarray:
+        """The dense feature vector for an album"""
+        vec = np.zeros(len(self.feature_names))
+        start, end = self.offsets[index], self.offsets[index + 1]
+        vec[self.features[start:end]] = self.weights[start:end]
+        return vec
+
+    def similarities(self, vec: np.ndarray) -> np.ndarray:
+        """Cosine similarity of every album to a (normalized) feature vector"""
+        sims: np.ndarray = np.bincount(
+            self._rows,
+            weights=self.weights * vec[self.features],
+            minlength=len(self.keys),
+        )
+        return sims
+
+    def _top(
+        self, vec: np.ndarray, k: int, exclude: Iterable[int] = ()
+    ) -> List[SimilarAlbum]:
+        sims = self.similarities(vec)
+        allowed = self.candidate.copy()
+        allowed[list(exclude)] = False
+        sims[~allowed] = -np.inf
+        k = min(k, int(allowed.sum()))
+        if k <= 0:
+            return []
+        top = np.argpartition(-sims, k - 1)[:k]
+        top = top[np.argsort(-sims[top], kind="stable")]
+        return [
+            SimilarAlbum(
+                album=self.albums[i][0],
+                artist=self.albums[i][1],
+                year=int(self.albums[i][2]),
+                similarity=float(sims[i]),
+            )
+            for i in top
+        ]
+
+    def index_of(self, album: Album) -> int:
+        try:
+            return self.keys.index(album_key(album))
+        except ValueError:
+            raise ValueError(f"Could not find {album_key(album)} in the index")
+
+    def similar_to(self, album: Album, k: int = 10) -> List[SimilarAlbum]:
+        """The k unlistened albums which are most similar to this album"""
+        index = self.index_of(album)
+        return self._top(self.vector(index), k, exclude=[index])
+
+    def similar_to_top_scored(self, count: int = 25, k: int = 10) -> List[SimilarAlbum]:
+        """The k unlistened albums which are most similar to my highest scored albums"""
+        scored = np.flatnonzero(~np.isnan(self.score))
+        if len(scored) == 0:
+            return []
+        best = scored[np.argsort(-self.score[scored], kind="stable")[:count]]
+        vec = np.sum([self.vector(i) for i in best], axis=0)
+        if (norm := np.linalg.norm(vec)) > 0:
+            vec /= norm
+        return self._top(vec, k)
+
+    def save(self, path: Path = INDEX_PATH) -> None:
+        meta = {
+            "version": self.version,
+            "keys": self.keys,
+            "albums": self.albums,
+            "feature_names": self.feature_names,
+        }
+        # savez adds .npz to the filename if it doesn't end with it
+        with atomic_write(path, suffix=".tmp.npz") as tmp:
+            np.savez_compressed(
+                tmp,
+                offsets=self.offsets,
+                features=self.features,
+                weights=self.weights,
+                score=self.score,
+                candidate=self.candidate,
+                meta=np.array(json.dumps(meta)),
+            )
+
+    @staticmethod
+    def load(path: Path = INDEX_PATH) -> Optional["SimilarityIndex"]:
+        if not path.exists():
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                meta = json.loads(str(data["meta"]))
+                return SimilarityIndex(
+                    offsets=data["offsets"],
+                    features=data["features"],
+                    weights=data["weights"],
+                    score=data["score"],
+                    candidate=data["candidate"],
+                    keys=meta["keys"],
+                    albums=meta["albums"],
+                    feature_names=meta["feature_names"],
+                    version=meta["version"],
+                )
+        except (ValueError, KeyError, OSError):
+            eprint(f"Could not read {path}, ignoring")
+            return None
+
+
+def current_index() -> SimilarityIndex:
+    """
+    Returns the saved index if the spreadsheet hasn't changed since
+    it was saved, else reads the sheet and saves a new index
+    """
+    from .core_gsheets import load_or_build
+    from .export import export_data
+
+    def _build(version: Optional[str]) -> SimilarityIndex:
+        return SimilarityIndex.build(
+            (a for a in export_data() if isinstance(a, Album)), version=version
+        )
+
+    return load_or_build(SimilarityIndex.load, _build, SimilarityIndex.save)
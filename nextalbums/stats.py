@@ -0,0 +1,110 @@
+"""
+Aggregates over the albums I've listened to, computed on an AlbumTable
+"""
+
+from typing import Any, Dict, List
+
+from prettytable import PrettyTable  # type: ignore[import]
+
+from .album_table import AlbumTable
+from .update_datafiles import reason_filename
+
+# groups to compute score statistics for
+SCORE_GROUPS = ["genres", "styles", "reasons", "decade", "year"]
+
+
+def compute_stats(table: AlbumTable, *, min_albums: int = 1) -> Dict[str, Any]:
+    """
+    Returns score statistics by each of SCORE_GROUPS, completion for
+    each reason and how many albums were listened to each month
+
+    Groups with less than min_albums listened albums are left
+    out of the score statistics
+    """
+    listened = table.listened
+    scores: Dict[str, List[Dict[str, Any]]] = {}
+    for key in SCORE_GROUPS:
+        summary = table.describe_by(key, mask=listened)
+        rows = [
+            {
+                "key": k,
+                "albums": s.albums,
+                "mean": round(s.mean, 3),
+                "median": s.median,
+            }
+            for k, s in summary.items()
+            if s.albums >= min_albums
+        ]
+        # categories sorted by how many albums are in them, years chronologically
+        if key in ("decade", "year"):
+            rows.sort(key=lambda r: r["key"])
+        else:
+            rows.sort(key=lambda r: (-r["albums"], r["key"]))
+        scores[key] = rows
+
+    totals = table.count_by("reasons")
+    listened_reasons = table.count_by("reasons", mask=listened)
+    completion = sorted(
+        (
+            {
+                "reason": reason,
+                "file": reason_filename(reason),
+                "listened": listened_reasons.get(reason, 0),
+                "total": total,
+                "percent": round(100 * listened_reasons.get(reason, 0) / total, 2),
+            }
+            for reason, total in totals.items()
+        ),
+        key=lambda r: (-r["percent"], r["reason"]),
+    )
+
+    per_month = table.count_by("listened_month", mask=listened)
+    return {
+        "albums": len(table),
+        "listened": int(listened.sum()),
+        "scores": scores,
+        "completion": completion,
+        "per_month": [
+            {"month": month, "albums": count}
+            for month, count in sorted(per_month.items())
+        ],
+    }
+
+
+def _table(field_names: List[str], rows: List[List[Any]]) -> str:
+    p_table = PrettyTable()
+    p_table.field_names = field_names
+    for name in field_names:
+        p_table.align[name] = "l"
+    for row in rows:
+        p_table.add_row(row)
+    return str(p_table)
+
+
+def format_stats(stats: Dict[str, Any]) -> str:
+    parts = [f"Listened to {stats['listened']} of {stats['albums']} albums"]
+    for key, rows in stats["scores"].items():
+        parts.append(f"Score by {key}:")
+        parts.append(
+            _table(
+                [key, "albums", "mean", "median"],
+                [[r["key"], r["albums"], r["mean"], r["median"]] for r in rows],
+            )
+        )
+    parts.append("Completion by reason:")
+    parts.append(
+        _table(
+            ["reason", "listened", "total", "%"],
+            [
+                [r["reason"], r["listened"], r["total"], r["percent"]]
+                for r in stats["completion"]
+            ],
+        )
+    )
+    parts.append("Albums listened to per month:")
+    parts.append(
+        _table(
+            ["month", "albums"], [[r["month"], r["albums"]] for r in stats["per_month"]]
+        )
+    )
+    return "\n\n".join(parts)
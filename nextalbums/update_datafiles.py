@@ -26,6 +26,11 @@ def write_csv(name: str, results: WorksheetData, *, key: Optional[str] = None) -
             csv_writer.writerow(rrow)
 
 
+def reason_filename(descriptor: str) -> str:
+    """The name of the file in csv_data/reasons for a reason"""
+    return re.sub(r"[\s&/]", "_", descriptor) + ".csv"
+
+
 def _iter_descriptor(albums: List[Album], key: str) -> Set[str]:
     descriptors: Set[str] = set()
     for a in albums:
@@ -49,7 +54,9 @@ def _filter_by_descriptor(
 
 
 def update_datafiles() -> None:
-    values = get_values(sheetRange="Music!A2:K", valueRenderOption="FORMULA")
+    values = get_values(
+        sheetRange="Music!A2:K", valueRenderOption="FORMULA", allow_csv=False
+    )
     albums_exc = list(export_data(data_source=values, remove_header=False))
     albums: List[Album] = []
     for a in albums_exc:
@@ -60,15 +67,16 @@ def update_datafiles() -> None:
 
     for key in {"reasons"}:
         for descriptor in _iter_descriptor(albums, key):
-            desc = re.sub(r"[\s&/]", "_", descriptor)
             rows = list(_filter_by_descriptor(values, albums, key, descriptor))
-            write_csv(f"{desc}.csv", rows, key=key)
+            write_csv(reason_filename(descriptor), rows, key=key)
 
     write_csv("all.csv", values)
 
 
 def write_to_spreadsheets_csv_file(buf: TextIO) -> None:
-    values = get_values(sheetRange="Music!A2:K", valueRenderOption="FORMULA")
+    values = get_values(
+        sheetRange="Music!A2:K", valueRenderOption="FORMULA", allow_csv=False
+    )
     values = filter_personal_reasons(values)
     csv_writer = csv.writer(buf, quoting=csv.QUOTE_ALL)
     max_row_len = max(map(len, values))
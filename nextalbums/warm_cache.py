@@ -0,0 +1,144 @@
+"""
+Requests discogs data for everything on the sheet ahead of time, so
+that exporting/updating doesn't have to wait on the API
+"""
+
+import json
+import time
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import List, Set, Dict, Iterator
+
+from . import SETTINGS
+from .common import WorksheetData, eprint, atomic_write
+from .core_gsheets import get_values
+from .discogs_cache import discogs_store, _fetch_discogs, DEFAULT_WORKERS
+
+CHECKPOINT_PATH = Path(SETTINGS.CACHE_DIR) / "warm_cache_checkpoint.json"
+
+# how often to save the checkpoint file
+CHECKPOINT_EVERY = 10
+
+
+def _sheet_urls(values: WorksheetData) -> Iterator[str]:
+    from .discogs_update import _fix_discogs_link
+
+    for row in values:
+        if len(row) > 7 and str(row[7]).strip():
+            try:
+                yield _fix_discogs_link(str(row[7]), resolve=False)
+            except Exception as e:
+                eprint(str(e))
+
+
+def collect_urls(values: WorksheetData) -> List[str]:
+    """
+    Returns any master/release URLs from the sheet, and the main
+    releases for any masters, which are missing or have expired
+    """
+    store = discogs_store()
+    urls = list(dict.fromkeys(_sheet_urls(values)))
+    main_release_urls = [
+        f"https://discogs.com/release/{release_id}"
+        for release_id in store.main_releases(
+            u for u in urls if "/master/" in u
+        ).values()
+    ]
+    # masters that aren't cached request their main release when they're fetched
+    return list(dict.fromkeys(store.stale(urls + main_release_urls)))
+
+
+def load_checkpoint() -> List[str]:
+    if not CHECKPOINT_PATH.exists():
+        return []
+    try:
+        pending: List[str] = json.loads(CHECKPOINT_PATH.read_text())["pending"]
+    except (ValueError, KeyError):
+        eprint(f"Could not parse {CHECKPOINT_PATH}, ignoring")
+        return []
+    return pending
+
+
+def save_checkpoint(pending: List[str]) -> None:
+    with atomic_write(CHECKPOINT_PATH) as tmp:
+        tmp.write_text(json.dumps({"pending": pending}))
+
+
+def _format_duration(seconds: float) -> str:
+    minutes, secs = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{secs:02d}"
+
+
+def warm_cache(workers: int = DEFAULT_WORKERS, restart: bool = False) -> int:
+    """
+    Fetches everything which is missing from the discogs cache
+
+    Saves the URLs that are left to a checkpoint file as it goes, so
+    if this is interrupted, the next run resumes from there instead of
+    reading the sheet again. Returns the number of URLs fetched
+    """
+    pending: List[str] = [] if restart else load_checkpoint()
+    if pending:
+        eprint(f"[warm-cache] Resuming from checkpoint, {len(pending)} URLs left")
+    else:
+        values = get_values(sheetRange="Music!A:K", valueRenderOption="FORMULA")
+        pending = collect_urls(values[1:])
+    total = len(pending)
+    if total == 0:
+        eprint("[warm-cache] Everything is already cached")
+        CHECKPOINT_PATH.unlink(missing_ok=True)
+        return 0
+
+    eprint(f"[warm-cache] Fetching {total} URLs with {workers} workers")
+    remaining: Set[str] = set(pending)
+    failed: List[str] = []
+    started = time.monotonic()
+    done = 0
+
+    def _save() -> None:
+        save_checkpoint([u for u in pending if u in remaining])
+
+    queue = iter(pending)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        in_flight: Dict[Future, str] = {}
+        try:
+            while True:
+                # keep the pool busy, without queueing every URL at once
+                while len(in_flight) < workers * 2:
+                    url = next(queue, None)
+                    if url is None:
+                        break
+                    in_flight[pool.submit(_fetch_discogs, url, True)] = url
+                if not in_flight:
+                    break
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for fut in finished:
+                    url = in_flight.pop(fut)
+                    done += 1
+                    if (exc := fut.exception()) is not None:
+                        eprint(f"[warm-cache] Failed to fetch {url}: {exc}")
+                        failed.append(url)
+                    else:
+                        remaining.discard(url)
+                    elapsed = time.monotonic() - started
+                    rate = done / elapsed if elapsed > 0 else 0.0
+                    eta = (total - done) / rate if rate > 0 else 0.0
+                    eprint(
+                        f"[warm-cache] {done}/{total} ({rate:.2f}/s, ETA {_format_duration(eta)})"
+                    )
+                    if done % CHECKPOINT_EVERY == 0:
+                        _save()
+        except KeyboardInterrupt:
+            pool.shutdown(wait=False, cancel_futures=True)
+            _save()
+            eprint(f"[warm-cache] Interrupted, saved checkpoint to {CHECKPOINT_PATH}")
+            raise
+
+    if failed:
+        # keep the failed URLs, so they're retried next time
+        _save()
+        eprint(f"[warm-cache] Failed to fetch {len(failed)} URLs, run again to retry")
+    else:
+        CHECKPOINT_PATH.unlink(missing_ok=True)
+    return total - len(failed)
@@ -35,6 +35,13 @@ CREDENTIALS_PATH = os.path.join(
     CREDENTIALS_DIR, "sheets.googleapis.com-python-nextalbums.json"
 )
 
+# local snapshots of the spreadsheet/other cached data
+CACHE_DIR = os.environ.get(
+    "NEXTALBUMS_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "nextalbums"),
+)
+os.makedirs(CACHE_DIR, exist_ok=True)
+
 CSV_DATADIR = os.path.join(this_dir, "csv_data")
 assert os.path.exists(CSV_DATADIR)
 
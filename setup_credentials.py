@@ -11,7 +11,12 @@ from settings import CLIENT_SECRET_FILE, CREDENTIALS_PATH
 # probably wont ever be changed, no point in putting them in settings.py?
 # If modifying these scopes, delete your previously saved credentials
 # at ~/.credentials/sheets.googleapis.com-python-nextalbums.json
-SCOPES = "https://www.googleapis.com/auth/spreadsheets"
+# drive.metadata.readonly is used to check the spreadsheets version,
+# so the local snapshot of the sheet is only re-downloaded when it changes
+SCOPES = [
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive.metadata.readonly",
+]
 APPLICATION_NAME = "Next Albums"
 
 # Set up OAuth2 flow to obtain new credentials
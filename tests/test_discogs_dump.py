@@ -0,0 +1,105 @@
+from pathlib import Path
+from typing import Any, Iterator, List, Tuple
+
+import pytest
+
+from nextalbums import discogs_dump
+from nextalbums.discogs_dump import import_dump, iter_dump
+from nextalbums.discogs_store import DiscogsStore
+
+DATA = Path(__file__).parent / "data"
+MASTERS = DATA / "discogs_masters.xml.gz"
+RELEASES = DATA / "discogs_releases.xml.gz"
+
+MASTER_URL = "https://www.discogs.com/master/{}"
+RELEASE_URL = "https://www.discogs.com/release/{}"
+
+
+@pytest.fixture
+def store(tmp_path: Path) -> DiscogsStore:
+    return DiscogsStore(tmp_path / "discogs.sqlite")
+
+
+@pytest.fixture
+def parsed(monkeypatch: pytest.MonkeyPatch) -> List[str]:
+    """Records the id of every <master>/<release> which is read from a dump"""
+    seen: List[str] = []
+    iterparse = discogs_dump.iterparse
+
+    def _iterparse(*args: Any, **kwargs: Any) -> Iterator[Tuple[str, Any]]:
+        for event, elem in iterparse(*args, **kwargs):
+            if event == "end" and elem.tag in ("master", "release"):
+                seen.append(elem.get("id"))
+            yield event, elem
+
+    monkeypatch.setattr(discogs_dump, "iterparse", _iterparse)
+    return seen
+
+
+def test_iter_dump() -> None:
+    masters = dict((data["id"], data) for _, data in iter_dump(MASTERS))
+    assert list(masters) == [100, 200, 300]
+    first = masters[100]
+    assert first["uri"] == MASTER_URL.format(100)
+    assert first["title"] == "First Album"
+    assert first["main_release"] == 1001
+    assert first["year"] == 1999
+    assert first["genres"] == ["Rock"]
+    assert first["styles"] == ["Indie Rock"]
+    assert first["artists"][0]["id"] == 10
+    assert first["artists"][0]["name"] == "Test Artist"
+    assert first["videos"][0]["duration"] == 180
+    assert first["videos"][0]["embed"] is True
+    # images without a URL are dropped, and so is the key if none are left
+    assert [i["uri"] for i in first["images"]] == [
+        "https://i.discogs.com/master-100.jpg"
+    ]
+    assert "images" not in masters[200]
+
+    releases = list(iter_dump(RELEASES, wanted={1001}))
+    assert [(_type, data["id"]) for _type, data in releases] == [("release", 1001)]
+    release = releases[0][1]
+    assert release["uri"] == RELEASE_URL.format(1001)
+    assert release["master_id"] == 100
+    assert release["year"] == 1999
+    assert release["released"] == "1999-03-02"
+    assert release["labels"] == [{"id": 5, "name": "Test Label", "catno": "TL-001"}]
+    assert release["formats"][0]["descriptions"] == ["Album"]
+    assert release["extraartists"][0]["role"] == "Producer"
+    assert release["tracklist"] == [
+        {"position": "1", "title": "First Song", "duration": "3:00"}
+    ]
+    assert "images" not in release
+
+
+def test_import_dump(store: DiscogsStore, parsed: List[str]) -> None:
+    keys = [("master", 100), ("master", 999), ("release", 4001)]
+    imported, missing = import_dump(store, keys, masters=MASTERS, releases=RELEASES)
+    # the master, its main release, and the release
+    assert imported == 3
+    assert missing == [MASTER_URL.format(999)]
+
+    master = store.get(MASTER_URL.format(100))
+    assert master is not None
+    assert master.metadata["main_release"] == 1001
+    release = store.get(RELEASE_URL.format(1001))
+    assert release is not None
+    assert release.metadata["master_id"] == 100
+    assert store.get(RELEASE_URL.format(4001)) is not None
+    # entries that weren't asked for aren't saved
+    assert store.get(MASTER_URL.format(200)) is None
+    assert store.get(RELEASE_URL.format(1002)) is None
+
+    # master 999 isn't in the dump, so every master is read, but the releases
+    # stop once 4001 (the last one that's needed) has been found
+    assert parsed == ["100", "200", "300", "1001", "1002", "4001"]
+
+
+def test_import_dump_skips_cached(store: DiscogsStore, parsed: List[str]) -> None:
+    import_dump(store, [("master", 100)], masters=MASTERS, releases=RELEASES)
+    parsed.clear()
+    imported, missing = import_dump(
+        store, [("master", 100)], masters=MASTERS, releases=RELEASES
+    )
+    assert (imported, missing) == (0, [])
+    assert parsed == []